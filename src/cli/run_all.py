@@ -1,9 +1,43 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
+import copy
 import json
-import subprocess
+import shlex
+import argparse
+from src.shared.h5_functions import POINTS_EXT
+from src.shared.scheduler import Task, run_graph
+from src.downsample import run_downsample
+from src.inversion import run_inversion
+from src.simulation import run_simulation
+from src import pipeline
+
+
+EXAMPLE = """
+        run_all.py
+        run_all.py --template template.json --jobs 8
+        run_all.py --dry-run
+        run_all.py --single-env
+        run_all.py --in-memory
+"""
+
+
+def create_parser(iargs=None):
+    synopsis = 'Downsample, inversion and simulation check of every (track, period) as a task graph'
+    epilog = EXAMPLE
+    parser = argparse.ArgumentParser(description=synopsis, epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('--template', type=str, default=f"{os.getenv('RSMASINSAR_HOME')}/tools/SourceInversion/template.json",
+                        help="JSON template with the arguments of each stage (default: %(default)s).")
+    parser.add_argument('--jobs', type=int, default=None, help="Worker processes running the tasks (default: 'jobs' of the template, else 1).")
+    parser.add_argument('--dry-run', action='store_true', help="List the tasks and their dependencies without running them.")
+    parser.add_argument('--single-env', action='store_true', help="Run every task as a function of this process' environment instead of running each stage\nin its conda environment ('environments' of the template), mintpy and VSM must both be importable.")
+    parser.add_argument('--in-memory', action='store_true', help="Run every stage in this process, the points passed between them as arrays and\nonly the inversion results written, native engine only.")
+    parser.add_argument('--save-points', action='store_true', help="With --in-memory, also write the downsampled and simulated points.")
+
+    return parser.parse_args(iargs)
 
 
 def load_template(template_path):
@@ -21,57 +55,148 @@ def load_template(template_path):
         sys.exit(1)
 
 
-def run_downsample(args):
-    """
-    Run the downsample module in the 'base' conda environment.
-    """
-    try:
-        cmd = [
-            "bash", "-c",
-            f"source {os.getenv('RSMASINSAR_HOME')}/tools/miniforge3/etc/profile.d/conda.sh && conda activate base && python src/downsample/run_downsample.py {args}"
-        ]
-        print(f"Running downsample command: {' '.join(cmd)}\n")
-        subprocess.run(cmd, capture_output=True, text=True, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running downsample: {e}")
-        sys.exit(1)
+# Module of each stage and the conda environment it runs in unless the template names another one
+STAGES = {
+    'downsample': ('src.downsample.run_downsample', 'base'),
+    'inversion': ('src.inversion.run_inversion', 'vsm'),
+    'simulation': ('src.simulation.run_simulation', 'vsm'),
+}
+CONDA_SH = f"{os.getenv('RSMASINSAR_HOME')}/tools/miniforge3/etc/profile.d/conda.sh"
 
 
-def run_inversion(args):
+def stage_command(template, stage, args):
+    """Command running 'stage' with the arguments 'args' in its conda environment.
+    The environments are the 'environments' of the template, by default those of STAGES, an empty one runs
+    the stage with the interpreter of run_all. 'conda' of the template is the conda.sh to source (default: CONDA_SH).
+    Returns:    list of str
     """
-    Run the inversion module in the 'vsm' conda environment.
+    module, default = STAGES[stage]
+    env = template.get("environments", {}).get(stage, default)
+
+    if not env:
+        return [sys.executable, '-m', module, *args]
+
+    return ["bash", "-c", f"source {shlex.quote(template.get('conda', CONDA_SH))} && conda activate {shlex.quote(env)} && "
+                          f"exec python -m {module} {shlex.join(args)}"]
+
+
+def period_option(period):
+    """--period option selecting one period folder YYYYMMDD_YYYYMMDD."""
+    return ['--period', period.replace('_', ':')] if period else []
+
+
+def build_tasks(template, single_env=False):
+    """Tasks of the pipeline: one downsample per (track, period), one inversion per period depending on the
+    downsample of its tracks, and one simulation check per period depending on its inversion.
+    Every task runs its stage in the conda environment of the stage (see stage_command), as a function of
+    this process with 'single_env'.
+    Parameters: template   - dict, arguments of the stages under 'downsample', 'inversion' and optionally 'simulation'
+                single_env - bool, run the stages in this process' environment
+    Returns:    list of Task
     """
-    try:
-        cmd = [
-            "bash", "-c",
-            f"source {os.getenv('RSMASINSAR_HOME')}/tools/miniforge3/etc/profile.d/conda.sh && conda activate vsm && python src/inversion/run_inversion.py {args}"
-        ]
-        print(f"Running inversion command: {' '.join(cmd)}\n")
-        subprocess.run(cmd, capture_output=True, text=True, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running inversion: {e}")
-        sys.exit(1)
+    # Older templates name the downsample stage 'decomposition'
+    downsample_args = template.get("downsample", template.get("decomposition", ""))
+    inversion_args = template.get("inversion", "")
+    simulation_args = template.get("simulation")
 
+    down = run_downsample.create_parser(shlex.split(downsample_args))
+    down.jobs = 1
+    units = run_downsample.find_units(down)
+    if not down.utm_zone:
+        down.utm_zone = run_downsample.shared_utm_zone(units)
 
-def main():
-    # Path to the template file
-    template_path = f"{os.getenv('RSMASINSAR_HOME')}/tools/SourceInversion/template.json"
+    tasks = []
+    outputs = {}
+    for input_folder, period_folder, node, out_file in units:
+        period = os.path.basename(period_folder) if down.period_folder else None
+        velocity_file, geom_file = run_downsample.input_files(input_folder, period_folder)
+        mask_file = run_downsample.covariance_mask_file(input_folder, period_folder, down.covariance_mask) if down.covariance else []
+        output = out_file + ('.csv' if down.format == 'csv' else POINTS_EXT)
+
+        command = None if single_env else stage_command(template, 'downsample', shlex.split(downsample_args) + period_option(period) +
+                                                        ['--track', node, '--utm-zone', down.utm_zone, '--jobs', '1'])
+
+        tasks.append(Task(f"downsample:{node}:{period}" if period else f"downsample:{node}",
+                          run_downsample.process_folder, args=(input_folder, period_folder, node, out_file, down),
+                          inputs=velocity_file + geom_file + mask_file, outputs=[output],
+                          params={'args': downsample_args, 'utm_zone': down.utm_zone}, command=command))
+        outputs.setdefault(period, []).append((node, tasks[-1]))
+
+    inv = run_inversion.create_parser(shlex.split(inversion_args))
+    regex = re.compile(f"({inv.satellite}[AD]T?)\\d+")
+    periods = inv.period_folder if inv.period_folder else [None]
+
+    previous = None
+    for period in periods:
+        # Every track of the period the inversion reads
+        tracks = [t for node, t in outputs.get(period, []) if regex.match(node)]
+        output_folder = os.path.join(inv.folder_path, period) if period else inv.folder_path
+
+        inps = copy.deepcopy(inv)
+        inps.period_folder = [period] if period else []
+        deps = [t.name for t in tracks]
+        if period and getattr(inv, 'sequential', False) and previous:
+            # Warm started from the previous period
+            inps.warm_from = os.path.dirname(previous.outputs[0])
+            deps.append(previous.name)
+
+        warm_from = ['--warm-from', inps.warm_from] if previous and previous.name in deps else []
+        command = None if single_env else stage_command(template, 'inversion', shlex.split(inversion_args) + period_option(period) + warm_from)
+
+        tasks.append(Task(f"inversion:{period}" if period else "inversion", run_inversion.main, args=(inps,),
+                          inputs=[f for t in tracks for f in t.outputs] + ([previous.outputs[0]] if warm_from else []),
+                          outputs=[os.path.join(output_folder, 'VSM_best.csv')], deps=deps,
+                          params={'args': inversion_args}, command=command))
+        previous = tasks[-1]
+
+        if simulation_args is not None:
+            sim = run_simulation.create_parser(shlex.split(simulation_args))
+            sim_folder = os.path.join(sim.folder_path, 'simulation', period) if period else os.path.join(sim.folder_path, 'simulation')
+
+            command = None if single_env else stage_command(template, 'simulation', shlex.split(simulation_args) + period_option(period))
+
+            tasks.append(Task(f"simulation:{period}" if period else "simulation", run_simulation.simulate_period, args=(sim, period),
+                              inputs=previous.inputs + previous.outputs, outputs=[os.path.join(sim_folder, 'VSM_best.csv')],
+                              deps=[previous.name], params={'args': simulation_args}, command=command))
+
+    return tasks
+
+
+def main(iargs=None):
+    inps = create_parser(iargs)
 
     # Load arguments from the template file
-    template = load_template(template_path)
+    template = load_template(inps.template)
 
-    # Extract arguments for downsample and inversion
-    decomp_args = template.get("downsample", "")
-    inversion_args = template.get("inversion", "")
+    if inps.in_memory:
+        print("#" * 50)
+        print("Running the stages in this process, points kept in memory.\n")
+        pipeline.run(template, save_points=inps.save_points)
+        return 0
+
+    tasks = build_tasks(template, single_env=inps.single_env)
+
+    if inps.dry_run:
+        for task in tasks:
+            print(f"{task.name} <- {task.deps or '-'}")
+            if task.command:
+                print(f"  {task.command[-1]}")
+        return 0
+
+    jobs = inps.jobs or template.get("jobs", 1)
+    print("#" * 50)
+    print(f"Running {len(tasks)} tasks with {jobs} jobs, logs next to the outputs of each task.\n")
+
+    status = run_graph(tasks, jobs=jobs)
 
-    # Run downsample
-    print("Running downsampling...\n")
-    run_downsample(decomp_args)
+    failed = [name for name, state in status.items() if state in ['failed', 'blocked']]
+    if failed:
+        print("#" * 50)
+        print(f"{len(failed)} of {len(tasks)} tasks did not complete: {failed}")
+        return 1
 
-    # Run inversion
-    print("Running inversion...\n")
-    run_inversion(inversion_args)
+    return 0
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,193 @@
+import warnings
+import numpy as np
+from scipy import fft, ndimage
+from scipy.optimize import curve_fit
+
+
+class Covariance:
+    """Empirical covariance of the noise of a velocity field and its exponential model.
+
+    The deformation is masked out with a buffer around it (see deformation_mask),
+    together with the pixels of an optional user mask, and a plane is removed. The autocovariance of
+    the remaining field is then computed with FFTs, normalised by the
+    autocorrelation of the mask so that every lag is averaged over its actual
+    number of pixel pairs. The radial profile of the autocovariance is fitted
+    with C(r) = sill * exp(-r / range). The variance left at zero lag is the
+    nugget, i.e. the uncorrelated noise.
+    """
+    # Lags with fewer pixel pairs are left out of the profile
+    MIN_PAIRS = 100
+    # Smaller groups of outlying pixels are noise, not deformation
+    MIN_DEFORMATION_PIXELS = 25
+    # Smallest fraction of the valid pixels left for the estimate by the buffer
+    MIN_NOISE_FRACTION = 0.1
+
+    def __init__(self, data, dx, dy, n_sigma=3., n_bins=30, max_lag=None, buffer=2., mask=None):
+        """Parameters: data    - 2D np.ndarray, velocity with NaN for no-data
+                       dx, dy  - float, pixel spacing of data in [m]
+                       n_sigma - float, pixels farther than n_sigma robust std from the median are deformation
+                       n_bins  - int, number of distance bins of the radial profile
+                       max_lag - float, largest distance of the profile in [m], default half the scene
+                       buffer  - float, width of the buffer masked around each deformation area, in radii of the area
+                       mask    - 2D np.ndarray of bool, pixels usable for the estimate (e.g. False on known deformation)
+        """
+        self.dx, self.dy = abs(dx), abs(dy)
+
+        valid = self.deformation_mask(data, n_sigma, buffer=buffer, dx=self.dx, dy=self.dy)
+        if mask is not None:
+            valid &= np.asarray(mask, dtype=bool)
+        noise = np.where(valid, self.detrend(data, valid), 0.)
+        cov, pairs = self._autocovariance(noise, valid)
+
+        if max_lag is None:
+            max_lag = min(data.shape[0] * self.dy, data.shape[1] * self.dx) / 2
+        self.distance, self.empirical, self.pairs = self._radial(cov, pairs, n_bins, max_lag)
+
+        self.variance = np.sum(noise[valid] ** 2) / max(np.sum(valid), 1)
+        self.sill, self.range = self._fit()
+        self.nugget = float(max(self.variance - self.sill, 0.))
+
+    @classmethod
+    def deformation_mask(cls, data, n_sigma=3., buffer=2., dx=1., dy=1.):
+        """Valid pixels away from the deformation signal.
+        Pixels farther than n_sigma robust std from the median of the detrended data are outliers, the
+        plane, median and std taken again over the remaining pixels until the outliers no longer change. Every group of at least
+        MIN_DEFORMATION_PIXELS outliers is a deformation area, masked with a buffer of 'buffer' times
+        its equivalent radius around it, so that the tails of the signal below the threshold go too.
+        The buffer is narrowed where it would leave less than MIN_NOISE_FRACTION of the valid pixels.
+        Parameters: data     - 2D np.ndarray, velocity with NaN for no-data
+                    n_sigma  - float, outlier threshold in robust std
+                    buffer   - float, width of the buffer in radii of the area
+                    dx, dy   - float, pixel spacing [m]
+        Returns:    valid    - 2D np.ndarray of bool
+        """
+        valid = np.isfinite(data)
+        outliers = np.zeros(data.shape, dtype=bool)
+
+        for _ in range(10):
+            # Outliers of the data minus the plane of the other pixels, a ramp is not deformation
+            values = np.where(valid, cls.detrend(data, valid & ~outliers), 0.)
+            kept = values[valid & ~outliers]
+            median = np.median(kept)
+            mad = 1.4826 * np.median(np.abs(kept - median))
+            new = valid & (np.abs(values - median) > n_sigma * mad)
+            if np.array_equal(new, outliers):
+                break
+            outliers = new
+
+        labels, n = ndimage.label(outliers)
+        counts = np.bincount(labels.ravel(), minlength=n + 1)
+        counts[0] = 0
+        deformation = counts[labels] >= cls.MIN_DEFORMATION_PIXELS
+        if not np.any(deformation):
+            return valid & ~outliers
+
+        # Distance to the nearest deformation pixel, against the buffer of the area it belongs to
+        distance, (rows, cols) = ndimage.distance_transform_edt(~deformation, sampling=(dy, dx), return_indices=True)
+        radius = np.sqrt(counts * dx * dy / np.pi)[labels[rows, cols]]
+
+        # A signal spanning the scene leaves too few pixels, the buffer is narrowed until enough remain
+        while True:
+            noise = valid & ~outliers & (distance > buffer * radius)
+            if np.sum(noise) >= cls.MIN_NOISE_FRACTION * np.sum(valid) or buffer < 0.1:
+                return noise
+            buffer /= 2
+
+    @staticmethod
+    def detrend(data, valid):
+        """Data minus the best fitting plane over the valid pixels."""
+        rows, cols = np.nonzero(valid)
+        A = np.column_stack([np.ones(len(rows)), rows, cols])
+        coef = np.linalg.lstsq(A, data[valid], rcond=None)[0]
+
+        r, c = np.mgrid[0:data.shape[0], 0:data.shape[1]]
+        return data - (coef[0] + coef[1] * r + coef[2] * c)
+
+    def _autocovariance(self, noise, valid):
+        """Autocovariance and number of pixel pairs of every lag, zero padded against circular wrapping."""
+        shape = [fft.next_fast_len(2 * n - 1) for n in noise.shape]
+
+        f_noise = fft.rfft2(noise, s=shape)
+        f_valid = fft.rfft2(valid.astype(float), s=shape)
+        products = fft.irfft2(f_noise * np.conj(f_noise), s=shape)
+        pairs = np.round(fft.irfft2(f_valid * np.conj(f_valid), s=shape))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = np.where(pairs >= self.MIN_PAIRS, products / pairs, np.nan)
+
+        return cov, pairs
+
+    def _radial(self, cov, pairs, n_bins, max_lag):
+        """Pair-weighted average of the autocovariance in distance bins."""
+        lag_y = np.fft.fftfreq(cov.shape[0], 1. / cov.shape[0]) * self.dy
+        lag_x = np.fft.fftfreq(cov.shape[1], 1. / cov.shape[1]) * self.dx
+        distance = np.hypot(*np.meshgrid(lag_y, lag_x, indexing='ij'))
+
+        keep = np.isfinite(cov) & (distance > 0) & (distance <= max_lag)
+        edges = np.linspace(0, max_lag, n_bins + 1)
+        idx = np.digitize(distance[keep], edges) - 1
+
+        weights = np.bincount(idx, weights=pairs[keep], minlength=n_bins)[:n_bins]
+        sums = np.bincount(idx, weights=(cov * pairs)[keep], minlength=n_bins)[:n_bins]
+        centers = np.bincount(idx, weights=(distance * pairs)[keep], minlength=n_bins)[:n_bins]
+
+        full = weights > 0
+        return centers[full] / weights[full], sums[full] / weights[full], weights[full]
+
+    def _fit(self):
+        """Sill and range of the exponential model, (0, 0) if the noise is not spatially correlated."""
+        positive = self.empirical > 0
+        if np.sum(positive) < 3:
+            return 0., 0.
+
+        sill0 = min(self.empirical[0], self.variance)
+        below = np.nonzero(self.empirical < sill0 / np.e)[0]
+        range0 = self.distance[below[0]] if len(below) else self.distance[-1] / 3
+
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                (sill, rng), _ = curve_fit(lambda r, s, l: s * np.exp(-r / l), self.distance, self.empirical,
+                                           p0=[sill0, range0], sigma=1 / np.sqrt(self.pairs),
+                                           bounds=([0, min(self.dx, self.dy) / 10], [self.variance, np.inf]))
+        except (RuntimeError, ValueError):
+            return 0., 0.
+
+        return float(sill), float(rng)
+
+    def __call__(self, r):
+        """Modelled covariance at distance r [m], the nugget included at r = 0."""
+        r = np.asarray(r, dtype=float)
+        correlated = self.sill * np.exp(-r / self.range) if self.range > 0 else np.zeros(r.shape)
+        return correlated + np.where(r == 0, self.nugget, 0.)
+
+    def footprint_variance(self, sizes, dx=None, dy=None):
+        """Variance of the mean of the noise over square footprints of size x size pixels.
+        Parameters: sizes    - array-like of int, edge length of the footprint of each point in pixels
+                    dx, dy   - float, pixel spacing of the footprints in [m], default that of the estimate
+        Returns:    variance - np.ndarray, one value per point
+        """
+        dx, dy = abs(dx or self.dx), abs(dy or self.dy)
+        sizes = np.asarray(sizes, dtype=int)
+        variance = np.empty(sizes.shape)
+
+        for k in np.unique(sizes):
+            # Sum of the covariance over all pixel pairs of the footprint, grouped by lag
+            lags = np.arange(-k + 1, k)
+            ly, lx = np.meshgrid(lags, lags, indexing='ij')
+            pairs = (k - np.abs(ly)) * (k - np.abs(lx))
+            correlated = np.sum(pairs * self.sill * np.exp(-np.hypot(ly * dy, lx * dx) / self.range)) if self.range > 0 else 0.
+
+            variance[sizes == k] = self.nugget / k ** 2 + correlated / k ** 4
+
+        return variance
+
+    @property
+    def attrs(self):
+        """Model parameters, as stored with the point dataset."""
+        return {
+            'COV_MODEL': 'exponential',
+            'COV_SILL': self.sill,
+            'COV_RANGE': self.range,
+            'COV_NUGGET': self.nugget,
+        }
@@ -1,24 +1,65 @@
+import warnings
 import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from mintpy.utils import (
     readfile,
     utils as ut,
 )
 from mintpy import subset
-from kite import Scene
-from src.shared.helper_functions import extent2meshgrid, convert_to_utm
+from src.shared.helper_functions import convert_to_utm, block_view
+from src.shared import projection
+from src.downsample.objects.raster import Raster
+from src.downsample.objects.los import LOSRaster
+from src.downsample.objects.geometry_index import GeometryIndex
+from src.downsample.objects.quadtree import Quadtree
+from src.downsample.objects.covariance import Covariance
+from src.downsample.objects.pyramid import Pyramid
+from src.shared import forward
+from src.shared.h5_functions import PointWriter, COLUMNS
 
 
 class Downsample:
-    def __init__(self, velocity_file=None, kite_file=None, geometry_file=None):
+    # Error assigned to the points when no estimate is available
+    DEFAULT_ERR = 0.1
+
+    def __init__(self, velocity_file=None, geometry_file=None, utm_zone=None, geometry_interp='nearest', pyramid=False):
         self.velocity_file = velocity_file
         self.geometry_file = geometry_file
-        self.velocity, self.metadata = readfile.read(self.velocity_file)
-        self.incident_angle = readfile.read(self.geometry_file, datasetName='/incidenceAngle')[0]
-        self.kite_file = kite_file
+        self.geometry_interp = geometry_interp
+        self.use_pyramid = pyramid
+
+        # Only the attributes are read here, rasters are read lazily by window
+        self.metadata = readfile.read_attribute(self.velocity_file)
+
+        # Every point of the scene is projected in the same (possibly forced) UTM zone
+        lon_min, lat_max, lon_max, lat_min = self._geo_box()
+        self.utm_zone = utm_zone or projection.utm_zone((lon_min, lon_max), (lat_min, lat_max))
+        self.velocity_raster = Raster(self.velocity_file, 'velocity')
+        self.los_raster = LOSRaster(self.geometry_file, heading=float(self.metadata['HEADING']))
+        self.geometry_index = GeometryIndex(self.geometry_file, extent=(lon_min, lat_max, lon_max, lat_min))
+        self.covariance = None
+        self._velocity = None
+        self._pyramid = None
 
         print("#" * 50)
         print(f"Loading {self.velocity_file}.\n")
 
+    @property
+    def pyramid(self):
+        """Pooling pyramid of the velocity file, built on first access only."""
+        if self._pyramid is None:
+            self._pyramid = Pyramid(self.velocity_file, self.geometry_file, pixel2geo=self._pixel2geo, los=self._los,
+                                    los_method=self.geometry_interp)
+        return self._pyramid
+
+    @property
+    def velocity(self):
+        """Full velocity raster, read on first access only."""
+        if self._velocity is None:
+            self._velocity = self.velocity_raster.read()
+        return self._velocity
+
     def uniform(self, reduction=3):
         """Downsample the velocity data using a mask and geometry file.
         Parameters: velocity_file - path to the velocity data file
@@ -33,111 +74,440 @@ class Downsample:
         """
         # Skip value every 'skip' step
         skip = reduction
-        # coord = ut.coordinate(metadata)
-        pix_box, geo_box = subset.subset_input_dict2box({"subset_lon": None,
-                                                        "subset_lat": None,
-                                                        "subset_x": None,
-                                                        "subset_y": None}, self.metadata)
         print("#" * 50)
         print(f"Reducing {self.velocity_file} by a factor of {reduction}.\n")
 
-        z = self.velocity[:: skip, ::skip]
-        x, y = extent2meshgrid(extent=geo_box, ds_shape=z.shape)
+        z = self.velocity_raster.read(step=skip)
+        n_rows, n_cols = z.shape
+
+        # Projected grid is shared by every period of the same track geometry
+        geotransform = tuple(float(self.metadata[k]) for k in ['X_FIRST', 'X_STEP', 'Y_FIRST', 'Y_STEP'])
+        x, y = projection.project_grid(geotransform, shape=z.shape, step=skip, zone=self.utm_zone)
 
         z = z.flatten()
         mask = np.isnan(z)
         self.length = len(z[~mask])
 
-        x, y = convert_to_utm(longitude=x, latitude=y)
-
         self.x = x[~mask]
         self.y = y[~mask]
         self.z = z[~mask]
 
+        rows, cols = np.meshgrid(np.arange(n_rows) * skip, np.arange(n_cols) * skip, indexing='ij')
+        lons, lats = self._pixel2geo(rows.flatten()[~mask], cols.flatten()[~mask])
+        self.sizes = np.ones(self.length, dtype=int)
+
+        self._LOS(lons, lats)
 
-        n_rows, n_cols = self.velocity[:: skip, ::skip].shape
-        lon_min, lat_max, lon_max, lat_min = geo_box
-        lats = np.linspace(lat_max, lat_min, n_rows)
-        lons = np.linspace(lon_min, lon_max, n_cols)
-        mesh_lons, mesh_lats = np.meshgrid(lons, lats)
-        self.incident = self._extract_geometry_values(
-            lats=mesh_lats.flatten(),
-            lons=mesh_lons.flatten(),
-            lat_min=lat_min, lat_max=lat_max,
-            lon_min=lon_min, lon_max=lon_max,
-            shape=self.incident_angle.shape
-        )
-        self.incident = self.incident[~mask]
 
+    def quadtree(self, epsilon=0.0029, tile_size_max=0.02, tile_size_min=0.002, nan_allowed=0.9, target_points=None, tolerance=0.05):
+        """Downsample the velocity data with a variance-driven quadtree.
+        Parameters: epsilon       - float, standard deviation threshold for tile splitting
+                    tile_size_max - float, maximum leaf edge length in [deg]
+                    tile_size_min - float, minimum leaf edge length in [deg]
+                    nan_allowed   - float, maximum fraction of NaN pixels per leaf
+                    target_points - int, if given tune epsilon/tile sizes to get this many leaves
+                    tolerance     - float, accepted relative difference from target_points
+        """
+        print("#" * 50)
+        print(f"Reducing {self.velocity_file} with Quadtree.\n")
+
+        qt = Quadtree(self.velocity, pixel_size=abs(float(self.metadata['X_STEP'])))
 
-        self._LOS()
+        if target_points:
+            fit = qt.fit_points(target_points, tolerance=tolerance, epsilon=epsilon, nan_allowed=nan_allowed,
+                                tile_size_min=tile_size_min, tile_size_max=tile_size_max)
+            epsilon, tile_size_min, tile_size_max = fit['epsilon'], fit['tile_size_min'], fit['tile_size_max']
 
+            print(f"Target of {target_points} points: {fit['count']} leaves with epsilon={epsilon:.3g}, "
+                  f"tile_size_min={tile_size_min:.3g}, tile_size_max={tile_size_max:.3g}.\n")
 
-    def quadtree(self, epsilon=0.0029, tile_size_max=0.02, tile_size_min=0.002, nan_allowed=0.9):
-        sc = Scene.load(self.kite_file)
+        rows, cols, sizes, z = qt.leaves(epsilon=epsilon, nan_allowed=nan_allowed,
+                                         tile_size_min=tile_size_min, tile_size_max=tile_size_max)
+        self._points(rows, cols, z, sizes=sizes)
 
+
+    def block(self, reduction=3, statistic='mean'):
+        """Downsample the velocity data by pooling non-overlapping blocks.
+        Parameters: reduction - int, edge length of the blocks in pixels
+                    statistic - str, 'mean' or 'median', NaN-aware pooling of each block
+        The standard deviation of each block is used as the error of the point. With the pyramid enabled,
+        the mean of even factors is served from the pyramid level the factor is a multiple of.
+        """
+        print("#" * 50)
+        print(f"Pooling {self.velocity_file} with the {statistic} of {reduction}x{reduction} blocks.\n")
+
+        if self.use_pyramid and statistic == 'mean' and self.pyramid.level(reduction):
+            self._pyramid_block(reduction)
+            return
+
+        length, width = self.velocity_raster.shape
+        rows, cols, z, err = self._block_tile((0, 0, width, length), reduction, statistic)
+        self._points(rows, cols, z, err=err, sizes=np.full(len(z), reduction))
+
+
+    def _pyramid_block(self, reduction):
+        """Block method served from the pyramid, with the LOS layers of the level when the factor is one."""
+        length, width = self.velocity_raster.shape
+        count, z, std = self.pyramid.pool(reduction)
+
+        r0 = np.arange(z.shape[0]) * reduction
+        c0 = np.arange(z.shape[1]) * reduction
+        rows = (r0 + np.minimum(r0 + reduction, length) - 1) / 2
+        cols = (c0 + np.minimum(c0 + reduction, width) - 1) / 2
+        rows, cols = np.meshgrid(rows, cols, indexing='ij')
+
+        # A single valid pixel has no spread, keep the default error there
+        err = np.where((count > 1) & (std > 0), std, self.DEFAULT_ERR)
+
+        mask = count > 0
+        los = [c[mask] for c in self.pyramid.los(reduction)] if reduction in self.pyramid.levels else None
+        self._points(rows[mask], cols[mask], z[mask], err=err[mask], sizes=np.full(np.sum(mask), reduction), los=los)
+
+
+    def radial(self, source=None, radius=2000., reduction=3, max_factor=48, statistic='mean', spacing=None):
+        """Downsample the velocity data densely near a deformation center and sparser away from it.
+        The scene is covered by blocks of reduction * 2^k pixels. A block is split in four while some of
+        its pixels are closer to the center than where the radial spacing function allows its size, so
+        the selected blocks partition the scene into rings of growing block size.
+        Parameters: source     - tuple of float (lon, lat) of the center, default the largest |velocity| blob
+                    radius     - float, distance [m] at which the spacing is twice that at the center
+                    reduction  - int, edge length of the blocks at the center in pixels
+                    max_factor - int, largest block edge length in pixels
+                    statistic  - str, 'mean' or 'median', NaN-aware pooling of each block
+                    spacing    - callable, block edge length in pixels as a function of the distance
+                                 to the center [m], default reduction * (1 + r / radius)
+        """
+        print("#" * 50)
+        print(f"Reducing {self.velocity_file} radially every {radius:.0f} m from a factor of {reduction}.\n")
+
+        length, width = self.velocity_raster.shape
+        dx, dy = self._pixel_spacing()
+
+        if source is None:
+            center = self._deformation_center(smooth=reduction)
+        else:
+            center = ((source[1] - float(self.metadata['Y_FIRST'])) / float(self.metadata['Y_STEP']) - 0.5,
+                      (source[0] - float(self.metadata['X_FIRST'])) / float(self.metadata['X_STEP']) - 0.5)
+
+        if spacing is None:
+            spacing = lambda r: reduction * (1 + r / radius)
+
+        def needs_split(i, j, size):
+            """True for the blocks (i, j) of edge 'size' with pixels closer than their spacing allows."""
+            r0, c0 = i * size, j * size
+            d_row = np.maximum(np.maximum(r0 - center[0], center[0] - (np.minimum(r0 + size, length) - 1)), 0)
+            d_col = np.maximum(np.maximum(c0 - center[1], center[1] - (np.minimum(c0 + size, width) - 1)), 0)
+            return spacing(np.hypot(d_row * dy, d_col * dx)) < size
+
+        levels = reduction * 2 ** np.arange(int(np.log2(max(max_factor // reduction, 1))) + 1)
+        points = []
+        for size in levels:
+            rows, cols, z, err = self._block_tile((0, 0, width, length), size, statistic)
+            i, j = (rows // size).astype(int), (cols // size).astype(int)
+
+            # Leaves: the parent block was split and the block itself is not
+            keep = needs_split(i // 2, j // 2, 2 * size) if size != levels[-1] else np.ones(len(z), dtype=bool)
+            if size != levels[0]:
+                keep &= ~needs_split(i, j, size)
+
+            points.append((rows[keep], cols[keep], z[keep], err[keep], np.full(np.sum(keep), size)))
+
+        rows, cols, z, err, sizes = [np.concatenate(p) for p in zip(*points)]
+        self._points(rows, cols, z, err=err, sizes=sizes)
+
+
+    def stream(self, out_file, method='uniform', reduction=3, statistic='mean', tile_rows=1024, jobs=1, dtype='float64', metadata=None):
+        """Downsample the scene tile by tile with the uniform or block method, appending the points to out_file.
+        Peak memory is set by tile_rows instead of the scene size. The tiles are aligned on the reduction
+        factor, so the same pixels and blocks are sampled as by uniform()/block().
+        Parameters: out_file  - str, output point dataset (see h5_functions.PointWriter)
+                    method    - str, 'uniform' or 'block'
+                    reduction - int, uniform step or block edge length in pixels
+                    statistic - str, pooling statistic of the block method
+                    tile_rows - int, number of scene rows per tile (rounded to a multiple of reduction)
+                    jobs      - int, number of tiles processed in parallel
+                    dtype     - str, floating point precision of the output
+                    metadata  - dict, attributes of the output
+        Returns:    file_name - str
+        """
         print("#" * 50)
-        print(f"Reducing {self.kite_file} with Quadtree.\n")
+        print(f"Streaming {self.velocity_file} ({method}, factor {reduction}) in tiles of {tile_rows} rows.\n")
+
+        tiles = self.tiles(tile_rows, reduction)
+        args = (self.velocity_file, self.geometry_file, self.utm_zone, self.geometry_interp)
+
+        # Same footprint for every point of the scene
+        if self.covariance is not None:
+            size = reduction if method == 'block' else 1
+            footprint_err = np.sqrt(self.covariance.footprint_variance([size], *self._pixel_spacing())[0])
+
+        def append(x, y, z, err, lose, losn, losz):
+            if self.covariance is not None:
+                err = np.full(len(z), footprint_err)
+            writer.append(x, y, z, err, lose, losn, losz)
+
+        with PointWriter(out_file, dtype=dtype, metadata=metadata) as writer:
+            if jobs > 1:
+                # At most 2 tiles per worker in flight, written back in scene order
+                with ProcessPoolExecutor(max_workers=jobs) as executor:
+                    pending = deque()
+                    for box in tiles:
+                        pending.append(executor.submit(_stream_tile, args, box, method, reduction, statistic))
+                        if len(pending) >= 2 * jobs:
+                            append(*pending.popleft().result())
+
+                    while pending:
+                        append(*pending.popleft().result())
+            else:
+                for box in tiles:
+                    append(*self._tile(box, method, reduction, statistic))
+
+        self.length = writer.count
+        return writer.file_name
+
+
+    def tiles(self, tile_rows=1024, reduction=1):
+        """Windows (x0, y0, x1, y1) of full-width row tiles, starting on multiples of reduction."""
+        length, width = self.velocity_raster.shape
+        tile_rows = max(reduction, tile_rows // reduction * reduction)
+
+        for r0 in range(0, length, tile_rows):
+            yield (0, r0, width, min(r0 + tile_rows, length))
+
+
+    def estimate_covariance(self, n_sigma=3., max_pixels=2 ** 20, buffer=2., mask_file=None):
+        """Estimate the covariance of the noise of the scene (see Covariance).
+        Parameters: n_sigma    - float, pixels farther than n_sigma robust std from the median are deformation
+                    max_pixels - int, the scene is decimated to at most this many pixels for the estimate
+                    buffer     - float, buffer masked around the deformation, in radii of the deformed area
+                    mask_file  - str, HDF5 file in the geometry of the velocity whose 'mask' dataset is
+                                 nonzero on the pixels usable for the estimate
+        Returns:    covariance - Covariance, also kept in self.covariance to weight the points
+        """
+        length, width = self.velocity_raster.shape
+        step = max(1, int(np.ceil(np.sqrt(length * width / max_pixels))))
+        dx, dy = self._pixel_spacing()
+
+        print("#" * 50)
+        print(f"Estimating the noise covariance of {self.velocity_file} (decimation {step}).\n")
+
+        mask = Raster(mask_file, 'mask').read(step=step) != 0 if mask_file else None
+        self.covariance = Covariance(self.velocity_raster.read(step=step), dx * step, dy * step, n_sigma=n_sigma,
+                                     buffer=buffer, mask=mask)
+        print(f"Exponential covariance: sill={self.covariance.sill:.3g}, range={self.covariance.range:.0f} m, "
+              f"nugget={self.covariance.nugget:.3g}.\n")
+
+        return self.covariance
+
+
+    def points(self):
+        """Output points as a point dataset held in memory, dict of the h5_functions.COLUMNS."""
+        return dict(zip(COLUMNS, [np.asarray(c, dtype=float).ravel() for c in
+                                  [self.x, self.y, self.z, self.err, self.lose, self.losn, self.losz]]))
+
+
+    def weight(self):
+        """Set the error of every point to the standard deviation of the noise averaged over its footprint."""
+        if self.covariance is None:
+            self.estimate_covariance()
+
+        self.err = np.sqrt(self.covariance.footprint_variance(self.sizes, *self._pixel_spacing()))
+
+
+    def resolution(self, model='mogi', source=None, depth=3000., threshold=0.01, tile_size_max=0.02, tile_size_min=0.002, nan_allowed=0.9, nu=0.25):
+        """Downsample the velocity data where it best constrains a source model, after Lohman & Simons (2005).
+        Cells start at tile_size_max and are split in four while their diagonal element of the data
+        resolution matrix N = G (G^T G)^-1 G^T exceeds 'threshold', G being the LOS Jacobian of the
+        model parameters at the cell centers. N does not depend on the source strength.
+        Parameters: model         - str, source model with a native forward kernel
+                    source        - tuple of float (lon, lat) of the reference source,
+                                    default the center of the largest |velocity| blob
+                    depth         - float, depth of the reference source [m]
+                    threshold     - float, data resolution above which a cell is split
+                    tile_size_max - float, maximum cell edge length in [deg]
+                    tile_size_min - float, minimum cell edge length in [deg]
+                    nan_allowed   - float, maximum fraction of NaN pixels per cell
+                    nu            - float, Poisson ratio
+        """
+        print("#" * 50)
+        print(f"Reducing {self.velocity_file} by data resolution of a {model} source.\n")
+
+        pixel_size = abs(float(self.metadata['X_STEP']))
+        qt = Quadtree(self.velocity, pixel_size=pixel_size)
+
+        if source is None:
+            source = self._pixel2geo(*self._deformation_center(smooth=max(1, int(round(tile_size_min / pixel_size)))))
+
+        xcen, ycen = convert_to_utm(longitude=np.atleast_1d(source[0]), latitude=np.atleast_1d(source[1]), zone=self.utm_zone)
+        params = dict(forward.REFERENCE_PARAMS[model], xcen=xcen[0], ycen=ycen[0], depth=depth)
 
-        qt = sc.quadtree
+        def criterion(rows, cols, sizes):
+            lons, lats = self._pixel2geo(rows, cols)
 
-        # Parametrisation of the quadtree
-        qt.epsilon = epsilon             # Variance threshold
-        qt.nan_allowed = nan_allowed     # Percentage of NaN values allowed per tile/leave
+            x, y = convert_to_utm(longitude=lons, latitude=lats, zone=self.utm_zone)
 
-        # Be careful here, if you scene is referenced in degree use decimal values!
-        qt.tile_size_max = tile_size_max  # Maximum leave edge length in [m] or [deg]
-        qt.tile_size_min = tile_size_min   # Minimum leave edge length in [m] or [deg]
+            los = self._los(lons, lats)
+            G = forward.jacobian(model, x, y, params, los, nu=nu)
 
-        self.z = qt.leaf_medians
-        self.length = len(qt.leaf_eastings)
+            # diag(N) from the left singular vectors, robust to badly scaled columns
+            U = np.linalg.svd(G, full_matrices=False)[0]
+            return np.sum(U ** 2, axis=1) > threshold
 
-        qt_lons = qt.leaf_coordinates[:, 0] + sc.frame.llLon
-        qt_lats = qt.leaf_coordinates[:, 1] + sc.frame.llLat
+        selection = qt.refine(criterion, nan_allowed=nan_allowed, tile_size_min=tile_size_min, tile_size_max=tile_size_max)
+        rows, cols, sizes, z = qt.values(selection)
+        self._points(rows, cols, z, sizes=sizes)
 
-        self.x, self.y = convert_to_utm(longitude=qt.leaf_coordinates[:, 0] + sc.frame.llLon, latitude=qt.leaf_coordinates[:, 1] + sc.frame.llLat)
 
-        lat_min = qt_lats.min()
-        lat_max = qt_lats.max()
-        lon_min = qt_lons.min()
-        lon_max = qt_lons.max()
+    def _deformation_center(self, smooth=1):
+        """Pixel coordinates (row, col) of the largest |velocity| after block averaging by 'smooth' pixels."""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            pooled = np.nanmean(block_view(np.abs(self.velocity), smooth), axis=(2, 3))
 
-        self.incident = self._extract_geometry_values(
-            lats=qt_lats,
-            lons=qt_lons,
-            lat_min=lat_min, lat_max=lat_max,
-            lon_min=lon_min, lon_max=lon_max,
-            shape=self.incident_angle.shape
-        )
+        r, c = np.unravel_index(np.nanargmax(pooled), pooled.shape)
+        return r * smooth + (smooth - 1) / 2, c * smooth + (smooth - 1) / 2
 
-        self._LOS()
 
+    def _points(self, rows, cols, z, err=None, sizes=None, los=None):
+        """Set the output points from their pixel coordinates, values and footprint edge lengths in pixels.
+        The LOS components are sampled from the geometry unless given."""
+        self.z = z
+        self.length = len(self.z)
+        self.sizes = sizes if sizes is not None else np.ones(self.length, dtype=int)
 
-    def _extract_geometry_values(self, lats, lons, lat_min, lat_max, lon_min, lon_max, shape):
-        """Extract geometry values from regular lat/lon grid at given coordinates."""
-        n_rows, n_cols = shape
-        lat_step = (lat_max - lat_min) / n_rows
-        lon_step = (lon_max - lon_min) / n_cols
+        lons, lats = self._pixel2geo(rows, cols)
+        self.x, self.y = convert_to_utm(longitude=lons, latitude=lats, zone=self.utm_zone)
 
-        row_idx = ((lat_max - lats) / lat_step).astype(int)
-        col_idx = ((lons - lon_min) / lon_step).astype(int)
+        self._LOS(lons, lats, err=err, los=los)
 
-        row_idx = np.clip(row_idx, 0, n_rows - 1)
-        col_idx = np.clip(col_idx, 0, n_cols - 1)
 
-        return self.incident_angle[row_idx, col_idx]
+    def _uniform_tile(self, box, skip):
+        """Pixel coordinates and values of one pixel every 'skip' in a window starting on a multiple of skip."""
+        z = self.velocity_raster.read(box=box, step=skip)
+        rows, cols = np.meshgrid(np.arange(box[1], box[3], skip), np.arange(box[0], box[2], skip), indexing='ij')
 
+        mask = ~np.isnan(z)
+        return rows[mask], cols[mask], z[mask], None
 
-    def _LOS(self):
+
+    def _block_tile(self, box, reduction, statistic):
+        """Pixel coordinates (block centers), pooled values and errors of the blocks of a window."""
+        x0, y0, x1, y1 = box
+        blocks = block_view(self.velocity_raster.read(box=box), reduction)
+        pool = np.nanmedian if statistic == 'median' else np.nanmean
+
+        # All-NaN blocks are expected at the scene borders
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            z = pool(blocks, axis=(2, 3))
+            std = np.nanstd(blocks, axis=(2, 3))
+        count = np.sum(~np.isnan(blocks), axis=(2, 3))
+
+        # Block centers in pixel coordinates, clipped blocks on the last row/column
+        r0 = y0 + np.arange(z.shape[0]) * reduction
+        c0 = x0 + np.arange(z.shape[1]) * reduction
+        rows = (r0 + np.minimum(r0 + reduction, y1) - 1) / 2
+        cols = (c0 + np.minimum(c0 + reduction, x1) - 1) / 2
+        rows, cols = np.meshgrid(rows, cols, indexing='ij')
+
+        # A single valid pixel has no spread, keep the default error there
+        err = np.where((count > 1) & (std > 0), std, self.DEFAULT_ERR)
+
+        mask = count > 0
+        return rows[mask], cols[mask], z[mask], err[mask]
+
+
+    def _tile(self, box, method, reduction, statistic):
+        """Output columns (x, y, z, err, lose, losn, losz) of one tile."""
+        if method == 'block':
+            return self._columns(*self._block_tile(box, reduction, statistic))
+        return self._columns(*self._uniform_tile(box, reduction))
+
+
+    def _columns(self, rows, cols, z, err=None):
+        """Output columns (x, y, z, err, lose, losn, losz) of points given by their pixel coordinates."""
+        lons, lats = self._pixel2geo(rows, cols)
+        x, y = convert_to_utm(longitude=lons, latitude=lats, zone=self.utm_zone)
+        lose, losn, losz = self._los(lons, lats)
+        err = err if err is not None else np.full(len(z), self.DEFAULT_ERR)
+
+        # Points without geometry are dropped, as by _LOS
+        found = np.isfinite(lose) & np.isfinite(losn) & np.isfinite(losz)
+        self._report_dropped(found)
+
+        return tuple(np.asarray(c)[found] for c in [x, y, z, err, lose, losn, losz])
+
+
+    def _pixel2geo(self, rows, cols):
+        """Convert pixel coordinates (center of pixel) into longitude/latitude."""
+        lons = float(self.metadata['X_FIRST']) + (cols + 0.5) * float(self.metadata['X_STEP'])
+        lats = float(self.metadata['Y_FIRST']) + (rows + 0.5) * float(self.metadata['Y_STEP'])
+        return lons, lats
+
+
+    def _pixel_spacing(self):
+        """Pixel spacing (dx, dy) in [m] at the center of the scene."""
+        length, width = self.velocity_raster.shape
+        rows, cols = np.array([length // 2, length // 2, length // 2 + 1]), np.array([width // 2, width // 2 + 1, width // 2])
+        x, y = convert_to_utm(*self._pixel2geo(rows, cols), zone=self.utm_zone)
+
+        return np.hypot(x[1] - x[0], y[1] - y[0]), np.hypot(x[2] - x[0], y[2] - y[0])
+
+
+    def _geo_box(self):
+        """Geographic extent (lon_min, lat_max, lon_max, lat_min) of the velocity file."""
+        pix_box, geo_box = subset.subset_input_dict2box({"subset_lon": None,
+                                                        "subset_lat": None,
+                                                        "subset_x": None,
+                                                        "subset_y": None}, self.metadata)
+        return geo_box
+
+
+    def _geometry_index(self, lons, lats):
+        """Pixel indices (row, col) of the geometry file nearest to the given coordinates and whether
+        there is one, for geocoded as well as radar-coded geometry files."""
+        return self.geometry_index.nearest(lons, lats)
+
+
+    def _los(self, lons, lats):
+        """East, north and up LOS components at the given coordinates, NaN where the geometry has no pixel."""
+        return self.geometry_index.sample(self.los_raster.take, lons, lats, method=self.geometry_interp)
+
+
+    def _report_dropped(self, found):
+        """Report the points left out for lack of geometry, see _LOS."""
+        if not np.all(found):
+            print("#" * 50)
+            print(f"{np.sum(~found)} points without geometry in {self.geometry_file} (outside it or on no-data) dropped.\n")
+
+
+    def _LOS(self, lons, lats, err=None, los=None):
         self.los_az_angle = float(self.metadata['HEADING'])
-        if False:
-            self.incident_angle = float(self.metadata['CENTER_INCIDENCE_ANGLE'])
-        self.incident = np.full(len(self.z), np.nanmean(self.incident_angle))
         self.ref_lat = float(self.metadata['REF_LAT'])
         self.ref_lon = float(self.metadata['REF_LON'])
 
-        self.lose = -np.sin(np.deg2rad(self.incident)) * np.cos(np.deg2rad(self.los_az_angle))
-        self.losn = np.sin(np.deg2rad(self.incident)) * np.sin(np.deg2rad(self.los_az_angle))
-        self.losz = np.cos(np.deg2rad(self.incident))
+        # Per-pixel geometry gathered from the LOS raster of the track
+        self.lose, self.losn, self.losz = los if los is not None else self._los(lons, lats)
+
+        self.err = err if err is not None else np.full(len(self.z), self.DEFAULT_ERR)
+
+        # Points the geometry has no pixel for have no LOS, they are dropped
+        found = np.isfinite(self.lose) & np.isfinite(self.losn) & np.isfinite(self.losz)
+        if not np.all(found):
+            self._report_dropped(found)
+            for name in ['x', 'y', 'z', 'err', 'sizes', 'lose', 'losn', 'losz']:
+                setattr(self, name, np.asarray(getattr(self, name))[found])
+            self.length = len(self.z)
+
+
+# Downsample objects of the tile workers, one per process and input pair
+_workers = {}
+
 
-        self.err = np.full(len(self.z), 0.1)
\ No newline at end of file
+def _stream_tile(args, box, method, reduction, statistic):
+    """Process one tile of Downsample.stream in a worker process."""
+    if args not in _workers:
+        velocity_file, geometry_file, utm_zone, geometry_interp = args
+        _workers[args] = Downsample(velocity_file=velocity_file, geometry_file=geometry_file, utm_zone=utm_zone,
+                                    geometry_interp=geometry_interp)
+    return _workers[args]._tile(box, method, reduction, statistic)
@@ -0,0 +1,204 @@
+import os
+import h5py
+import numpy as np
+from scipy.spatial import cKDTree
+from src.downsample.objects.raster import Raster
+
+# Sidecar written next to the geometry file of each track
+INDEX_FILE = 'geometryIndex.h5'
+QUERY_BATCH = 1_000_000
+
+
+class GeometryIndex:
+    """Map geographic coordinates to pixels of a geometry file.
+
+    Geocoded geometry files are regular lat/lon grids and are indexed from
+    their own X/Y_FIRST and X/Y_STEP. Radar-coded files are indexed through
+    their /latitude and /longitude datasets: a cKDTree over the valid pixels
+    fills an inverse lookup table (regular lat/lon grid -> nearest pixel) that
+    is persisted in INDEX_FILE, so the tree is built once per track and every
+    query is an O(1) gather. Files with neither fall back to a regular grid
+    spanning 'extent'.
+    """
+    def __init__(self, geometry_file, extent=None):
+        """Parameters: geometry_file - str, mintpy geometry file
+                       extent        - tuple of float (lon_min, lat_max, lon_max, lat_min), used only
+                                       when the file has no coordinates of its own
+        """
+        self.geometry_file = geometry_file
+        self.extent = extent
+
+        with h5py.File(geometry_file, 'r') as f:
+            self.attrs = dict(f.attrs)
+            self.shape = f['incidenceAngle'].shape
+            self.radar = 'Y_FIRST' not in self.attrs and 'latitude' in f and 'longitude' in f
+
+        if self.radar:
+            self.file = os.path.join(os.path.dirname(os.path.abspath(geometry_file)), INDEX_FILE)
+            if not self._is_fresh():
+                self._build()
+
+            with h5py.File(self.file, 'r') as f:
+                self.lut_attrs = dict(f.attrs)
+            self.lut = Raster(self.file, 'index')
+            self.latitude = Raster(geometry_file, 'latitude')
+            self.longitude = Raster(geometry_file, 'longitude')
+
+    def _is_fresh(self):
+        if not os.path.exists(self.file):
+            return False
+
+        with h5py.File(self.file, 'r') as f:
+            return f.attrs.get('GEOMETRY_MTIME_NS') == os.stat(self.geometry_file).st_mtime_ns
+
+    def _build(self):
+        print("#" * 50)
+        print(f"Indexing the coordinates of {self.geometry_file}.\n")
+
+        lat = Raster(self.geometry_file, 'latitude').read()
+        lon = Raster(self.geometry_file, 'longitude').read()
+        valid = np.isfinite(lat) & np.isfinite(lon) & ((lat != 0) | (lon != 0))
+        pixels = np.flatnonzero(valid)
+        lat, lon = lat[valid], lon[valid]
+
+        # Scale longitude so that distances are isotropic around the scene
+        scale = np.cos(np.deg2rad(np.mean(lat)))
+        tree = cKDTree(np.column_stack([lon * scale, lat]))
+
+        # Lookup table spacing close to the pixel spacing
+        lat_max, lon_min = lat.max(), lon.min()
+        step = np.sqrt((lat_max - lat.min()) * (lon.max() - lon_min) * scale / len(lat))
+        n_lat = int(np.ceil((lat_max - lat.min()) / step)) + 1
+        n_lon = int(np.ceil((lon.max() - lon_min) * scale / step)) + 1
+
+        tmp_file = f"{self.file}.{os.getpid()}.tmp"
+        with h5py.File(tmp_file, 'w') as f:
+            ds = f.create_dataset('index', shape=(n_lat, n_lon), dtype=np.int32,
+                                  chunks=(min(n_lat, 256), min(n_lon, 256)), compression='lzf')
+
+            rows_per_batch = max(1, QUERY_BATCH // n_lon)
+            lon_grid = lon_min + (np.arange(n_lon) + 0.5) * step / scale
+            for r0 in range(0, n_lat, rows_per_batch):
+                lat_grid = lat_max - (np.arange(r0, min(r0 + rows_per_batch, n_lat)) + 0.5) * step
+                glon, glat = np.meshgrid(lon_grid, lat_grid)
+
+                # Cells farther than two pixels from any valid pixel are outside the scene
+                _, idx = tree.query(np.column_stack([glon.ravel() * scale, glat.ravel()]),
+                                    distance_upper_bound=2 * step, workers=-1)
+                index = np.full(idx.shape, -1, dtype=np.int32)
+                inside = idx < len(pixels)
+                index[inside] = pixels[idx[inside]]
+                ds[r0:r0 + len(lat_grid)] = index.reshape(glat.shape)
+
+            f.attrs.update({
+                'LAT_MAX': lat_max,
+                'LON_MIN': lon_min,
+                'LAT_STEP': step,
+                'LON_STEP': step / scale,
+                'GEOMETRY_FILE': os.path.abspath(self.geometry_file),
+                'GEOMETRY_MTIME_NS': os.stat(self.geometry_file).st_mtime_ns,
+            })
+
+        os.replace(tmp_file, self.file)
+
+    def _regular(self, lons, lats):
+        """Fractional pixel coordinates on a regular lat/lon grid (pixel centers at integers)."""
+        if 'Y_FIRST' in self.attrs:
+            rows = (lats - float(self.attrs['Y_FIRST'])) / float(self.attrs['Y_STEP']) - 0.5
+            cols = (lons - float(self.attrs['X_FIRST'])) / float(self.attrs['X_STEP']) - 0.5
+        else:
+            lon_min, lat_max, lon_max, lat_min = self.extent
+            rows = (lat_max - lats) / ((lat_max - lat_min) / self.shape[0]) - 0.5
+            cols = (lons - lon_min) / ((lon_max - lon_min) / self.shape[1]) - 0.5
+
+        # Beyond the outer half pixel no pixel of the grid is the nearest
+        inside = (rows >= -0.5) & (rows < self.shape[0] - 0.5) & (cols >= -0.5) & (cols < self.shape[1] - 0.5)
+        return np.where(inside, rows, np.nan), np.where(inside, cols, np.nan)
+
+    def _radar(self, lons, lats):
+        """Fractional pixel coordinates on the radar grid: lookup of the nearest
+        pixel, refined by inverting the local lat/lon gradients of the grid."""
+        a = self.lut_attrs
+        n_lat, n_lon = self.lut.shape
+        i = np.clip(((a['LAT_MAX'] - lats) / a['LAT_STEP']).astype(int), 0, n_lat - 1)
+        j = np.clip(((lons - a['LON_MIN']) / a['LON_STEP']).astype(int), 0, n_lon - 1)
+
+        flat = self.lut.take(i, j).astype(int)
+        inside = flat >= 0
+        rows, cols = np.divmod(np.where(inside, flat, 0), self.shape[1])
+
+        # Neighbours along both radar axes, stepping backward on the last row/column
+        dr = np.where(rows < self.shape[0] - 1, 1, -1)
+        dc = np.where(cols < self.shape[1] - 1, 1, -1)
+        lat0, lon0 = self.latitude.take(rows, cols), self.longitude.take(rows, cols)
+        lat_r, lon_r = (self.latitude.take(rows + dr, cols) - lat0) / dr, (self.longitude.take(rows + dr, cols) - lon0) / dr
+        lat_c, lon_c = (self.latitude.take(rows, cols + dc) - lat0) / dc, (self.longitude.take(rows, cols + dc) - lon0) / dc
+
+        # Solve [lat_r lat_c; lon_r lon_c] [d_row d_col] = [d_lat d_lon]
+        det = lat_r * lon_c - lat_c * lon_r
+        with np.errstate(invalid='ignore', divide='ignore'):
+            d_row = (lon_c * (lats - lat0) - lat_c * (lons - lon0)) / det
+            d_col = (lat_r * (lons - lon0) - lon_r * (lats - lat0)) / det
+        # The lookup cell is within about one pixel of the point, larger steps are degenerate gradients
+        ok = np.isfinite(d_row) & np.isfinite(d_col)
+
+        rows_f = np.where(inside, rows + np.where(ok, np.clip(d_row, -2, 2), 0), np.nan)
+        cols_f = np.where(inside, cols + np.where(ok, np.clip(d_col, -2, 2), 0), np.nan)
+
+        return rows_f, cols_f
+
+    def fractional(self, lons, lats):
+        """Fractional pixel coordinates (row, col) of the given coordinates, NaN outside the scene."""
+        lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+        return self._radar(lons, lats) if self.radar else self._regular(lons, lats)
+
+    def nearest(self, lons, lats):
+        """Pixel indices (row, col) of the nearest pixel and whether there is one, False outside
+        the scene and on the holes of the lookup table, where the indices are 0."""
+        rows, cols = self.fractional(lons, lats)
+        found = np.isfinite(rows) & np.isfinite(cols)
+        rows = np.clip(np.round(np.where(found, rows, 0)), 0, self.shape[0] - 1).astype(int)
+        cols = np.clip(np.round(np.where(found, cols, 0)), 0, self.shape[1] - 1).astype(int)
+
+        return rows, cols, found
+
+    def sample(self, take, lons, lats, method='nearest'):
+        """Sample a raster of the geometry grid at the given coordinates, NaN where nearest() finds no pixel.
+        Parameters: take   - callable, take(rows, cols) returning an array or a tuple of arrays
+                    method - str, 'nearest' or 'bilinear'
+        """
+        rows, cols, found = self.nearest(lons, lats)
+        if method == 'nearest':
+            values = take(rows[found], cols[found])
+        else:
+            values = self._bilinear(take, *[np.asarray(c)[found] for c in self.fractional(lons, lats)])
+
+        def expand(v):
+            out = np.full(found.shape, np.nan)
+            out[found] = v
+            return out
+
+        if isinstance(values, tuple):
+            return tuple(expand(v) for v in values)
+        return expand(values)
+
+    def _bilinear(self, take, rows, cols):
+        """Bilinear interpolation of a raster at fractional pixel coordinates within the scene."""
+        rows = np.clip(rows, 0, self.shape[0] - 1)
+        cols = np.clip(cols, 0, self.shape[1] - 1)
+
+        r0 = np.clip(np.floor(rows), 0, max(self.shape[0] - 2, 0)).astype(int)
+        c0 = np.clip(np.floor(cols), 0, max(self.shape[1] - 2, 0)).astype(int)
+        r1 = np.minimum(r0 + 1, self.shape[0] - 1)
+        c1 = np.minimum(c0 + 1, self.shape[1] - 1)
+        wr, wc = rows - r0, cols - c0
+
+        corners = [take(r0, c0), take(r0, c1), take(r1, c0), take(r1, c1)]
+        weights = [(1 - wr) * (1 - wc), (1 - wr) * wc, wr * (1 - wc), wr * wc]
+
+        def interpolate(values):
+            return sum(w * v for w, v in zip(weights, values))
+
+        if isinstance(corners[0], tuple):
+            return tuple(interpolate(v) for v in zip(*corners))
+        return interpolate(corners)
@@ -0,0 +1,82 @@
+import os
+import h5py
+import numpy as np
+from src.downsample.objects.raster import Raster
+
+# Sidecar written next to the geometry file of each track
+LOS_FILE = 'losVector.h5'
+COMPONENTS = ['east', 'north', 'up']
+
+
+class LOSRaster:
+    """Per-pixel ground-to-satellite LOS unit vectors of a track.
+
+    The vectors are computed once from the incidence and azimuth angles of the
+    geometry file and cached in LOS_FILE next to it. The cache is rebuilt when
+    the geometry file changes. Points then gather their vectors by pixel index.
+    """
+    def __init__(self, geometry_file, heading=None):
+        """Parameters: geometry_file - str, mintpy geometry file with /incidenceAngle (and /azimuthAngle)
+                       heading       - float, satellite heading used when /azimuthAngle is missing
+        """
+        self.geometry_file = geometry_file
+        self.file = os.path.join(os.path.dirname(os.path.abspath(geometry_file)), LOS_FILE)
+        self.heading = heading
+
+        if not self._is_fresh():
+            self._build()
+
+        self.components = [Raster(self.file, c) for c in COMPONENTS]
+
+    def _is_fresh(self):
+        if not os.path.exists(self.file):
+            return False
+
+        with h5py.File(self.file, 'r') as f:
+            return f.attrs.get('GEOMETRY_MTIME_NS') == os.stat(self.geometry_file).st_mtime_ns
+
+    def _build(self):
+        print("#" * 50)
+        print(f"Computing LOS vectors of {self.geometry_file}.\n")
+
+        incidence = Raster(self.geometry_file, 'incidenceAngle')
+        with h5py.File(self.geometry_file, 'r') as f:
+            azimuth = Raster(self.geometry_file, 'azimuthAngle') if 'azimuthAngle' in f else None
+
+        if azimuth is None and self.heading is None:
+            raise ValueError(f"No azimuthAngle in {self.geometry_file}, the heading must be given")
+
+        length, width = incidence.shape
+
+        # Unique temporary name, parallel units of the same track may build concurrently
+        tmp_file = f"{self.file}.{os.getpid()}.tmp"
+        with h5py.File(tmp_file, 'w') as f:
+            datasets = [f.create_dataset(c, shape=(length, width), dtype=np.float32) for c in COMPONENTS]
+
+            for r0 in range(0, length, Raster.BATCH_ROWS):
+                box = (0, r0, width, min(r0 + Raster.BATCH_ROWS, length))
+                inc = np.deg2rad(incidence.read(box=box))
+
+                # mintpy convention: azimuth of the ground-to-satellite vector,
+                # anti-clockwise from north, heading = 90 - azimuth
+                if azimuth is not None:
+                    az = np.deg2rad(azimuth.read(box=box))
+                else:
+                    az = np.full(inc.shape, np.deg2rad(90 - self.heading))
+
+                datasets[0][box[1]:box[3]] = -np.sin(inc) * np.sin(az)
+                datasets[1][box[1]:box[3]] = np.sin(inc) * np.cos(az)
+                datasets[2][box[1]:box[3]] = np.cos(inc)
+
+            f.attrs['GEOMETRY_FILE'] = os.path.abspath(self.geometry_file)
+            f.attrs['GEOMETRY_MTIME_NS'] = os.stat(self.geometry_file).st_mtime_ns
+
+        os.replace(tmp_file, self.file)
+
+    @property
+    def shape(self):
+        return self.components[0].shape
+
+    def take(self, rows, cols):
+        """East, north and up LOS components at pixel indices (rows, cols) of the geometry file."""
+        return tuple(c.take(rows, cols).astype(float) for c in self.components)
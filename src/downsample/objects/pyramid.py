@@ -0,0 +1,128 @@
+import os
+import h5py
+import numpy as np
+from src.shared.helper_functions import block_view
+
+# Sidecar written next to the velocity file, e.g. velocity_msk_pyramid.h5
+PYRAMID_SUFFIX = '_pyramid.h5'
+STATS = ['count', 'sum', 'sumsq']
+
+
+class Pyramid:
+    """Multiresolution pooling pyramid of a velocity file.
+
+    Level 'factor' (2, 4, 8, ...) holds, for every factor x factor block, the
+    number of valid pixels and the sum and sum of squares of the velocity
+    centred on the scene mean. Any block factor m * 2^k is then pooled exactly
+    from level 2^k. Every level also stores the latitude and longitude of the
+    block centers and the LOS vectors sampled there. The sidecar is rebuilt
+    when the velocity or geometry file changes.
+    """
+    def __init__(self, velocity_file, geometry_file, pixel2geo, los, los_method='nearest'):
+        """Parameters: velocity_file - str, velocity file with a /velocity dataset
+                       geometry_file - str, geometry file the LOS layers are sampled from
+                       pixel2geo     - callable, (rows, cols) -> (lons, lats) of the velocity grid
+                       los           - callable, (lons, lats) -> (east, north, up) LOS components
+                       los_method    - str, sampling of 'los', the layers are rebuilt when it changes
+        """
+        self.velocity_file = velocity_file
+        self.geometry_file = geometry_file
+        self.los_method = los_method
+        self.file = os.path.splitext(velocity_file)[0] + PYRAMID_SUFFIX
+
+        if not self._is_fresh():
+            self._build(pixel2geo, los)
+
+        with h5py.File(self.file, 'r') as f:
+            self.offset = f.attrs['OFFSET']
+            self.shape = tuple(f.attrs['SHAPE'])
+            self.levels = sorted(int(k) for k in f.keys())
+
+    def _is_fresh(self):
+        if not os.path.exists(self.file):
+            return False
+
+        with h5py.File(self.file, 'r') as f:
+            return (f.attrs.get('VELOCITY_MTIME_NS') == os.stat(self.velocity_file).st_mtime_ns and
+                    f.attrs.get('GEOMETRY_MTIME_NS') == os.stat(self.geometry_file).st_mtime_ns and
+                    f.attrs.get('LOS_METHOD') == self.los_method)
+
+    def _build(self, pixel2geo, los):
+        print("#" * 50)
+        print(f"Building the pyramid of {self.velocity_file}.\n")
+
+        with h5py.File(self.velocity_file, 'r') as f:
+            data = f['velocity'][()]
+
+        length, width = data.shape
+        valid = ~np.isnan(data)
+        offset = np.mean(data[valid]) if valid.any() else 0.
+        centred = np.where(valid, data - offset, 0.)
+        stats = [valid.astype(np.int64), centred, centred ** 2]
+
+        tmp_file = f"{self.file}.{os.getpid()}.tmp"
+        with h5py.File(tmp_file, 'w') as f:
+            factor = 1
+            while min(stats[0].shape) > 1:
+                # Exact 2x2 pooling of the previous level, zero padded at the borders
+                stats = [np.nansum(block_view(s.astype(float), 2), axis=(2, 3)) for s in stats]
+                factor *= 2
+
+                group = f.create_group(str(factor))
+                chunks = (min(stats[0].shape[0], 256), min(stats[0].shape[1], 256))
+                for name, s in zip(STATS, stats):
+                    group.create_dataset(name, data=s.astype(np.int32 if name == 'count' else np.float64), chunks=chunks)
+
+                # Block centers of the level, clipped blocks on the last row/column
+                r0 = np.arange(stats[0].shape[0]) * factor
+                c0 = np.arange(stats[0].shape[1]) * factor
+                rows = (r0 + np.minimum(r0 + factor, length) - 1) / 2
+                cols = (c0 + np.minimum(c0 + factor, width) - 1) / 2
+                lons, lats = pixel2geo(rows, cols)
+                group.create_dataset('latitude', data=lats)
+                group.create_dataset('longitude', data=lons)
+
+                mesh_lons, mesh_lats = np.meshgrid(lons, lats)
+                for name, component in zip(['east', 'north', 'up'], los(mesh_lons.ravel(), mesh_lats.ravel())):
+                    group.create_dataset(name, data=component.reshape(mesh_lons.shape).astype(np.float32), chunks=chunks)
+
+            f.attrs['OFFSET'] = offset
+            f.attrs['SHAPE'] = (length, width)
+            f.attrs['VELOCITY_FILE'] = os.path.abspath(self.velocity_file)
+            f.attrs['VELOCITY_MTIME_NS'] = os.stat(self.velocity_file).st_mtime_ns
+            f.attrs['GEOMETRY_MTIME_NS'] = os.stat(self.geometry_file).st_mtime_ns
+            f.attrs['LOS_METHOD'] = self.los_method
+
+        os.replace(tmp_file, self.file)
+
+    def level(self, factor):
+        """Largest level that 'factor' is a multiple of, None if factor is odd."""
+        levels = [k for k in self.levels if factor % k == 0]
+        return max(levels) if levels else None
+
+    def pool(self, factor):
+        """Count, mean and standard deviation of the velocity in factor x factor blocks.
+        Returns:    count, mean, std - 2D np.ndarray, NaN where a block has no valid pixel
+        """
+        level = self.level(factor)
+        with h5py.File(self.file, 'r') as f:
+            stats = [f[str(level)][name][()].astype(float) for name in STATS]
+
+        m = factor // level
+        if m > 1:
+            stats = [np.nansum(block_view(s, m), axis=(2, 3)) for s in stats]
+
+        count, total, total_sq = stats
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            variance = total_sq / count - mean ** 2
+
+            # Spreads below the rounding level of the sums are taken as constant blocks
+            variance[variance <= 1e-12 * total_sq / count] = 0
+
+        return count, mean + self.offset, np.sqrt(variance)
+
+    def los(self, factor):
+        """East, north and up LOS components at the block centers of a level."""
+        with h5py.File(self.file, 'r') as f:
+            return tuple(f[str(factor)][name][()].astype(float) for name in ['east', 'north', 'up'])
@@ -0,0 +1,237 @@
+import numpy as np
+from src.shared.helper_functions import block_view, summed_area_table
+
+
+class Quadtree:
+    """Variance-driven quadtree of a 2D field, following kite's parametrisation.
+
+    A tile is split in four while its standard deviation exceeds 'epsilon' and
+    it is larger than 'tile_size_min', or while it is larger than
+    'tile_size_max'. Tiles with more than 'nan_allowed' NaN pixels are dropped.
+    The count/mean/std of every tile come from summed-area tables, so each tile
+    costs O(1) whatever its size and a whole level is evaluated at once.
+    """
+    def __init__(self, data, pixel_size):
+        """Parameters: data       - 2D np.ndarray, field to decompose (NaN for no data)
+                       pixel_size - float, pixel edge length in the unit of the tile sizes ([deg] or [m])
+        """
+        self.data = data
+        self.pixel_size = pixel_size
+
+        valid = ~np.isnan(data)
+        # Remove the mean to limit cancellation in the sum of squares
+        offset = np.nanmean(data) if valid.any() else 0.
+        centered = np.where(valid, data - offset, 0.)
+
+        self._sat_n = summed_area_table(valid)
+        self._sat_s = summed_area_table(centered)
+        self._sat_ss = summed_area_table(centered ** 2)
+
+        # Tile size [px] -> (count, std, nan_fraction) for the regular grid of tiles of that size
+        self._stats = {}
+
+    def _tile_limits(self, tile_size_min, tile_size_max):
+        min_px = max(1, int(round(tile_size_min / self.pixel_size)))
+        max_px = max(min_px, int(round(tile_size_max / self.pixel_size)))
+
+        # Tiles are min_px * 2**k pixels wide so that every split is exact
+        base_px = min_px
+        while base_px < max_px:
+            base_px *= 2
+
+        return min_px, max_px, base_px
+
+    def _tile_stats(self, size):
+        """Count, standard deviation and NaN fraction of every size x size tile."""
+        if size not in self._stats:
+            length, width = self.data.shape
+            r0 = np.arange(0, length, size)
+            c0 = np.arange(0, width, size)
+            r1 = np.minimum(r0 + size, length)
+            c1 = np.minimum(c0 + size, width)
+
+            def box(sat):
+                return sat[np.ix_(r1, c1)] - sat[np.ix_(r0, c1)] - sat[np.ix_(r1, c0)] + sat[np.ix_(r0, c0)]
+
+            n = box(self._sat_n)
+            area = (r1 - r0)[:, None] * (c1 - c0)[None, :]
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = box(self._sat_s) / n
+                var = np.maximum(box(self._sat_ss) / n - mean ** 2, 0.)
+
+            self._stats[size] = (n, np.sqrt(var), 1. - n / area)
+
+        return self._stats[size]
+
+    def _select(self, epsilon, nan_allowed, tile_size_min, tile_size_max):
+        """Walk the tree top-down, one level at a time.
+        Returns:    list of (size, row_index, col_index) of the leaves of each level
+        """
+        min_px, max_px, size = self._tile_limits(tile_size_min, tile_size_max)
+        active = np.ones(self._tile_stats(size)[0].shape, dtype=bool)
+        selection = []
+
+        while True:
+            n, std, nan_fraction = self._tile_stats(size)
+
+            split = active & (size > min_px) & ((std > epsilon) | (size > max_px))
+            leaf = active & ~split & (n > 0) & (nan_fraction <= nan_allowed)
+            selection.append((size, *np.nonzero(leaf)))
+
+            if not split.any():
+                return selection
+
+            size //= 2
+            shape = self._tile_stats(size)[0].shape
+            active = np.repeat(np.repeat(split, 2, axis=0), 2, axis=1)[:shape[0], :shape[1]]
+
+    def count(self, epsilon=0.0029, nan_allowed=0.9, tile_size_min=0.002, tile_size_max=0.02):
+        """Number of leaves for a parametrisation, without computing their medians."""
+        selection = self._select(epsilon, nan_allowed, tile_size_min, tile_size_max)
+        return sum(len(r_idx) for _, r_idx, _ in selection)
+
+    def fit_points(self, target, tolerance=0.05, epsilon=0.0029, nan_allowed=0.9, tile_size_min=0.002, tile_size_max=0.02, max_iter=50):
+        """Search the parametrisation whose number of leaves is within 'tolerance' of 'target'.
+        Epsilon is bisected in log space. When the target is out of reach for the
+        given tile sizes, tile_size_min is halved (more leaves) or tile_size_max
+        doubled (fewer leaves) and the search is repeated. Tile statistics are
+        cached per tile size, so no level is ever recomputed between iterations.
+        Parameters: target    - int, wanted number of leaves
+                    tolerance - float, accepted relative difference from target
+                    epsilon, nan_allowed, tile_size_min, tile_size_max - starting parametrisation
+        Returns:    dict with epsilon, tile_size_min, tile_size_max and the resulting number of leaves
+        """
+        def result(eps, n):
+            return dict(epsilon=eps, tile_size_min=tile_size_min, tile_size_max=tile_size_max, count=n)
+
+        def close(n):
+            return abs(n - target) <= tolerance * target
+
+        n = self.count(epsilon, nan_allowed, tile_size_min, tile_size_max)
+        if close(n):
+            return result(epsilon, n)
+
+        while True:
+            n_max = self.count(0., nan_allowed, tile_size_min, tile_size_max)
+            n_min = self.count(np.inf, nan_allowed, tile_size_min, tile_size_max)
+            min_px, _, base_px = self._tile_limits(tile_size_min, tile_size_max)
+
+            if target > n_max and min_px > 1:
+                tile_size_min /= 2
+            elif target < n_min and base_px < max(self.data.shape):
+                tile_size_max *= 2
+            else:
+                break
+
+        if target >= n_max:
+            return result(0., n_max)
+        if target <= n_min:
+            return result(np.inf, n_min)
+
+        # Smallest and largest tile standard deviations bound the useful epsilon range
+        stds = np.concatenate([std[np.isfinite(std)] for _, std, _ in self._stats.values()])
+        lo = np.log(max(stds[stds > 0].min(), np.finfo(float).tiny))
+        hi = np.log(stds.max())
+
+        best = None
+        for _ in range(max_iter):
+            eps = np.exp((lo + hi) / 2)
+            n = self.count(eps, nan_allowed, tile_size_min, tile_size_max)
+
+            if best is None or abs(n - target) < abs(best['count'] - target):
+                best = result(eps, n)
+            if close(n):
+                break
+
+            if n > target:
+                lo = np.log(eps)
+            else:
+                hi = np.log(eps)
+
+        return best
+
+    def refine(self, criterion, nan_allowed=0.9, tile_size_min=0.002, tile_size_max=0.02, max_iter=20):
+        """Iteratively split the leaves flagged by an external criterion.
+        Starts from the coarsest tiling allowed by tile_size_max. At every iteration
+        criterion(rows, cols, sizes) receives the centers and sizes of all the
+        current leaves and returns a boolean mask of the leaves to split.
+        Returns:    list of (size, row_index, col_index) of the final leaves
+        """
+        min_px = self._tile_limits(tile_size_min, tile_size_max)[0]
+        selection = self._select(np.inf, nan_allowed, tile_size_min, tile_size_max)
+
+        for _ in range(max_iter):
+            rows, cols, sizes = self._centers(selection)
+            split = criterion(rows, cols, sizes) & (sizes > min_px)
+            if not split.any():
+                break
+
+            cells = {}
+            start = 0
+            for size, r_idx, c_idx in selection:
+                s = split[start:start + len(r_idx)]
+                start += len(r_idx)
+                cells.setdefault(size, []).append((r_idx[~s], c_idx[~s]))
+
+                if s.any():
+                    half = size // 2
+                    n, _, nan_fraction = self._tile_stats(half)
+
+                    # Four children of every split tile, inside the scene and with enough data
+                    r = (2 * r_idx[s][:, None] + [0, 0, 1, 1]).ravel()
+                    c = (2 * c_idx[s][:, None] + [0, 1, 0, 1]).ravel()
+                    inside = (r < n.shape[0]) & (c < n.shape[1])
+                    r, c = r[inside], c[inside]
+                    keep = (n[r, c] > 0) & (nan_fraction[r, c] <= nan_allowed)
+                    cells.setdefault(half, []).append((r[keep], c[keep]))
+
+            selection = [(size, np.concatenate([r for r, _ in rc]), np.concatenate([c for _, c in rc]))
+                         for size, rc in sorted(cells.items(), reverse=True)]
+
+        return selection
+
+    def _centers(self, selection):
+        """Pixel coordinates of the centers and edge lengths of the selected tiles."""
+        length, width = self.data.shape
+        rows, cols, sizes = [np.empty(0)], [np.empty(0)], [np.empty(0, dtype=int)]
+
+        for size, r_idx, c_idx in selection:
+            r0, c0 = r_idx * size, c_idx * size
+            rows.append((r0 + np.minimum(r0 + size, length) - 1) / 2)
+            cols.append((c0 + np.minimum(c0 + size, width) - 1) / 2)
+            sizes.append(np.full(len(r_idx), size))
+
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(sizes)
+
+    def values(self, selection):
+        """Centers, sizes and medians of the selected tiles.
+        Returns:    rows, cols    - 1D np.ndarray, pixel coordinates of the tile centers
+                    sizes         - 1D np.ndarray, tile edge length in pixels
+                    medians       - 1D np.ndarray, median of the valid pixels of each tile
+        """
+        length, width = self.data.shape
+        base_px = max(size for size, _, _ in selection)
+
+        # Pad once to a multiple of the largest tile, every level is then a view
+        padded = np.pad(self.data.astype(float), ((0, -length % base_px), (0, -width % base_px)), constant_values=np.nan)
+
+        medians = [np.empty(0)]
+        for size, r_idx, c_idx in selection:
+            if not len(r_idx):
+                continue
+
+            blocks = block_view(padded, size)[r_idx, c_idx].reshape(len(r_idx), -1)
+            medians.append(np.nanmedian(blocks, axis=1))
+
+        return *self._centers(selection), np.concatenate(medians)
+
+    def leaves(self, epsilon=0.0029, nan_allowed=0.9, tile_size_min=0.002, tile_size_max=0.02):
+        """Compute the quadtree leaves.
+        Parameters: epsilon       - float, standard deviation threshold for tile splitting
+                    nan_allowed   - float, maximum fraction of NaN pixels in a leaf
+                    tile_size_min - float, minimum leaf edge length in [deg] or [m]
+                    tile_size_max - float, maximum leaf edge length in [deg] or [m]
+        Returns:    rows, cols, sizes, medians of the leaves, see values()
+        """
+        return self.values(self._select(epsilon, nan_allowed, tile_size_min, tile_size_max))
@@ -0,0 +1,60 @@
+import h5py
+import numpy as np
+
+
+class Raster:
+    """Lazy view of a 2D dataset stored in an HDF5 file.
+
+    Nothing is read when the object is created: every access goes through an
+    h5py hyperslab selection, so only the requested window/stride is loaded.
+    """
+    # Number of rows gathered per h5py selection in take()
+    BATCH_ROWS = 1024
+
+    def __init__(self, file, dataset):
+        self.file = file
+        self.dataset = dataset.lstrip('/')
+
+        with h5py.File(self.file, 'r') as f:
+            ds = f[self.dataset]
+            self.shape = ds.shape
+            self.dtype = ds.dtype
+            self.chunks = ds.chunks
+
+    def read(self, box=None, step=1):
+        """Read a (strided) window of the dataset.
+        Parameters: box  - tuple of int (x0, y0, x1, y1) in pixel coordinates, as in mintpy
+                    step - int, keep one pixel every 'step' in both directions
+        Returns:    data - 2D np.ndarray
+        """
+        x0, y0, x1, y1 = box if box else (0, 0, self.shape[1], self.shape[0])
+
+        with h5py.File(self.file, 'r') as f:
+            return f[self.dataset][y0:y1:step, x0:x1:step]
+
+    def take(self, rows, cols):
+        """Gather the values at pixel indices (rows, cols).
+        Only the rows that are actually referenced are read, restricted to the
+        columns window spanned by 'cols'.
+        """
+        rows = np.asarray(rows, dtype=int)
+        cols = np.asarray(cols, dtype=int)
+        out = np.empty(rows.shape, dtype=self.dtype)
+
+        if rows.size == 0:
+            return out
+
+        c0, c1 = int(cols.min()), int(cols.max()) + 1
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        inverse = inverse.reshape(rows.shape)
+
+        with h5py.File(self.file, 'r') as f:
+            ds = f[self.dataset]
+            for i in range(0, len(unique_rows), self.BATCH_ROWS):
+                batch = unique_rows[i:i + self.BATCH_ROWS]
+                block = ds[batch.tolist(), c0:c1]
+
+                sel = (inverse >= i) & (inverse < i + len(batch))
+                out[sel] = block[inverse[sel] - i, cols[sel] - c0]
+
+        return out
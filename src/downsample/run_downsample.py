@@ -2,11 +2,19 @@
 import re
 import os
 import sys
+import json
 import argparse
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import matplotlib.pyplot as plt
-from mintpy.cli.save_kite import main as skite
+from mintpy.utils import readfile
+from mintpy import subset
+from src.shared import cache
+from src.shared.projection import utm_zone
 from src.shared.csv_functions import displacement_csv
+from src.shared.h5_functions import displacement_h5, read_points, export_csv
 from src.downsample.objects.downsample import Downsample
 
 EXAMPLE = """
@@ -14,8 +22,12 @@ EXAMPLE = """
 """
 SCRATCHDIR = os.getenv('SCRATCHDIR')
 
+# Options that do not change the content of the outputs, left out of the cache key
+CACHE_IGNORED = ['folder', 'folder_path', 'satellite', 'period', 'period_folder', 'show', 'jobs', 'keep_going', 'track', 'no_cache', 'cache_hash',
+                 'tile_rows', 'tile_jobs', 'pyramid']
 
-def create_parser():
+
+def create_parser(iargs=None):
     synopsis = 'Plotting of InSAR, GPS and Seismicity data'
     epilog = EXAMPLE
     parser = argparse.ArgumentParser(description=synopsis, epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
@@ -23,16 +35,42 @@ def create_parser():
     # Add arguments
     parser.add_argument('--folder', type=str, required=True, help="Path to the folder.")
     parser.add_argument('--satellite', type=str, nargs='+', default=['Sen'], help="Satellite names.")
-    parser.add_argument('--method', choices=['uniform', 'quadtree'], default='uniform', help="Downsampling method.")
-    parser.add_argument('--downsample-factor', type=int,dest="reduce", default=3, help="Reduce the number of pixels for uniform method(default:  %(default)s).")
+    parser.add_argument('--track', type=str, nargs='+', default=None, help="Only process these tracks of the satellites, e.g. SenAT44 (default: all).")
+    parser.add_argument('--method', choices=['uniform', 'quadtree', 'block', 'resolution', 'radial'], default='uniform', help="Downsampling method.")
+    parser.add_argument('--downsample-factor', type=int,dest="reduce", default=3, help="Reduce the number of pixels for uniform and block methods, block size at the center for radial method (default:  %(default)s).")
+    parser.add_argument('--block-statistic', choices=['mean', 'median'], default='mean', help="Pooling statistic for block and radial methods (default:  %(default)s).")
     parser.add_argument("--epsilon", type=float, default=0.0029, help="Epsilon value for quadtree method (default:  %(default)s)")
     parser.add_argument("--tile-size-max", type=float, default=0.02, help="Maximum tile size for quadtree method (default:  %(default)s)")
     parser.add_argument("--tile-size-min", type=float, default=0.002, help="Minimum tile size for quadtree method (default: %(default)s)")
+    parser.add_argument("--nan-allowed", type=float, default=0.9, help="Maximum fraction of NaN pixels per tile for quadtree method (default: %(default)s)")
+    parser.add_argument("--target-points", type=int, default=None, help="Tune epsilon and tile sizes of the quadtree method to get this number of points.")
+    parser.add_argument("--target-tolerance", type=float, default=0.05, help="Relative tolerance on --target-points (default: %(default)s)")
+    parser.add_argument('--model', choices=['mogi', 'point', 'penny', 'spheroid', 'moment', 'okada'], default='mogi', help="Source model for resolution method (default: %(default)s).")
+    parser.add_argument('--source-center', type=float, nargs=2, metavar=('LON', 'LAT'), default=None, help="Reference source position for resolution and radial methods (default: largest |velocity|).")
+    parser.add_argument('--source-depth', type=float, default=3000., help="Reference source depth [m] for resolution method (default: %(default)s).")
+    parser.add_argument('--resolution-threshold', type=float, default=0.01, help="Data resolution above which a cell is split for resolution method (default: %(default)s).")
+    parser.add_argument('--covariance', action='store_true', help="Estimate the noise covariance of the scene and set the point errors from it.")
+    parser.add_argument('--covariance-sigma', type=float, default=3., help="Pixels farther than this many robust std from the median are masked as deformation (default: %(default)s).")
+    parser.add_argument('--covariance-buffer', type=float, default=2., help="Buffer masked around the deformation for the noise covariance, in radii of the deformed area (default: %(default)s).")
+    parser.add_argument('--covariance-mask', type=str, default=None, help="Name of a mask file of the period or track folder (e.g. maskDeformation.h5), whose 'mask' dataset\nis nonzero on the pixels usable for the noise covariance (default: %(default)s).")
+    parser.add_argument('--radial-radius', type=float, default=2000., help="Distance [m] from the center at which the radial method doubles the block size (default: %(default)s).")
+    parser.add_argument('--radial-max-factor', type=int, default=48, help="Largest block size in pixels for radial method (default: %(default)s).")
+    parser.add_argument('--pyramid', action='store_true', help="Serve even factors of the block method from a pooling pyramid cached next to the velocity file.")
+    parser.add_argument('--geometry-interp', type=str, default='nearest', choices=['nearest', 'bilinear'], help="Sampling of the geometry (LOS) at the points (default: %(default)s).")
+    parser.add_argument('--utm-zone', type=str, default=None, help="UTM zone shared by all tracks, e.g. 33N (default: zone of the center of all tracks).")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of (track, period) units processed in parallel, each logging to <output>.log (default: %(default)s).")
+    parser.add_argument('--keep-going', action='store_true', help="Process the other units when one fails, parallel runs always do, failures still set the exit status.")
+    parser.add_argument('--tile-rows', type=int, default=None, help="Stream the uniform and block methods in tiles of this many rows, bounding memory for full frames (default: whole scene).")
+    parser.add_argument('--tile-jobs', type=int, default=1, help="Number of tiles processed in parallel with --tile-rows (default: %(default)s).")
+    parser.add_argument('--format', choices=['h5', 'csv'], default='h5', help="Output format of the points, CSV is exported on demand by the inversion (default: %(default)s).")
+    parser.add_argument('--dtype', choices=['float32', 'float64'], default='float64', help="Floating point precision of the h5 output (default: %(default)s).")
+    parser.add_argument('--no-cache', action='store_true', help="Recompute every unit even if its inputs and parameters did not change.")
+    parser.add_argument('--cache-hash', choices=['mtime', 'content'], default='mtime', help="Identify input files by size and mtime or by content hash (default: %(default)s).")
     parser.add_argument('--show', action='store_true', help="Show the plot.")
     parser.add_argument('--period', nargs='*', metavar='YYYYMMDD:YYYYMMDD, YYYYMMDD,YYYYMMDD', type=str, help='Period of the search')
 
     # Parse arguments
-    inps = parser.parse_args()
+    inps = parser.parse_args(iargs)
 
     inps.folder_path = inps.folder if SCRATCHDIR in inps.folder else os.path.join(SCRATCHDIR, inps.folder)
 
@@ -54,42 +92,161 @@ def create_parser():
     return inps
 
 
-def process_folder(input_folder, period_folder, node, out_file, inps):
+def cache_params(inps):
+    """Options of inps that change the content of the points, part of the cache key."""
+    return {k: v for k, v in sorted(vars(inps).items()) if k not in CACHE_IGNORED}
+
+
+def input_files(input_folder, period_folder):
     # Velocity file is in the period folder
     velocity_file = [os.path.join(period_folder, f) for f in os.listdir(period_folder) if 'velocity_msk.h5' in f]
 
     # Other files are in the parent folder
-    mask_file = [os.path.join(input_folder, f) for f in os.listdir(input_folder) if 'maskTempCoh.h5' in f]
     geom_file = [os.path.join(input_folder, f) for f in os.listdir(input_folder) if 'geometryRadar.h5' in f]
 
-    kite_args = [velocity_file[0], "-d", "velocity", "-g", geom_file[0], "-o", out_file]
+    return velocity_file, geom_file
+
+
+def covariance_mask_file(input_folder, period_folder, name):
+    """Mask file 'name' of the noise covariance, looked up in the period folder and then in the track folder."""
+    if not name:
+        return []
+
+    files = [os.path.join(folder, name) for folder in [period_folder, input_folder]]
+    files = [f for f in files if os.path.exists(f)]
+    if not files:
+        raise FileNotFoundError(f"Covariance mask {name} not found in {period_folder} or {input_folder}")
+
+    return files[:1]
+
 
+def shared_utm_zone(units):
+    """UTM zone of the center of all the velocity files, so that every track is projected alike."""
+    lons, lats = [], []
+    for input_folder, period_folder, _, _ in units:
+        velocity_file = input_files(input_folder, period_folder)[0]
+        if not velocity_file:
+            continue
+
+        geo_box = subset.subset_input_dict2box({"subset_lon": None,
+                                                "subset_lat": None,
+                                                "subset_x": None,
+                                                "subset_y": None}, readfile.read_attribute(velocity_file[0]))[1]
+        lons += [geo_box[0], geo_box[2]]
+        lats += [geo_box[1], geo_box[3]]
+
+    return utm_zone(lons, lats) if lons else None
+
+
+def open_unit(velocity_file, geom_file, inps, mask_file=None):
+    """Downsample object of one (track, period) unit and the attributes of its point dataset,
+    with the noise covariance estimated if requested, see covariance_mask_file for mask_file."""
+    down = Downsample(velocity_file=velocity_file, geometry_file=geom_file, utm_zone=inps.utm_zone,
+                      geometry_interp=inps.geometry_interp, pyramid=inps.pyramid)
+    metadata = {'METHOD': inps.method, 'VELOCITY_FILE': down.velocity_file, 'UTM_ZONE': down.utm_zone}
+
+    if inps.covariance:
+        metadata.update(down.estimate_covariance(n_sigma=inps.covariance_sigma, buffer=getattr(inps, 'covariance_buffer', 2.),
+                                                 mask_file=mask_file).attrs)
+
+    return down, metadata
+
+
+def downsample(down, inps):
+    """Set the points of 'down' with the method of inps, in memory (see Downsample.points)."""
     if inps.method == 'uniform':
-        down = Downsample(velocity_file=velocity_file[0], geometry_file=geom_file[0])
         down.uniform(reduction=inps.reduce)
 
     elif inps.method == 'quadtree':
-        skite(kite_args)
-        down = Downsample(velocity_file=velocity_file[0], kite_file=out_file + '.yml', geometry_file=geom_file[0])
-        down.quadtree(epsilon=inps.epsilon, tile_size_max=inps.tile_size_max, tile_size_min=inps.tile_size_min)
+        down.quadtree(epsilon=inps.epsilon, tile_size_max=inps.tile_size_max, tile_size_min=inps.tile_size_min, nan_allowed=inps.nan_allowed,
+                      target_points=inps.target_points, tolerance=inps.target_tolerance)
 
-    # Save the downsampled data
-    displacement_csv(file=out_file, x=down.x, y=down.y, z=down.z, err=down.err, lose=down.lose, losn=down.losn, losz=down.losz)
+    elif inps.method == 'block':
+        down.block(reduction=inps.reduce, statistic=inps.block_statistic)
 
-    if inps.show:
-        fig, ax = plt.subplots()
-        ax.scatter(down.x, down.y, c=down.z, s=1)
-        plt.show()
+    elif inps.method == 'resolution':
+        down.resolution(model=inps.model, source=inps.source_center, depth=inps.source_depth, threshold=inps.resolution_threshold,
+                        tile_size_max=inps.tile_size_max, tile_size_min=inps.tile_size_min, nan_allowed=inps.nan_allowed)
 
+    elif inps.method == 'radial':
+        down.radial(source=inps.source_center, radius=inps.radial_radius, reduction=inps.reduce,
+                    max_factor=inps.radial_max_factor, statistic=inps.block_statistic)
 
-def main(iargs=None):
-    print("#" * 50)
-    print("Starting Decomposition Module...")
-    print("#" * 50)
-    print()
+    # Errors from the noise covariance averaged over the footprint of each point
+    if inps.covariance:
+        down.weight()
 
-    inps = create_parser() if not isinstance(iargs, argparse.Namespace) else iargs
+    return down
+
+
+def save_points(down, out_file, inps, metadata):
+    """Write the points of 'down' in inps.format.
+    Returns:    list of str, written files
+    """
+    if inps.format == 'csv':
+        outputs = [displacement_csv(file=out_file, x=down.x, y=down.y, z=down.z, err=down.err, lose=down.lose, losn=down.losn, losz=down.losz)]
+    else:
+        outputs = [displacement_h5(file=out_file, x=down.x, y=down.y, z=down.z, err=down.err, lose=down.lose, losn=down.losn, losz=down.losz,
+                                   dtype=inps.dtype, metadata=metadata)]
+
+    # The CSV layout has no attributes, the covariance model goes to a sidecar
+    if inps.covariance and inps.format == 'csv':
+        outputs.append(out_file + '.covariance.json')
+        with open(outputs[-1], 'w') as f:
+            json.dump(down.covariance.attrs, f, indent=2)
+
+    return outputs
+
+
+def process_folder(input_folder, period_folder, node, out_file, inps):
+    velocity_file, geom_file = input_files(input_folder, period_folder)
+    mask_file = covariance_mask_file(input_folder, period_folder, inps.covariance_mask) if inps.covariance else []
+
+    # Skip the unit if it was already computed from the same inputs and parameters
+    params = cache_params(inps)
+    key = cache.unit_key([velocity_file[0], geom_file[0]] + mask_file, params, content=getattr(inps, 'cache_hash', 'mtime') == 'content')
+
+    if not getattr(inps, 'no_cache', False) and cache.is_fresh(out_file, key):
+        print("#" * 50)
+        print(f"{out_file} is up to date, skipping.\n")
+        return
+
+    down, metadata = open_unit(velocity_file[0], geom_file[0], inps, mask_file=(mask_file or [None])[0])
+
+    if inps.tile_rows and inps.method in ['uniform', 'block']:
+        file_name = down.stream(out_file, method=inps.method, reduction=inps.reduce, statistic=inps.block_statistic,
+                                tile_rows=inps.tile_rows, jobs=inps.tile_jobs, dtype=inps.dtype, metadata=metadata)
 
+        # The CSV is exported from the streamed dataset, the covariance model goes to a sidecar
+        outputs = [file_name]
+        if inps.format == 'csv':
+            outputs = [export_csv(file_name)]
+            if inps.covariance:
+                outputs.append(out_file + '.covariance.json')
+                with open(outputs[-1], 'w') as f:
+                    json.dump(down.covariance.attrs, f, indent=2)
+
+        if inps.show:
+            points = read_points(outputs[0], columns=['xx', 'yy', 'dd'])
+            fig, ax = plt.subplots()
+            ax.scatter(points['xx'], points['yy'], c=points['dd'], s=1)
+            plt.show()
+
+    else:
+        downsample(down, inps)
+        outputs = save_points(down, out_file, inps, metadata)
+
+        if inps.show:
+            fig, ax = plt.subplots()
+            ax.scatter(down.x, down.y, c=down.z, s=1)
+            plt.show()
+
+    cache.record(out_file, key, outputs=outputs, params=params)
+
+
+def find_units(inps):
+    """(track, period) units of the folder, (input_folder, period_folder, node, out_file) for every track
+    matching inps.satellite and every period of inps.period_folder, or the track folder without periods."""
     if inps.satellite:
         p = '|'.join([f"{s}[AD]T?" for s in inps.satellite])
 
@@ -97,11 +254,12 @@ def main(iargs=None):
     regex = re.compile(pattern)
     folder_list = [f for f in os.listdir(inps.folder_path) if os.path.isdir(os.path.join(inps.folder_path, f))]
 
+    units = []
     for folder in folder_list:
         # Search for the keyword in the path
         match = regex.match(folder)
 
-        if match:
+        if match and (not getattr(inps, 'track', None) or match.group(0) in inps.track):
             node = match.group(0)
             input_folder = os.path.join(inps.folder_path, node)
 
@@ -114,12 +272,95 @@ def main(iargs=None):
                         continue
 
                     out_file = os.path.join(period_folder, inps.folder + node)
-                    process_folder(input_folder, period_folder, node, out_file, inps)
+                    units.append((input_folder, period_folder, node, out_file))
             else:
                 # Process the main folder as usual
                 out_file = os.path.join(input_folder, inps.folder + node)
-                process_folder(input_folder, input_folder, node, out_file, inps)
+                units.append((input_folder, input_folder, node, out_file))
+
+    return units
+
+
+def run_unit(unit, inps, log=False):
+    """Process one (track, period) unit without letting its failure stop the others.
+    Returns:    out_file - str, output of the unit
+                error    - str, traceback of the failure or None
+    """
+    out_file = unit[-1]
+
+    try:
+        if log:
+            with open(out_file + '.log', 'w') as f, redirect_stdout(f), redirect_stderr(f):
+                process_folder(*unit, inps)
+        else:
+            process_folder(*unit, inps)
+
+    except Exception:
+        error = traceback.format_exc()
+        if log:
+            with open(out_file + '.log', 'a') as f:
+                f.write(error)
+        else:
+            print(error)
+
+        return out_file, error
+
+    return out_file, None
+
+
+def main(iargs=None):
+    print("#" * 50)
+    print("Starting Decomposition Module...")
+    print("#" * 50)
+    print()
+
+    inps = create_parser() if not isinstance(iargs, argparse.Namespace) else iargs
+    units = find_units(inps)
+
+    if not getattr(inps, 'utm_zone', None):
+        inps.utm_zone = shared_utm_zone(units)
+
+    print(f"Projecting all tracks in UTM zone {inps.utm_zone}.\n")
+
+    jobs = getattr(inps, 'jobs', 1)
+    failures = []
+
+    if jobs > 1:
+        if inps.show:
+            print("Plots are not shown when running in parallel.\n")
+            inps.show = False
+
+        print(f"Processing {len(units)} units with {jobs} jobs, logs in <output>.log.\n")
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(run_unit, unit, inps, True) for unit in units]
+
+            for i, future in enumerate(as_completed(futures), start=1):
+                out_file, error = future.result()
+                print(f"[{i}/{len(units)}] {'FAILED' if error else 'done'}: {out_file}")
+                if error:
+                    failures.append((out_file, error))
+    elif getattr(inps, 'keep_going', False):
+        for unit in units:
+            out_file, error = run_unit(unit, inps)
+            if error:
+                failures.append((out_file, error))
+    else:
+        # The first failure stops the run with its exception
+        for unit in units:
+            process_folder(*unit, inps)
+
+    if failures:
+        print("#" * 50)
+        print(f"{len(failures)} of {len(units)} units failed:")
+        for out_file, error in failures:
+            print(f"  {out_file}: {error.strip().splitlines()[-1]}")
+        print("#" * 50)
+
+        return 1
+
+    return 0
 
 
 if __name__ == '__main__':
-    main(iargs=sys.argv)
+    sys.exit(main(iargs=sys.argv))
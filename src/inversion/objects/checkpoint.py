@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import signal
+from contextlib import contextmanager
+import numpy as np
+
+
+class Checkpoint:
+    """Periodic snapshots of a native sampler, so that a killed run resumes where it stopped.
+
+    A snapshot holds the STATE attributes of the sampler and the state of its
+    random generator, written to a temporary file and renamed over the
+    previous one. It is tagged with the key of the run (see cache.unit_key) and
+    only restored into a run with the same key. On SIGTERM, which batch
+    schedulers send before the walltime kill, a snapshot is written after the
+    current iteration and the run exits, as long as the run is wrapped in
+    sigterm(). A run in a worker process can also be stopped through a
+    shared event set by the parent on its SIGTERM.
+    """
+    def __init__(self, file, key, interval=600., event=None):
+        """Parameters: file     - str, .npz snapshot file
+                       key      - str, key of the run the snapshot belongs to
+                       interval - float, seconds between two snapshots
+                       event    - multiprocessing.Event, terminate as on SIGTERM once set
+        """
+        self.file = file
+        self.key = key
+        self.interval = interval
+        self.event = event
+        self.last = time.monotonic()
+        self.terminate = False
+
+    def _on_sigterm(self, signum, frame):
+        self.terminate = True
+
+    @contextmanager
+    def sigterm(self):
+        """Defer SIGTERM to the next callback of the run within the block, the previous handler restored after it."""
+        try:
+            previous = signal.signal(signal.SIGTERM, self._on_sigterm)
+        except ValueError:
+            # Not the main thread, the run is only saved periodically
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+
+        # Received after the last callback, the run is complete and the signal goes to the previous handler
+        if self.terminate:
+            signal.raise_signal(signal.SIGTERM)
+
+    def load(self, sampler):
+        """Restore 'sampler' from the snapshot of the same run, if any.
+        Returns:    bool, True if the sampler was restored
+        """
+        if not os.path.exists(self.file):
+            return False
+
+        with np.load(self.file, allow_pickle=False) as f:
+            if str(f['key']) != self.key or str(f['sampler']) != type(sampler).__name__:
+                return False
+
+            for name in sampler.STATE:
+                value = f[name]
+                setattr(sampler, name, value.item() if value.ndim == 0 else value.copy())
+            sampler.rng.bit_generator.state = json.loads(str(f['rng']))
+
+        print("#" * 50)
+        print(f"Resuming from {self.file} at iteration {sampler.iteration}.\n")
+        return True
+
+    def save(self, sampler):
+        # Keep the .npz extension, np.savez would append it to the temporary name
+        tmp_file = f"{self.file[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_file, key=self.key, sampler=type(sampler).__name__,
+                 rng=json.dumps(sampler.rng.bit_generator.state),
+                 **{name: getattr(sampler, name) for name in sampler.STATE})
+        os.replace(tmp_file, self.file)
+        self.last = time.monotonic()
+
+    def __call__(self, sampler):
+        """Callback of the sampler runs, saves once the interval elapsed or on termination."""
+        if self.terminate or (self.event is not None and self.event.is_set()):
+            self.save(sampler)
+            print("#" * 50)
+            print(f"Terminated, state saved to {self.file}.\n")
+            raise SystemExit(1)
+
+        if time.monotonic() - self.last >= self.interval:
+            self.save(sampler)
+
+    def remove(self):
+        if os.path.exists(self.file):
+            os.remove(self.file)
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+def split_rhat(chains):
+    """Split potential scale reduction factor R-hat, Gelman et al. (2013).
+    Parameters: chains - np.ndarray (n_steps, n_chains, dim)
+    Returns:    rhat   - np.ndarray (dim,), 1 for parameters that do not vary
+    """
+    n = chains.shape[0] // 2
+    if n < 2:
+        return np.full(chains.shape[2], np.inf)
+
+    # Each chain cut in two, so that a drifting chain shows as two disagreeing ones
+    halves = np.concatenate([chains[:n], chains[n:2 * n]], axis=1)
+    W = halves.var(axis=0, ddof=1).mean(axis=0)
+    B = n * halves.mean(axis=0).var(axis=0, ddof=1)
+    var_plus = (n - 1) / n * W + B / n
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rhat = np.sqrt(var_plus / W)
+    return np.where(W > 0, rhat, 1.)
+
+
+def effective_sample_size(chains):
+    """Effective sample size of every parameter, with Geyer's initial monotone sequence.
+    Parameters: chains - np.ndarray (n_steps, n_chains, dim)
+    Returns:    ess    - np.ndarray (dim,), n_steps * n_chains for parameters that do not vary
+    """
+    n, m, dim = chains.shape
+    if n < 4:
+        return np.zeros(dim)
+
+    # Autocovariance of every chain by FFT, zero padded against wrapping
+    x = chains - chains.mean(axis=0)
+    f = np.fft.rfft(x, n=2 * n, axis=0)
+    acov = np.fft.irfft(f * np.conj(f), axis=0)[:n] / n
+
+    W = chains.var(axis=0, ddof=1).mean(axis=0)
+    var_plus = ((n - 1) / n * W + chains.mean(axis=0).var(axis=0, ddof=1)) if m > 1 else W
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rho = 1 - (W - acov.mean(axis=1)) / var_plus
+
+    # Sums of consecutive pairs, cut at the first negative one and made monotone
+    pairs = rho[:n // 2 * 2].reshape(n // 2, 2, dim).sum(axis=1)
+    positive = np.cumprod(pairs > 0, axis=0).astype(bool)
+    pairs = np.minimum.accumulate(np.where(positive, pairs, 0.), axis=0)
+    tau = np.maximum(-1 + 2 * pairs.sum(axis=0), 1 / np.log10(max(n * m, 10)))
+
+    return np.where(W > 0, n * m / tau, n * m)
+
+
+def plateau(history, tol, patience):
+    """True if the last 'patience' iterations improved the best misfit by less than 'tol' relative."""
+    history = np.asarray(history, dtype=float)
+    if len(history) <= patience:
+        return False
+
+    before, now = history[-patience - 1], history[-1]
+    return before - now <= tol * max(abs(before), 1e-300)
@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+import numpy as np
+from src.shared import forward
+
+# Bump when the layout or the content of the tables changes
+GREENS_VERSION = 1
+
+# Number of (node, point) values computed at once while building a table
+BUILD_BATCH = 2 ** 22
+
+
+def point_set_key(x, y, los):
+    """sha256 of the coordinates and LOS vectors of a point set, the displacements left out."""
+    sha = hashlib.sha256()
+    for column in [x, y, *los]:
+        sha.update(np.ascontiguousarray(column, dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+
+def cacheable(model, ranges, linear):
+    """True if the unit responses of a source depend on its position only,
+    every parameter other than the position and 'linear' having a single value."""
+    shape = [p for p in forward.param_names(model) if p not in forward.POSITION_PARAMS and p not in linear]
+    return all(ranges.get(p) is not None and min(ranges[p]) == max(ranges[p]) for p in shape)
+
+
+class GreensTable:
+    """Unit responses of a source on a grid of candidate positions, for one point set.
+
+    For every (xcen, ycen, depth) node of a regular grid over the position
+    ranges, the table holds the LOS displacement of every point for a unit
+    value of each linear parameter, the other parameters fixed. A response
+    anywhere in the grid is then a trilinear interpolation of the 8 nodes
+    around it, and the displacement of a source its linear combination with
+    the linear parameters. The table is stored as a memory-mapped .npy file
+    named after the hash of the point set and of the settings, so that every
+    period of the same tracks reuses it.
+    """
+    def __init__(self, folder, x, y, los, model, linear, fixed, bounds, shape=(41, 41, 21), nu=0.25):
+        """Parameters: folder - str, directory of the tables
+                       x, y   - np.ndarray, point coordinates [m]
+                       los    - tuple of np.ndarray, LOS unit vectors (lx, ly, lz) of the points
+                       model  - str, key of forward.MODELS
+                       linear - list of str, parameters of the responses, each set to 1 in turn
+                       fixed  - dict, value of the other non-position parameters of the model
+                       bounds - list of (min, max) of xcen, ycen and depth
+                       shape  - tuple of int, number of nodes along xcen, ycen and depth
+                       nu     - float, Poisson ratio
+        """
+        self.model = model
+        self.linear = list(linear)
+        self.fixed = dict(fixed)
+
+        # A source at the surface is singular below the points, the depth axis starts just below it
+        (x0, x1), (y0, y1), (z0, z1) = [(min(b), max(b)) for b in bounds]
+        z0 = max(z0, 0.01 * (z1 - z0))
+        self.axes = [np.linspace(lo, hi, n) for (lo, hi), n in zip([(x0, x1), (y0, y1), (z0, z1)], shape)]
+
+        settings = {
+            'version': GREENS_VERSION,
+            'points': point_set_key(x, y, los),
+            'model': model,
+            'linear': self.linear,
+            'fixed': self.fixed,
+            'axes': [[float(a[0]), float(a[-1]), len(a)] for a in self.axes],
+            'nu': nu,
+        }
+        key = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+        self.file = os.path.join(folder, f"greens_{model}_{key[:16]}.npy")
+
+        if not os.path.exists(self.file):
+            os.makedirs(folder, exist_ok=True)
+            self._build(x, y, los, nu)
+
+        # Layout (n_linear, nx, ny, nz, n_points)
+        self.table = np.load(self.file, mmap_mode='r')
+
+    def _build(self, x, y, los, nu):
+        print("#" * 50)
+        print(f"Building the Green's function table {self.file}.\n")
+
+        xc, yc, zc = [a.ravel() for a in np.meshgrid(*self.axes, indexing='ij')]
+        n_nodes = len(xc)
+        step = max(1, BUILD_BATCH // len(x))
+
+        # Unique temporary name, concurrent inversions may build the same table
+        tmp_file = f"{self.file}.{os.getpid()}.tmp.npy"
+        table = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                          shape=(len(self.linear),) + tuple(len(a) for a in self.axes) + (len(x),))
+        flat = table.reshape(len(self.linear), n_nodes, len(x))
+
+        for k, name in enumerate(self.linear):
+            for s0 in range(0, n_nodes, step):
+                s = slice(s0, s0 + step)
+                n = len(xc[s])
+                params = {p: np.full(n, v, dtype=float) for p, v in self.fixed.items()}
+                params.update({p: np.zeros(n) for p in self.linear})
+                params.update(xcen=xc[s], ycen=yc[s], depth=zc[s])
+                params[name] = np.ones(n)
+                flat[k, s] = forward.batch(self.model, x, y, params, los=los, nu=nu)
+
+        table.flush()
+        del table, flat
+        os.replace(tmp_file, self.file)
+
+    @staticmethod
+    def nbytes(shape, n_points, n_linear):
+        """Size in bytes of a table of 'shape' nodes for n_points points and n_linear responses."""
+        return int(np.prod(shape)) * n_points * n_linear * np.dtype(np.float32).itemsize
+
+    def interpolation_error(self, x, y, los, nu=0.25, n=64, seed=0):
+        """Difference between the interpolated and the direct unit responses at the centres of 'n' random
+        cells of the grid, where trilinear interpolation is the least accurate, spread evenly over the depth layers.
+        Parameters: x, y, los - np.ndarray, points of the table, see __init__
+        Returns:    depth     - np.ndarray (n,), depth of each cell centre
+                    error     - np.ndarray (n,), largest difference over the largest direct response of each
+        """
+        rng = np.random.default_rng(seed)
+        nx, ny, nz = [len(a) - 1 for a in self.axes]
+        cells = [rng.integers(0, nx, n), rng.integers(0, ny, n), np.arange(n) % nz]
+        xcen, ycen, depth = [(axis[i] + axis[i + 1]) / 2 for axis, i in zip(self.axes, cells)]
+
+        params = {p: np.full(n, v, dtype=float) for p, v in self.fixed.items()}
+        params.update(xcen=xcen, ycen=ycen, depth=depth)
+
+        error = np.zeros(n)
+        for name in self.linear:
+            unit = dict(params, **{p: np.zeros(n) for p in self.linear})
+            unit[name] = np.ones(n)
+            direct = forward.batch(self.model, x, y, unit, los=los, nu=nu)
+            table = self.response(name, xcen, ycen, depth)
+            peak = np.maximum(np.max(np.abs(direct), axis=1), 1e-300)
+            error = np.maximum(error, np.max(np.abs(table - direct), axis=1) / peak)
+
+        return depth, error
+
+    def response(self, name, xcen, ycen, depth):
+        """Interpolated unit response of the linear parameter 'name' for sources at the given positions.
+        Returns:    np.ndarray (n_sources, n_points)
+        """
+        table = self.table[self.linear.index(name)]
+
+        # Lower node and fractional position along each axis, positions outside the grid are clamped
+        index, frac = [], []
+        for axis, value in zip(self.axes, [xcen, ycen, depth]):
+            value = np.clip(np.asarray(value, dtype=float), axis[0], axis[-1])
+            i = np.clip(np.searchsorted(axis, value, side='right') - 1, 0, len(axis) - 2)
+            index.append(i)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                frac.append(np.nan_to_num((value - axis[i]) / (axis[i + 1] - axis[i])))
+
+        out = np.zeros((len(index[0]), table.shape[-1]))
+        for corner in np.ndindex(2, 2, 2):
+            weight = np.prod([f if c else 1 - f for f, c in zip(frac, corner)], axis=0)
+            out += weight[:, None] * table[index[0] + corner[0], index[1] + corner[1], index[2] + corner[2]]
+
+        return out
@@ -0,0 +1,189 @@
+import numpy as np
+from src.inversion.objects.samplers import seed_population
+
+
+class MultistartOptimizer:
+    """Multistart L-BFGS-B, all starts advanced together.
+
+    Every start runs a projected limited-memory BFGS descent in the unit box
+    of the problem with a backtracking Armijo line search, the L-BFGS-B
+    scheme without the Cauchy point search. The gradients come from central
+    differences, one-sided at the bounds. Every function and gradient
+    evaluation of all the active starts is a single batched Problem.solve.
+    """
+    # Attributes that, with the random generator, resume a run (see Checkpoint)
+    STATE = ['iteration', 'evaluations', 'unit', 'misfits', 'params', 'gradient', 'active', 's', 'y', 'filled']
+
+    def __init__(self, problem, n_starts=32, max_iter=200, memory=10, f_tol=1e-9, g_tol=1e-6, step=1e-6, init=None, seed=None):
+        """Parameters: problem  - Problem, with solve() and the bounds of the sampled parameters
+                       n_starts - int, number of starting points, drawn uniformly in the box
+                       max_iter - int, iterations of every start
+                       memory   - int, number of correction pairs of the L-BFGS approximation
+                       f_tol    - float, a start stops when its misfit decreases by less than f_tol relative
+                       g_tol    - float, a start stops when its projected gradient is below g_tol, in unit box units
+                       step     - float, finite-difference step, in unit box units
+                       init     - np.ndarray (n, dim), models of the sampled parameters used as up to half of the starts
+                       seed     - int, seed of the random generator
+        """
+        self.problem = problem
+        self.n_starts = n_starts
+        self.max_iter = max_iter
+        self.memory = memory
+        self.f_tol = f_tol
+        self.g_tol = g_tol
+        self.step_size = step
+        self.rng = np.random.default_rng(seed)
+
+        self.iteration = 0
+        self.evaluations = 0
+        self.unit = seed_population(self.rng.random((n_starts, problem.dim)),
+                                    None if init is None else problem.to_unit(init), self.rng, 0.5)
+        self.misfits, self.params = self._objective(self.unit)
+        self.gradient = self._gradient(self.unit, self.misfits)
+        self.active = np.ones(n_starts, dtype=bool)
+
+        # Correction pairs, the most recent last, and the number filled for each start
+        self.s = np.zeros((n_starts, memory, problem.dim))
+        self.y = np.zeros((n_starts, memory, problem.dim))
+        self.filled = np.zeros(n_starts, dtype=int)
+
+    @property
+    def samples(self):
+        """Final point of every start, in the units of the problem."""
+        return self.problem.lower + self.unit * (self.problem.upper - self.problem.lower)
+
+    @property
+    def best(self):
+        """Full parameters and misfit of the best start."""
+        i = np.argmin(self.misfits)
+        return self.params[i], self.misfits[i]
+
+    def _objective(self, unit):
+        self.evaluations += len(unit)
+        return self.problem.solve(self.problem.lower + unit * (self.problem.upper - self.problem.lower))
+
+    def _gradient(self, unit, misfit):
+        """Finite-difference gradients (n, dim) of the misfit at 'unit', all points in one batch."""
+        n, dim = unit.shape
+        h = self.step_size
+        eye = np.eye(dim)
+
+        # Central differences, one-sided against a bound
+        up = np.clip(unit[:, None, :] + h * eye, 0., 1.)
+        down = np.clip(unit[:, None, :] - h * eye, 0., 1.)
+        f, _ = self._objective(np.concatenate([up, down], axis=1).reshape(-1, dim))
+        f_up, f_down = f.reshape(n, 2, dim).transpose(1, 0, 2)
+
+        width = np.einsum('nid,id->ni', up - down, eye)
+        return np.where(width > 0, (f_up - f_down) / np.where(width > 0, width, 1.), 0.)
+
+    def _direction(self, g, s, y, filled):
+        """L-BFGS two-loop recursion, vectorized over starts."""
+        q = g.copy()
+        n, m, _ = s.shape
+        sy = np.einsum('nmd,nmd->nm', s, y)
+        rho = np.where(np.arange(m) >= m - filled[:, None], 1 / np.where(sy > 0, sy, 1.), 0.)
+
+        alpha = np.zeros((n, m))
+        for j in range(m - 1, -1, -1):
+            alpha[:, j] = rho[:, j] * np.einsum('nd,nd->n', s[:, j], q)
+            q -= alpha[:, j, None] * y[:, j]
+
+        # Initial Hessian scaled by the latest pair
+        yy = np.einsum('nd,nd->n', y[:, -1], y[:, -1])
+        gamma = np.where((filled > 0) & (yy > 0), sy[:, -1] / np.where(yy > 0, yy, 1.), 1.)
+        r = gamma[:, None] * q
+
+        for j in range(m):
+            beta = rho[:, j] * np.einsum('nd,nd->n', y[:, j], r)
+            r += (alpha[:, j] - beta)[:, None] * s[:, j]
+
+        return -r
+
+    def step(self):
+        """One iteration of every active start."""
+        idx = np.nonzero(self.active)[0]
+        u, f, g = self.unit[idx], self.misfits[idx], self.gradient[idx]
+
+        # Variables at a bound with the gradient pushing out of the box are fixed for this iteration
+        blocked = ((u <= 0) & (g > 0)) | ((u >= 1) & (g < 0))
+        g_free = np.where(blocked, 0., g)
+
+        p = np.where(blocked, 0., self._direction(g_free, self.s[idx], self.y[idx], self.filled[idx]))
+        descent = np.einsum('nd,nd->n', p, g_free)
+
+        # Back to steepest descent where the approximation is not a descent direction
+        reset = descent >= 0
+        p[reset] = -g_free[reset]
+        self.filled[idx[reset]] = 0
+
+        # Steps move at most across the box, the first steps of a start at most a tenth of it
+        largest = np.max(np.abs(p), axis=1)
+        alpha = np.minimum(1., np.where(self.filled[idx] == 0, 0.1, 1.) / np.maximum(largest, 1e-300))
+
+        new_u, new_f, new_params = u.copy(), f.copy(), self.params[idx].copy()
+        pending = largest > 0
+        for _ in range(30):
+            if not pending.any():
+                break
+            trial = np.clip(u[pending] + alpha[pending, None] * p[pending], 0., 1.)
+            f_trial, params_trial = self._objective(trial)
+
+            armijo = f_trial <= f[pending] + 1e-4 * np.einsum('nd,nd->n', g_free[pending], trial - u[pending])
+            done = np.nonzero(pending)[0][armijo]
+            new_u[done], new_f[done], new_params[done] = trial[armijo], f_trial[armijo], params_trial[armijo]
+
+            pending[done] = False
+            alpha[pending] /= 2
+
+        new_g = self._gradient(new_u, new_f)
+
+        # Curvature pairs of the free variables only, the blocked gradient components say nothing of the curvature
+        s, y = new_u - u, np.where(blocked, 0., new_g - g)
+        keep = np.einsum('nd,nd->n', s, y) > 1e-12 * np.einsum('nd,nd->n', s, s)
+        for i in np.nonzero(keep)[0]:
+            k = idx[i]
+            self.s[k] = np.roll(self.s[k], -1, axis=0)
+            self.y[k] = np.roll(self.y[k], -1, axis=0)
+            self.s[k, -1], self.y[k, -1] = s[i], y[i]
+            self.filled[k] = min(self.filled[k] + 1, self.memory)
+
+        # Negative curvature along the step: the stored pairs no longer describe the misfit, restart from steepest descent
+        self.filled[idx[~keep]] = 0
+
+        # Converged: no decrease left, a small projected gradient, or a failed line search
+        projected = np.max(np.abs(np.clip(new_u - new_g, 0., 1.) - new_u), axis=1)
+        change = (f - new_f) <= self.f_tol * np.maximum(np.abs(f), 1.)
+        stop = change | (projected < self.g_tol)
+
+        self.unit[idx], self.misfits[idx], self.params[idx], self.gradient[idx] = new_u, new_f, new_params, new_g
+        self.active[idx[stop]] = False
+        self.iteration += 1
+
+    def run(self, callback=None):
+        """Iterate until every start converged or max_iter, calling callback(self) after every iteration."""
+        while self.iteration < self.max_iter and self.active.any():
+            if self.iteration % 10 == 0:
+                print("#" * 50)
+                print(f"L-BFGS-B iteration {self.iteration}/{self.max_iter}, {self.active.sum()} of {self.n_starts} starts active, best misfit {np.min(self.misfits):.6g}\n")
+            self.step()
+            if callback:
+                callback(self)
+        return self
+
+    def report(self):
+        """Budget used and convergence of the run."""
+        # Starts ending within the misfit tolerance of the best one, a single one hints at too few starts
+        best = np.min(self.misfits)
+        return {
+            'sampler': type(self).__name__,
+            'iterations': int(self.iteration),
+            'max_iterations': int(self.max_iter),
+            'evaluations': int(self.evaluations),
+            'converged': bool(not self.active.any()),
+            'criterion': {'f_tol': self.f_tol, 'g_tol': self.g_tol},
+            'best_misfit': float(best),
+            'starts': int(self.n_starts),
+            'starts_converged': int(np.sum(~self.active)),
+            'starts_at_best': int(np.sum(self.misfits - best <= 1e-6 * max(abs(best), 1.))),
+        }
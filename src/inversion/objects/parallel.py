@@ -0,0 +1,174 @@
+import signal
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from src.inversion.objects.problem import Problem
+from src.inversion.objects.checkpoint import Checkpoint
+from src.inversion.objects.diagnostics import split_rhat
+
+# Problem and stop event of a worker process, set once by _init_worker
+_WORKER = {}
+
+
+class SharedArrays:
+    """Named arrays copied once into a shared memory block, attached without a copy by worker processes."""
+    def __init__(self, arrays):
+        """Parameters: arrays - dict of np.ndarray"""
+        layout, size = [], 0
+        for name, a in arrays.items():
+            layout.append((name, np.asarray(a).dtype.str, np.shape(a), size))
+            # Every array starts on a cache line
+            size += -(-np.asarray(a).nbytes // 64) * 64
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.spec = (self.shm.name, layout)
+        for name, dtype, shape, offset in layout:
+            np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)[...] = arrays[name]
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def attach(spec):
+    """Read-only views of the arrays of a SharedArrays from its spec.
+    Returns:    shm    - SharedMemory, to keep open while the views are used
+                arrays - dict of np.ndarray
+    """
+    name, layout = spec
+    shm = shared_memory.SharedMemory(name=name)
+
+    arrays = {}
+    for key, dtype, shape, offset in layout:
+        a = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        a.flags.writeable = False
+        arrays[key] = a
+
+    return shm, arrays
+
+
+def _init_worker(spec, sources, nu, linear, greens, event):
+    """Attach the shared point arrays once per worker and build its Problem on them."""
+    # The parent forwards SIGTERM through the event, the Checkpoint of the chain saves and exits
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    shm, arrays = attach(spec)
+    problem = Problem.from_arrays(arrays, sources, nu=nu, linear=linear)
+    if greens:
+        # Built by the parent, the workers only map the table
+        problem.use_greens(*greens)
+
+    _WORKER.update(shm=shm, problem=problem, event=event)
+
+
+def chain_result(sampler):
+    """Best parameters and misfit, report, and posterior parameters, misfits and samples of a finished sampler."""
+    best, misfit = sampler.best
+    return {
+        'best': best, 'misfit': misfit, 'report': sampler.report(),
+        'params': sampler.params, 'misfits': sampler.misfits, 'samples': sampler.samples,
+    }
+
+
+def _run_chain(factory, seed, checkpoint, log_file):
+    """Run one chain in a worker, logging to log_file, see chain_result."""
+    file, key, interval = checkpoint
+    with open(log_file, 'a') as f, redirect_stdout(f), redirect_stderr(f):
+        sampler = factory(_WORKER['problem'], seed=seed)
+        chain_checkpoint = Checkpoint(file, key, interval=interval, event=_WORKER['event'])
+        chain_checkpoint.load(sampler)
+        with chain_checkpoint.sigterm():
+            sampler.run(callback=chain_checkpoint)
+
+    return chain_result(sampler)
+
+
+def run_chains(problem, factory, seeds, jobs, checkpoint, log_pattern, greens=None):
+    """Independent chains or restarts of a sampler in a process pool, the point arrays in shared memory.
+    Parameters: problem     - Problem, its arrays are shared with the workers
+                factory     - callable (problem, seed=seed) -> sampler, picklable
+                seeds       - list of seeds or np.random.SeedSequence, one per chain
+                jobs        - int, worker processes
+                checkpoint  - (file pattern with {k}, key, interval) of the chain snapshots
+                log_pattern - str, log file of each chain with {k}
+                greens      - arguments of Problem.use_greens, None without
+    Returns:    list of dict, results of the chains in order (see chain_result)
+    """
+    event = mp.Event()
+    file, key, interval = checkpoint
+
+    def forward_sigterm(signum, frame):
+        event.set()
+
+    previous = signal.signal(signal.SIGTERM, forward_sigterm)
+    try:
+        with SharedArrays(problem.arrays) as shared, \
+                ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                    initargs=(shared.spec, problem.sources, problem.nu, problem.linear, greens, event)) as executor:
+            futures = {executor.submit(_run_chain, factory, seed, (file.format(k=k), f'{key}:{k}', interval),
+                                       log_pattern.format(k=k)): k
+                       for k, seed in enumerate(seeds)}
+
+            results = [None] * len(seeds)
+            for i, future in enumerate(as_completed(futures), start=1):
+                k = futures[future]
+                results[k] = future.result()
+                print(f"[{i}/{len(seeds)}] chain {k} done, best misfit {results[k]['misfit']:.6g}, log in {log_pattern.format(k=k)}")
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+    return results
+
+
+def merge(problem, results):
+    """One posterior and one best fit from the results of independent chains.
+    Returns:    best      - np.ndarray, full parameters of the best model of all chains
+                misfit    - float, its misfit
+                posterior - dict of np.ndarray, columns of the parameters, misfit and chain of every sample
+                report    - dict, per-chain reports and chain-to-chain diagnostics, the report of the
+                            sampler for a single chain
+    """
+    misfits = np.array([r['misfit'] for r in results])
+    i = int(np.argmin(misfits))
+    names = [problem.names[j] for j in problem.free]
+
+    params = np.vstack([r['params'] for r in results])
+    posterior = dict(zip(problem.names, params.T))
+    posterior['misfit'] = np.concatenate([r['misfits'] for r in results])
+    posterior['chain'] = np.concatenate([np.full(len(r['misfits']), k) for k, r in enumerate(results)])
+
+    if len(results) == 1:
+        return results[0]['best'], misfits[0], posterior, results[0]['report']
+
+    # Chains ending in the same minimum, and how far apart their best models are
+    bests = np.array([r['best'][problem.free] for r in results])
+    report = {
+        'chains': len(results),
+        'iterations': int(max(r['report']['iterations'] for r in results)),
+        'max_iterations': results[0]['report']['max_iterations'],
+        'evaluations': int(sum(r['report']['evaluations'] for r in results)),
+        'converged': bool(all(r['report']['converged'] for r in results)),
+        'best_misfit': float(misfits[i]),
+        'best_chain': i,
+        'chain_best_misfits': misfits.tolist(),
+        'chains_at_best': int(np.sum(misfits - misfits[i] <= 1e-6 * max(abs(misfits[i]), 1.))),
+        'best_spread': dict(zip(names, bests.std(axis=0).tolist())),
+        'reports': [r['report'] for r in results],
+    }
+
+    if results[0]['report']['sampler'] == 'EnsembleSampler':
+        # Samples of every chain as one sequence, steps in order, cut to the shortest chain
+        n = min(len(r['samples']) for r in results)
+        if n >= 4:
+            chains = np.stack([r['samples'][len(r['samples']) - n:] for r in results], axis=1)
+            report['between_chain_rhat'] = dict(zip(names, split_rhat(chains).tolist()))
+
+    return results[i]['best'], misfits[i], posterior, report
@@ -0,0 +1,270 @@
+import numpy as np
+from scipy.optimize import lsq_linear
+from src.shared import forward
+from src.inversion.objects.greens import GreensTable, cacheable
+
+# Parameters the LOS displacement is linear in, solved by least squares instead of sampled
+LINEAR_PARAMS = {
+    'mogi': ['volume'],
+    'point': ['dP_mu'],
+    'penny': ['dP_mu'],
+    'spheroid': ['dP_mu'],
+    'moment': ['Mxx', 'Myy', 'Mzz', 'Mxy', 'Mxz', 'Myz'],
+    'okada': ['slip', 'opening'],
+}
+
+# Number of (sample, point, column) values held at once while evaluating misfits
+BATCH_SIZE = 2 ** 23
+
+
+def point_arrays(points, weights=None):
+    """Point datasets concatenated, with the weight of every point.
+    Parameters: points  - list of dict of np.ndarray, point datasets with the h5_functions.COLUMNS
+                weights - list of float, weight of each dataset (default: 1)
+    Returns:    dict of np.ndarray, coordinates x and y, displacement d, LOS vectors lx, ly and lz,
+                index of the dataset and weight w, sqrt(weight) / error, of every point
+    """
+    arrays = {name: np.concatenate([np.asarray(p[c], dtype=float) for p in points])
+              for name, c in [('x', 'xx'), ('y', 'yy'), ('d', 'dd'), ('lx', 'lx'), ('ly', 'ly'), ('lz', 'lz')]}
+    arrays['dataset'] = np.concatenate([np.full(len(p['xx']), i) for i, p in enumerate(points)])
+
+    # Points without a usable error get unit error
+    err = np.concatenate([np.asarray(p['ee'], dtype=float) for p in points])
+    err = np.where(np.isfinite(err) & (err > 0), err, 1.)
+    weights = np.ones(len(points)) if weights is None else np.asarray(weights, dtype=float)
+    arrays['w'] = np.sqrt(weights[arrays['dataset']]) / err
+
+    return arrays
+
+
+class Problem:
+    """Weighted least-squares fit of one or more sources to LOS point datasets.
+
+    Every source has a position (xcen, ycen, depth) and the parameters of its
+    model, each with a (min, max) range. With 'linear' the parameters the
+    displacement is linear in (LINEAR_PARAMS) are not sampled: for every
+    sample of the other parameters they are solved by bounded weighted least
+    squares, which leaves the sampler only the nonlinear ones. The misfit is
+    the weighted sum of squared residuals, sum(w * ((d - synth) / err) ** 2).
+    """
+    def __init__(self, points, sources, weights=None, nu=0.25, linear=True):
+        """Parameters: points  - list of dict of np.ndarray, point datasets with the h5_functions.COLUMNS
+                       sources - list of (model, ranges), ranges a dict param -> (min, max) for
+                                 forward.param_names(model), None for an unbounded linear parameter
+                       weights - list of float, weight of each dataset (default: 1)
+                       nu      - float, Poisson ratio
+                       linear  - bool, solve the linear parameters instead of sampling them
+        """
+        self._setup(point_arrays(points, weights), sources, nu, linear)
+
+    @classmethod
+    def from_arrays(cls, arrays, sources, nu=0.25, linear=True):
+        """Problem on the point arrays of another one (see Problem.arrays), used without a copy,
+        so that they may live in shared memory."""
+        problem = cls.__new__(cls)
+        problem._setup(arrays, sources, nu, linear)
+        return problem
+
+    @property
+    def arrays(self):
+        """Concatenated point arrays of the problem, see point_arrays."""
+        return {'x': self.x, 'y': self.y, 'd': self.d, 'lx': self.los[0], 'ly': self.los[1], 'lz': self.los[2],
+                'dataset': self.dataset, 'w': self.w}
+
+    def _setup(self, arrays, sources, nu, linear):
+        self.nu = nu
+        self.linear = linear
+        # Point-source approximations of finite sources are only sampled where they hold
+        self.sources = [(model, dict(forward.far_field_ranges(model, ranges))) for model, ranges in sources]
+
+        self.x, self.y, self.d = arrays['x'], arrays['y'], arrays['d']
+        self.los = (arrays['lx'], arrays['ly'], arrays['lz'])
+        self.dataset, self.w = arrays['dataset'], arrays['w']
+
+        # Names of all parameters, the first source unsuffixed and the following ones suffixed by their index
+        self.names, self.free, self._slots, self._bounds = [], [], [], []
+        for k, (model, ranges) in enumerate(self.sources):
+            suffix = f'_{k}' if k else ''
+            slots = {}
+            for name in forward.param_names(model):
+                slots[name] = len(self.names)
+                self.names.append(name + suffix)
+                r = ranges.get(name)
+                self._bounds.append((-np.inf, np.inf) if r is None else (min(r), max(r)))
+                if not (linear and name in LINEAR_PARAMS[model]):
+                    self.free.append(slots[name])
+            self._slots.append(slots)
+
+        # Green's function table of each source, see use_greens()
+        self.greens = [None] * len(self.sources)
+
+        self.lower = np.array([self._bounds[i][0] for i in self.free], dtype=float)
+        self.upper = np.array([self._bounds[i][1] for i in self.free], dtype=float)
+
+        if not np.all(np.isfinite(self.lower) & np.isfinite(self.upper)):
+            missing = [self.names[i] for i, l, u in zip(self.free, self.lower, self.upper) if not np.isfinite(l + u)]
+            raise ValueError(f"Sampled parameters need finite ranges: {missing}")
+
+    @property
+    def dim(self):
+        """Number of sampled parameters."""
+        return len(self.free)
+
+    def _columns(self, theta):
+        """Unit responses of the linear parameters and the displacement of the sampled ones.
+        Returns:    G     - np.ndarray (n_samples, n_points, n_linear)
+                    fixed - np.ndarray (n_samples, n_points)
+                    index - list of int, position in self.names of each column of G
+        """
+        full = np.zeros((len(theta), len(self.names)))
+        full[:, self.free] = theta
+
+        columns, index = [], []
+        fixed = np.zeros((len(theta), len(self.x)))
+
+        for k, ((model, _), slots) in enumerate(zip(self.sources, self._slots)):
+            params = {name: full[:, i] for name, i in slots.items()}
+
+            if self.linear:
+                for name in LINEAR_PARAMS[model]:
+                    columns.append(self.unit_response(k, name, params))
+                    index.append(slots[name])
+            elif self.greens[k] is not None:
+                # Sampled linear parameters scale the tabulated unit responses
+                for name in LINEAR_PARAMS[model]:
+                    fixed += params[name][:, None] * self.unit_response(k, name, params)
+            else:
+                fixed += forward.batch(model, self.x, self.y, params, los=self.los, nu=self.nu)
+
+        G = np.stack(columns, -1) if columns else np.zeros((len(theta), len(self.x), 0))
+        return G, fixed, index
+
+    def unit_response(self, k, name, params):
+        """LOS displacement (n_samples, n_points) of source 'k' with a unit value of its linear parameter 'name'."""
+        if self.greens[k] is not None:
+            return self.greens[k].response(name, params['xcen'], params['ycen'], params['depth'])
+
+        model = self.sources[k][0]
+        linear = LINEAR_PARAMS[model]
+        n = len(params['xcen'])
+        unit = dict(params, **{p: np.zeros(n) for p in linear})
+        unit[name] = np.ones(n)
+
+        return forward.batch(model, self.x, self.y, unit, los=self.los, nu=self.nu)
+
+    def use_greens(self, folder, shape=(41, 41, 21), sources=None, max_size=None):
+        """Interpolate the unit responses of the sources that only move from cached Green's function tables.
+        Parameters: folder   - str, directory of the tables, shared by the periods of the same tracks
+                    shape    - tuple of int, nodes of the position grid along xcen, ycen and depth
+                    sources  - list of (model, ranges), position ranges spanned by the tables (default: self.sources),
+                               wider ranges keep one table for problems narrowed differently
+                    max_size - float, largest size of a table [MB], larger ones are not built and their
+                               source is evaluated directly
+        Returns:    list of str, models using a table
+        """
+        for k, (model, ranges) in enumerate(self.sources):
+            linear = LINEAR_PARAMS[model]
+            if not cacheable(model, ranges, linear):
+                continue
+
+            size = GreensTable.nbytes(shape, len(self.x), len(linear)) / 2 ** 20
+            if max_size is not None and size > max_size:
+                print("#" * 50)
+                print(f"Green's function table of {model} would take {size:.0f} MB, above {max_size:g} MB, "
+                      f"it is evaluated directly instead.\n")
+                continue
+
+            fixed = {p: float(min(r)) for p, r in ranges.items()
+                     if p not in forward.POSITION_PARAMS and p not in linear}
+            span = ranges if sources is None else sources[k][1]
+            bounds = [(min(span[p]), max(span[p])) for p in forward.POSITION_PARAMS]
+            self.greens[k] = GreensTable(folder, self.x, self.y, self.los, model, linear, fixed, bounds,
+                                         shape=shape, nu=self.nu)
+
+        return [model for (model, _), table in zip(self.sources, self.greens) if table is not None]
+
+    def greens_error(self, n=64):
+        """Relative interpolation error of the Green's function table of every source using one.
+        Returns:    dict, model -> (depth, error), see GreensTable.interpolation_error
+        """
+        return {model: table.interpolation_error(self.x, self.y, self.los, nu=self.nu, n=n)
+                for (model, _), table in zip(self.sources, self.greens) if table is not None}
+
+    def solve(self, theta):
+        """Misfit and full parameters of samples of the sampled parameters.
+        Parameters: theta  - np.ndarray (n_samples, dim), values of the parameters in self.free
+        Returns:    misfit - np.ndarray (n_samples,)
+                    params - np.ndarray (n_samples, len(self.names)), linear parameters solved
+        """
+        theta = np.atleast_2d(np.asarray(theta, dtype=float))
+        n_columns = 1 + sum(len(LINEAR_PARAMS[m]) for m, _ in self.sources if self.linear)
+        step = max(1, BATCH_SIZE // (len(self.x) * n_columns))
+
+        misfit = np.empty(len(theta))
+        params = np.empty((len(theta), len(self.names)))
+
+        for s0 in range(0, len(theta), step):
+            s = slice(s0, s0 + step)
+            misfit[s], params[s] = self._solve(theta[s])
+
+        return misfit, params
+
+    def _solve(self, theta):
+        G, fixed, index = self._columns(theta)
+
+        params = np.zeros((len(theta), len(self.names)))
+        params[:, self.free] = theta
+
+        A = G * self.w[None, :, None]
+        b = (self.d[None, :] - fixed) * self.w[None, :]
+
+        if index:
+            m = self._least_squares(A, b, index)
+            params[:, index] = m
+            b = b - np.einsum('npk,nk->np', A, m)
+
+        return np.sum(b ** 2, axis=1), params
+
+    def _least_squares(self, A, b, index):
+        """Bounded least squares of every sample, normal equations first and an exact bounded solver where they break a bound."""
+        lower = np.array([self._bounds[i][0] for i in index])
+        upper = np.array([self._bounds[i][1] for i in index])
+
+        AtA = np.einsum('npi,npj->nij', A, A)
+        Atb = np.einsum('npi,np->ni', A, b)
+
+        # Tiny ridge against sources far from every point, where the columns vanish
+        ridge = (1e-12 * np.einsum('nii->ni', AtA) + 1e-300)[..., None] * np.eye(len(index))
+        m = np.linalg.solve(AtA + ridge, Atb[..., None])[..., 0]
+
+        outside = np.any((m < lower) | (m > upper), axis=1)
+        if len(index) == 1:
+            # One parameter: the clipped minimizer is the bounded one
+            m = np.clip(m, lower, upper)
+        else:
+            for i in np.nonzero(outside)[0]:
+                m[i] = lsq_linear(A[i], b[i], bounds=(lower, upper), method='bvls').x
+
+        return m
+
+    def synthetic(self, params):
+        """Modelled LOS displacement of every point for one full parameter vector."""
+        params = np.asarray(params, dtype=float)
+        synth = np.zeros(len(self.x))
+
+        for (model, _), slots in zip(self.sources, self._slots):
+            values = {name: params[i] for name, i in slots.items()}
+            synth += forward.los_displacement(model, self.x, self.y, values, self.los, nu=self.nu)
+
+        return synth
+
+    def sample_uniform(self, n, rng):
+        """'n' samples drawn uniformly in the box of the sampled parameters."""
+        return self.lower + (self.upper - self.lower) * rng.random((n, self.dim))
+
+    def to_unit(self, theta):
+        """Samples of the sampled parameters scaled to the unit box, clipped to it."""
+        width = self.upper - self.lower
+        with np.errstate(invalid='ignore', divide='ignore'):
+            unit = np.where(width > 0, (np.atleast_2d(np.asarray(theta, dtype=float)) - self.lower) / width, 0.)
+        return np.clip(unit, 0., 1.)
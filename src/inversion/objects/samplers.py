@@ -0,0 +1,314 @@
+import numpy as np
+from src.inversion.objects.diagnostics import split_rhat, effective_sample_size, plateau
+
+
+def seed_population(samples, init, rng, fraction=1.):
+    """Initial samples with up to 'fraction' of them replaced by a random subset of the models 'init',
+    e.g. the posterior of the previous period, the others keeping the search open."""
+    if init is None or not len(init):
+        return samples
+
+    m = min(len(init), int(fraction * len(samples)))
+    samples = samples.copy()
+    samples[:m] = init[rng.choice(len(init), m, replace=False)]
+    return samples
+
+
+class NeighbourhoodAlgorithm:
+    """Neighbourhood Algorithm search, Sambridge (1999).
+
+    Every iteration resamples the Voronoi cells of the n_resample best models
+    found so far with n_samples new models in total, drawn by Gibbs walks
+    restricted to each cell. Coordinates are scaled to the unit box of the
+    problem so that every parameter weighs the same in the distances.
+    The search stops early once the mean misfit of the resampled cells, which
+    keeps decreasing while the cells contract around the minima, reaches a
+    plateau. The best misfit alone often stalls for a few iterations.
+    """
+    # Attributes that, with the random generator, resume a run (see Checkpoint)
+    STATE = ['iteration', 'unit', 'misfits', 'params', 'history', 'converged']
+
+    def __init__(self, problem, n_samples=1000, n_resample=300, n_iterations=12, plateau_tol=None, patience=2, init=None, seed=None):
+        """Parameters: problem      - Problem, with solve() and the bounds of the sampled parameters
+                       n_samples    - int, models drawn at every iteration, the initial one included
+                       n_resample   - int, best cells resampled at every iteration
+                       n_iterations - int, maximum iterations after the initial uniform sampling
+                       plateau_tol  - float, stop once 'patience' iterations improved the mean misfit of the
+                                      resampled cells by less than plateau_tol relative, None to run every iteration
+                       patience     - int, iterations of the plateau
+                       init         - np.ndarray (n, dim), models of the sampled parameters seeding up to half
+                                      of the initial sampling
+                       seed         - int, seed of the random generator
+        """
+        self.problem = problem
+        self.n_samples = n_samples
+        self.n_resample = n_resample
+        self.n_iterations = n_iterations
+        self.plateau_tol = plateau_tol
+        self.patience = patience
+        self.init = None if init is None else problem.to_unit(init)
+        self.rng = np.random.default_rng(seed)
+
+        self.iteration = 0
+        self.unit = np.empty((0, problem.dim))
+        self.misfits = np.empty(0)
+        self.params = np.empty((0, len(problem.names)))
+
+        # Mean misfit of the cells to resample after every iteration
+        self.history = np.empty(0)
+        self.converged = False
+
+    @property
+    def samples(self):
+        """Sampled parameters of every model, in the units of the problem."""
+        return self.problem.lower + self.unit * (self.problem.upper - self.problem.lower)
+
+    @property
+    def best(self):
+        """Full parameters and misfit of the best model."""
+        i = np.argmin(self.misfits)
+        return self.params[i], self.misfits[i]
+
+    def _evaluate(self, unit):
+        misfit, params = self.problem.solve(self.problem.lower + unit * (self.problem.upper - self.problem.lower))
+        self.unit = np.vstack([self.unit, unit])
+        self.misfits = np.concatenate([self.misfits, misfit])
+        self.params = np.vstack([self.params, params])
+
+    def step(self):
+        """One iteration, the initial uniform sampling first."""
+        if not len(self.misfits):
+            self._evaluate(seed_population(self.rng.random((self.n_samples, self.problem.dim)), self.init, self.rng, 0.5))
+        else:
+            self._evaluate(self._resample())
+        self.iteration += 1
+
+        self.history = np.append(self.history, np.mean(np.sort(self.misfits)[:self.n_resample]))
+        if self.plateau_tol is not None:
+            self.converged = plateau(self.history, self.plateau_tol, self.patience)
+
+    def run(self, callback=None):
+        """Iterate up to n_iterations or to a plateau, calling callback(self) after every iteration."""
+        while self.iteration <= self.n_iterations and not self.converged:
+            print("#" * 50)
+            print(f"Neighbourhood algorithm iteration {self.iteration}/{self.n_iterations}, best misfit {np.min(self.misfits) if len(self.misfits) else np.nan:.6g}\n")
+            self.step()
+            if callback:
+                callback(self)
+
+        if self.converged:
+            print("#" * 50)
+            print(f"Misfit of the best cells improved by less than {self.plateau_tol:g} over {self.patience} iterations, stopping at iteration {self.iteration - 1}.\n")
+        return self
+
+    def report(self):
+        """Budget used and convergence of the run."""
+        return {
+            'sampler': type(self).__name__,
+            'iterations': int(self.iteration),
+            'max_iterations': int(self.n_iterations) + 1,
+            'evaluations': len(self.misfits),
+            'converged': bool(self.converged),
+            'criterion': None if self.plateau_tol is None else {'plateau_tol': self.plateau_tol, 'patience': self.patience},
+            'best_misfit': float(np.min(self.misfits)),
+            'history': self.history.tolist(),
+        }
+
+    def _resample(self):
+        """New models by Gibbs walks in the Voronoi cells of the best models."""
+        n_cells = min(self.n_resample, len(self.misfits))
+        cells = np.argsort(self.misfits)[:n_cells]
+        per_cell = np.full(n_cells, self.n_samples // n_cells)
+        per_cell[:self.n_samples % n_cells] += 1
+
+        points = self.unit
+        walk = points[cells].copy()
+        dist2 = np.sum((walk[:, None, :] - points[None, :, :]) ** 2, axis=2)
+        own = points[cells]
+
+        new = []
+        for k in range(per_cell.max()):
+            for i in range(self.problem.dim):
+                # Perpendicular distances to the axis through the walk, and where it crosses each bisector
+                perp = dist2 - (walk[:, i, None] - points[None, :, i]) ** 2
+                own_perp = perp[np.arange(n_cells), cells]
+                delta = own[:, i, None] - points[None, :, i]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    cross = 0.5 * (own[:, i, None] + points[None, :, i] + (own_perp[:, None] - perp) / delta)
+
+                low = np.max(np.where(delta > 0, cross, 0.), axis=1, initial=0.)
+                high = np.min(np.where(delta < 0, cross, 1.), axis=1, initial=1.)
+                low, high = np.clip(low, 0., 1.), np.clip(high, 0., 1.)
+
+                value = low + (high - low) * self.rng.random(n_cells)
+                dist2 += (value[:, None] - points[None, :, i]) ** 2 - (walk[:, i, None] - points[None, :, i]) ** 2
+                walk[:, i] = value
+
+            new.append(walk[per_cell > k].copy())
+
+        return np.vstack(new)
+
+
+class EnsembleSampler:
+    """Bayesian sampling with the affine-invariant ensemble stretch move, Goodman & Weare (2010).
+
+    The likelihood is exp(-misfit / 2) with uniform priors on the box of the
+    problem. With linear parameters solved by least squares the sampled
+    density is the profile likelihood of the nonlinear parameters.
+
+    With convergence tolerances the burn-in is adaptive: every check_every
+    steps the second half of the chain is tested with the split R-hat across
+    walkers and the effective sample size, and the run stops as soon as both
+    pass, the first half discarded as warm-up. Otherwise burn_in steps are
+    discarded and n_steps kept.
+    """
+    # Attributes that, with the random generator, resume a run (see Checkpoint)
+    STATE = ['iteration', 'evaluations', 'walkers', 'walker_misfits', 'walker_params', 'warmup', 'converged',
+             'chain', 'chain_misfits', 'chain_params', 'best_params', 'best_misfit']
+
+    def __init__(self, problem, n_walkers=32, n_steps=1000, burn_in=5000, stretch=2., rhat=None, min_ess=400,
+                 check_every=100, init=None, seed=None):
+        """Parameters: problem     - Problem, with solve() and the bounds of the sampled parameters
+                       n_walkers   - int, number of walkers, at least twice the number of sampled parameters
+                       n_steps     - int, steps kept after the burn-in
+                       burn_in     - int, steps discarded first
+                       stretch     - float, scale of the stretch move
+                       rhat        - float, stop once the split R-hat of every parameter is below rhat,
+                                     None to run burn_in + n_steps steps
+                       min_ess     - float, and the effective sample size of every parameter above min_ess
+                       check_every - int, steps between two convergence checks
+                       init        - np.ndarray (n, dim), models of the sampled parameters the walkers start from,
+                                     uniform draws for the missing ones
+                       seed        - int, seed of the random generator
+        """
+        self.problem = problem
+        self.n_walkers = max(n_walkers, 2 * problem.dim + 2) // 2 * 2
+        self.n_steps = n_steps
+        self.burn_in = burn_in
+        self.stretch = stretch
+        self.rhat = rhat
+        self.min_ess = min_ess
+        self.check_every = check_every
+        self.rng = np.random.default_rng(seed)
+
+        self.iteration = 0
+        self.evaluations = self.n_walkers
+        self.walkers = problem.sample_uniform(self.n_walkers, self.rng)
+        if init is not None:
+            unit = problem.to_unit(init)
+            self.walkers = seed_population(self.walkers, problem.lower + unit * (problem.upper - problem.lower), self.rng)
+        misfit, params = problem.solve(self.walkers)
+        self.walker_misfits, self.walker_params = misfit, params
+
+        # Every step, burn-in included, the samples are those from self.warmup to self.iteration
+        total = burn_in + n_steps
+        self.warmup = burn_in
+        self.converged = False
+        self.chain = np.empty((total, self.n_walkers, problem.dim))
+        self.chain_misfits = np.empty((total, self.n_walkers))
+        self.chain_params = np.empty((total, self.n_walkers, len(problem.names)))
+        self.best_params, self.best_misfit = params[np.argmin(misfit)], np.min(misfit)
+
+    @property
+    def kept(self):
+        """Steps retained as posterior samples."""
+        return max(self.iteration - self.warmup, 0)
+
+    @property
+    def samples(self):
+        """Posterior samples kept after the burn-in, walkers flattened."""
+        return self.chain[self.warmup:self.iteration].reshape(-1, self.problem.dim)
+
+    @property
+    def misfits(self):
+        return self.chain_misfits[self.warmup:self.iteration].ravel()
+
+    @property
+    def params(self):
+        return self.chain_params[self.warmup:self.iteration].reshape(-1, len(self.problem.names))
+
+    @property
+    def best(self):
+        """Full parameters and misfit of the best model visited, burn-in included."""
+        return self.best_params, self.best_misfit
+
+    def diagnostics(self):
+        """Split R-hat and effective sample size of every sampled parameter over the kept steps."""
+        chain = self.chain[self.warmup:self.iteration]
+        return split_rhat(chain), effective_sample_size(chain)
+
+    def step(self):
+        """Move both halves of the ensemble once."""
+        half = self.n_walkers // 2
+        for active, other in [(slice(0, half), slice(half, None)), (slice(half, None), slice(0, half))]:
+            walkers, partners = self.walkers[active], self.walkers[other]
+
+            z = ((self.stretch - 1) * self.rng.random(half) + 1) ** 2 / self.stretch
+            chosen = partners[self.rng.integers(0, len(partners), half)]
+            proposal = chosen + z[:, None] * (walkers - chosen)
+
+            inside = np.all((proposal >= self.problem.lower) & (proposal <= self.problem.upper), axis=1)
+            misfit = np.full(half, np.inf)
+            params = self.walker_params[active].copy()
+            if inside.any():
+                misfit[inside], params[inside] = self.problem.solve(proposal[inside])
+                self.evaluations += int(inside.sum())
+
+            log_ratio = (self.problem.dim - 1) * np.log(z) - 0.5 * (misfit - self.walker_misfits[active])
+            accept = np.log(self.rng.random(half)) < log_ratio
+
+            index = np.arange(self.n_walkers)[active][accept]
+            self.walkers[index] = proposal[accept]
+            self.walker_misfits[index] = misfit[accept]
+            self.walker_params[index] = params[accept]
+
+        i = np.argmin(self.walker_misfits)
+        if self.walker_misfits[i] < self.best_misfit:
+            self.best_params, self.best_misfit = self.walker_params[i].copy(), self.walker_misfits[i]
+
+        self.chain[self.iteration] = self.walkers
+        self.chain_misfits[self.iteration] = self.walker_misfits
+        self.chain_params[self.iteration] = self.walker_params
+        self.iteration += 1
+
+        if self.rhat is not None and self.iteration % self.check_every == 0:
+            # The first half of the chain is taken as warm-up, as long as it is the shorter burn-in
+            warmup = min(self.iteration // 2, self.burn_in)
+            chain = self.chain[warmup:self.iteration]
+            if np.all(split_rhat(chain) < self.rhat) and np.all(effective_sample_size(chain) >= self.min_ess):
+                self.warmup, self.converged = warmup, True
+
+    def run(self, callback=None):
+        """Step through the burn-in and the kept steps, or up to convergence, calling callback(self) after every step."""
+        total = self.burn_in + self.n_steps
+        while self.iteration < total and not self.converged:
+            if self.iteration % 500 == 0:
+                print("#" * 50)
+                print(f"Ensemble sampler step {self.iteration}/{total}, best misfit {self.best_misfit:.6g}\n")
+            self.step()
+            if callback:
+                callback(self)
+
+        if self.converged:
+            print("#" * 50)
+            print(f"Converged at step {self.iteration}, R-hat below {self.rhat:g} and effective sample size above {self.min_ess:g}.\n")
+        return self
+
+    def report(self):
+        """Budget used and convergence of the run."""
+        rhat, ess = self.diagnostics()
+        names = [self.problem.names[i] for i in self.problem.free]
+        return {
+            'sampler': type(self).__name__,
+            'iterations': int(self.iteration),
+            'max_iterations': self.burn_in + self.n_steps,
+            'evaluations': int(self.evaluations),
+            'converged': bool(self.converged),
+            'criterion': None if self.rhat is None else {'rhat': self.rhat, 'min_ess': self.min_ess},
+            'best_misfit': float(self.best_misfit),
+            'walkers': self.n_walkers,
+            'warmup': int(self.warmup),
+            'kept': int(self.kept),
+            'rhat': dict(zip(names, rhat.tolist())),
+            'ess': dict(zip(names, ess.tolist())),
+        }
@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2
+
+# Narrowed ranges keep at least this fraction of the original range
+MIN_WIDTH = 0.05
+
+# Factor on the inflation when a best fit ends against a narrowed bound
+WIDEN = 4.
+
+# Probability of the misfit region of the previous posterior the next ranges are built on
+LEVEL = 0.95
+
+
+class WarmStart:
+    """Result of the previous period of a sequential inversion, narrowing the ranges of the next one.
+
+    The models of the previous posterior within the LEVEL confidence region
+    of the misfit (best misfit plus the chi-square quantile of the number of
+    sampled parameters) give, for every parameter, the half-width of the
+    region around the best fit. The next range is the best fit plus or minus
+    'inflation' times that half-width, at least MIN_WIDTH of the original
+    range and within it, the inflation leaving room for a migrating source.
+    The same models seed the initial population of the next sampler. Without
+    a posterior only the best fit is used, with the minimum width. A best fit
+    ending against a narrowed bound means the source moved beyond the
+    inflation, the period is then run again with the inflation raised by WIDEN.
+    """
+    def __init__(self, best, posterior=None, inflation=2.):
+        """Parameters: best      - pd.Series, best model of the previous period, VSM_best.csv
+                       posterior - pd.DataFrame, samples with their misfit, VSM_posterior.csv
+                       inflation - float, factor applied to the half-width of the previous region
+        """
+        self.best = best
+        self.posterior = posterior
+        self.inflation = inflation
+
+    @classmethod
+    def load(cls, output_folder, inflation=2.):
+        """WarmStart from the outputs of a period, None if it has no best model."""
+        best_file = os.path.join(output_folder, 'VSM_best.csv')
+        if not os.path.exists(best_file):
+            return None
+
+        posterior_file = os.path.join(output_folder, 'VSM_posterior.csv')
+        posterior = pd.read_csv(posterior_file) if os.path.exists(posterior_file) else None
+        return cls(pd.read_csv(best_file).iloc[0], posterior, inflation=inflation)
+
+    def region(self, columns):
+        """Models of the posterior within the confidence region, columns 'columns' only."""
+        if self.posterior is None or not set(columns) <= set(self.posterior.columns):
+            return pd.DataFrame([self.best[columns]])
+
+        misfit = self.posterior['misfit']
+        keep = misfit <= misfit.min() + chi2.ppf(LEVEL, max(len(columns), 1))
+        return self.posterior.loc[keep, columns]
+
+    def narrow(self, sources):
+        """Sources with the ranges of their varying parameters narrowed around the previous best fit.
+        Parameters: sources - list of (model, ranges), parameter names of source k suffixed by _k after the first
+        Returns:    list of (model, ranges)
+        """
+        columns = [name + (f'_{k}' if k else '') for k, (_, ranges) in enumerate(sources)
+                   for name, r in ranges.items() if r is not None and min(r) < max(r)]
+        columns = [c for c in columns if c in self.best.index]
+        region = self.region(columns)
+
+        narrowed = []
+        for k, (model, ranges) in enumerate(sources):
+            ranges = dict(ranges)
+            for name, r in ranges.items():
+                column = name + (f'_{k}' if k else '')
+                if column not in columns:
+                    continue
+
+                lo, hi = min(r), max(r)
+                center = float(np.clip(self.best[column], lo, hi))
+                half = max(center - region[column].min(), region[column].max() - center, 0.5 * MIN_WIDTH * (hi - lo))
+                ranges[name] = [float(max(lo, center - self.inflation * half)), float(min(hi, center + self.inflation * half))]
+
+            narrowed.append((model, ranges))
+
+        return narrowed
+
+    def widen(self):
+        """Same warm start with the inflation raised by WIDEN."""
+        return WarmStart(self.best, self.posterior, inflation=self.inflation * WIDEN)
+
+    def at_bound(self, sources, narrowed, best):
+        """Parameters whose best fit lies against a narrowed bound, one inside the original range.
+        Parameters: sources  - list of (model, ranges), original ranges
+                    narrowed - list of (model, ranges), from narrow(sources)
+                    best     - dict, best fit of the narrowed inversion, parameter names suffixed as in narrow()
+        Returns:    list of str
+        """
+        hit = []
+        for k, ((_, ranges), (_, narrow)) in enumerate(zip(sources, narrowed)):
+            for name, r in ranges.items():
+                column = name + (f'_{k}' if k else '')
+                if r is None or column not in best or narrow[name] is r:
+                    continue
+
+                lo, hi = min(narrow[name]), max(narrow[name])
+                tol = 1e-3 * (hi - lo)
+                if (lo > min(r) and best[column] <= lo + tol) or (hi < max(r) and best[column] >= hi - tol):
+                    hit.append(column)
+
+        return hit
+
+    def init(self, problem):
+        """Models of the region seeding the sampler of 'problem', None if they lack a sampled parameter.
+        Returns:    np.ndarray (n, problem.dim)
+        """
+        columns = [problem.names[i] for i in problem.free]
+        if not set(columns) <= set(self.best.index):
+            return None
+
+        return self.region(columns)[columns].to_numpy(dtype=float)
@@ -3,22 +3,72 @@
 import os
 import re
 import sys
-import VSM
 import glob
+import json
+import itertools
 import argparse
+from functools import partial
+import numpy as np
 import pandas as pd
+from src.shared import cache
 from src.shared.plot import plot_results as plot
 from src.shared.csv_functions import results_csv
+from src.shared import forward
+from src.shared.h5_functions import POINTS_EXT, point_files, points_metadata, export_csv, read_points
 from src.shared.helper_functions import inversion_template, SCRATCHDIR, MODEL_DEFS
+from src.inversion.objects.problem import Problem
+from src.inversion.objects.samplers import NeighbourhoodAlgorithm, EnsembleSampler
+from src.inversion.objects.optimizer import MultistartOptimizer
+from src.inversion.objects.checkpoint import Checkpoint
+from src.inversion.objects.parallel import run_chains, chain_result, merge
+from src.inversion.objects.warm_start import WarmStart
 
 
 EXAMPLE = """
         run_inversion.py --folder CampiFlegrei --satellite Csk  -model mogi spheroid --show
+        run_inversion.py --folder CampiFlegrei --satellite Sen --model mogi --engine native --linear
+        run_inversion.py --folder CampiFlegrei --satellite Sen --model okada --sampling_id 2 --starts 64
+        run_inversion.py --folder CampiFlegrei --satellite Sen --model mogi penny --engine native --sampling_id 1 --burn-in 20000 --rhat 1.02
+        run_inversion.py --folder CampiFlegrei --satellite Sen --model mogi --engine native --sampling_id 1 --chains 8 --jobs 8
+        run_inversion.py --folder CampiFlegrei --satellite Sen --model mogi --engine native --period 20200101:20200301 20200301:20200501 --sequential
         run_inversion.py --folder /path/to/folder --satellite Sen --txt-file template.txt --shear 0.5 --poisson 0.25 --x-range 0 100 --y-range 0 200 --z-range 0 5000 --model mogi --mogi-volume 1.e6 2.e7 --sampling_id 0 --weight-sar 1.0 --weight-gps 0.0 --show
 """
 
 
-def create_parser():
+def add_sampler_arguments(parser):
+    """Options of the sampling, shared by the parsers of the stages that run an inversion."""
+    parser.add_argument('--no-cache', action='store_true', help="Run the inversion even if its inputs and template did not change.")
+    parser.add_argument('--sampling_id', type=str, choices=['0', '1', '2'], default='0', help="Sampling ID, 0 for Natural Neighbor 1 for Bayesian, 2 for multistart L-BFGS-B\nwith the native engine (default: %(default)s).")
+    parser.add_argument('--engine', type=str, choices=['vsm', 'native'], default='vsm', help="Run the sampling with VSM or with the native forward models (default: %(default)s).")
+    parser.add_argument('--linear', action='store_true', help="Solve the parameters the data are linear in (volume, dP_mu, moment, slip, opening) by bounded\nleast squares for every sample instead of sampling them, native engine only.")
+    parser.add_argument('--seed', type=int, default=None, help="Seed of the native samplers (default: %(default)s).")
+    parser.add_argument('--starts', type=int, default=32, help="Number of starting points of the multistart optimizer (default: %(default)s).")
+    parser.add_argument('--greens', action='store_true', help="Interpolate the responses of sources with fixed shape from Green's function tables\ncached per point set and reused across periods, native engine only.")
+    parser.add_argument('--checkpoint-interval', type=float, default=600., help="Seconds between two snapshots of the native sampler state, a killed run\nresumes from the last one (default: %(default)s).")
+    parser.add_argument('--greens-shape', type=int, nargs=3, default=[41, 41, 21], metavar=('NX', 'NY', 'NZ'), help="Nodes of the Green's function position grid (default: %(default)s).")
+    parser.add_argument('--greens-max-size', type=float, default=2048., help="Largest Green's function table [MB], sources of larger ones are evaluated directly\n(default: %(default)s).")
+
+    # Sampler budget, maxima when stopping early
+    parser.add_argument('--samples', type=int, default=1000, help="Neighbourhood algorithm models per iteration (default: %(default)s).")
+    parser.add_argument('--resample', type=int, default=300, help="Neighbourhood algorithm best cells resampled per iteration (default: %(default)s).")
+    parser.add_argument('--iterations', type=int, default=12, help="Neighbourhood algorithm iterations (default: %(default)s).")
+    parser.add_argument('--steps', type=int, default=None, help="Bayesian steps kept after the burn-in (default: 1000 with the native engine, the\n--iterations of the VSM template otherwise).")
+    parser.add_argument('--burn-in', type=int, default=5000, help="Bayesian burn-in steps (default: %(default)s).")
+    parser.add_argument('--walkers', type=int, default=32, help="Walkers of the native Bayesian sampler (default: %(default)s).")
+
+    # Early stopping of the native samplers
+    parser.add_argument('--rhat', type=float, default=1.05, help="Bayesian sampling stops once the split R-hat of every parameter is below this\n(default: %(default)s).")
+    parser.add_argument('--min-ess', type=float, default=400, help="and the effective sample size of every parameter above this (default: %(default)s).")
+    parser.add_argument('--plateau', type=float, default=1e-3, help="Neighbourhood algorithm stops once the mean misfit of the resampled cells improved\nby less than this relative over --patience iterations (default: %(default)s).")
+    parser.add_argument('--patience', type=int, default=2, help="Iterations of the misfit plateau (default: %(default)s).")
+    parser.add_argument('--no-early-stop', action='store_true', help="Spend the whole budget, the convergence report is still written.")
+
+    # Independent chains of the native samplers
+    parser.add_argument('--chains', type=int, default=1, help="Independent chains or restarts with different seeds, merged into one posterior\nand one best fit (default: %(default)s).")
+    parser.add_argument('--jobs', type=int, default=None, help="Worker processes running the chains, each logging to VSM_chain_<k>.log\n(default: the chains, at most the number of cores).")
+
+
+def create_parser(iargs=None):
     synopsis = 'Plotting of InSAR, GPS and Seismicity data'
     epilog = EXAMPLE
     parser = argparse.ArgumentParser(description=synopsis, epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
@@ -37,7 +87,12 @@ def create_parser():
     parser.add_argument('--weight-gps', type=float, default=0.0, help="Weight for GPS data (default: 1.0).")
     parser.add_argument('--show', action='store_true', help="Show the plot.")
     parser.add_argument('--period', nargs='*', metavar='YYYYMMDD:YYYYMMDD, YYYYMMDD,YYYYMMDD', type=str, help='Period of the search')
-    parser.add_argument('--sampling_id', type=str, choices=['0', '1'], default='0', help="Sampling ID, 0 for Natural Neighbor 1 for Bayesian (default: %(default)s).")
+    add_sampler_arguments(parser)
+
+    # Sequential inversion of the periods
+    parser.add_argument('--sequential', action='store_true', help="Narrow the ranges of every period around the posterior of the previous one\nand seed its sampler with it, native engine only.")
+    parser.add_argument('--warm-from', type=str, default=None, help="Output folder of the period before the first one, warm starting it with --sequential.")
+    parser.add_argument('--inflation', type=float, default=2.0, help="Factor applied to the extent of the previous posterior around its best fit,\nroom for a migrating source (default: %(default)s).")
 
     # Mogi parameters
     parser.add_argument('--mogi-volume', type=float, nargs=2, default=[1e6, 2e7], help="Mogi volume range (default: %(default)s).")
@@ -53,6 +108,10 @@ def create_parser():
     parser.add_argument('--spheroid-semi-axis', type=float, nargs=2, default=[500, 3000], help="Spheroid semi-axis range (default: %(default)s).")
     parser.add_argument('--spheroid-dp_mu', type=float, nargs=2, default=[0.0001, 0.01], help="Spheroid dp/mu range (default: %(default)s).")
 
+    # Moment tensor, over shear modulus
+    for component in ['xx', 'yy', 'zz', 'xy', 'xz', 'yz']:
+        parser.add_argument(f'--moment-m{component}', type=float, nargs=2, default=[-1e8, 1e8], help=f"Moment M{component}/mu range (m^3) (default: %(default)s).")
+
     # Okada / Dislocation (model id = 5 R)
     parser.add_argument('--okada-length', type=float, nargs=2, default=[0, 5000], help="Fault length range (meters) (default: %(default)s).")
     parser.add_argument('--okada-width', type=float, nargs=2, default=[0, 5000], help="Fault width range (meters) (default: %(default)s).")
@@ -63,7 +122,7 @@ def create_parser():
     parser.add_argument('--okada-opening', type=float, nargs=2, default=[0.0, 1.0], help="Opening displacement range (meters) (default: %(default)s).")
 
     # Parse arguments
-    inps = parser.parse_args()
+    inps = parser.parse_args(iargs)
 
     inps.folder_path = inps.folder if SCRATCHDIR in inps.folder else os.path.join(SCRATCHDIR, inps.folder)
 
@@ -88,6 +147,16 @@ def create_parser():
     return inps
 
 
+# Relative interpolation error of the Green's function tables above which the user is told to refine them
+GREENS_TOLERANCE = 0.01
+
+# Command line options of the MODEL_DEFS parameters named differently
+OPTION_NAMES = {
+    ('spheroid', 'ratio'): 'axis_ratio',
+    ('spheroid', 'a'): 'semi_axis',
+}
+
+
 def extract_model_parameters(inps):
     model_dict = {}
 
@@ -101,7 +170,8 @@ def extract_model_parameters(inps):
 
         param_values = []
         for param in param_keys:
-            val = getattr(inps, f'{model}_{param}', None)
+            option = OPTION_NAMES.get((model, param), param)
+            val = getattr(inps, f'{model}_{option}'.lower(), None)
             if val is None:
                 raise ValueError(f'Missing parameter --{model}-{param}')
             param_values.append(val)
@@ -138,20 +208,274 @@ def run_vsm(inps, output_folder, input_sar, model_inputs):
         models=model_inputs,
         sampling_id=inps.sampling_id,
         weight_sar=inps.weight_sar,
-        weight_gps=inps.weight_gps
+        weight_gps=inps.weight_gps,
+        samples=getattr(inps, 'samples', 1000),
+        resample=getattr(inps, 'resample', 300),
+        # The third sampling line holds the NA iterations or the Bayesian steps, --steps only when given
+        iterations=inps.steps if inps.sampling_id == '1' and getattr(inps, 'steps', None) else getattr(inps, 'iterations', 12),
+        burn_in=getattr(inps, 'burn_in', 5000)
     )
 
-    if not glob.glob(os.path.join(output_folder, 'VSM_synth_*.csv')):
+    # The template holds every setting of the run, the data files are identified by size and mtime
+    with open(inps.txt_file, 'r') as f:
+        params = {'template': f.read()}
+    key = cache.unit_key(input_sar.split(), params)
+    base = os.path.join(output_folder, 'VSM')
+
+    if getattr(inps, 'no_cache', False) or not cache.is_fresh(base, key):
+        import VSM
+
         VSM.read_VSM_settings(inps.txt_file)
         VSM.iVSM()
+
+        outputs = glob.glob(os.path.join(output_folder, 'VSM_synth_*.csv')) + [os.path.join(output_folder, 'VSM_best.csv')]
+        cache.record(base, key, outputs=outputs, params=params)
     else:
         print("#" * 50)
-        print("VSM_synth already exists, skipping inversion.\n")
+        print("Inversion inputs unchanged, skipping inversion.\n")
 
     print("#" * 50)
     print("Inversion completed with VSM.\n")
 
 
+def inversion_sources(inps, model_inputs):
+    """Sources of the native inversion, (model, ranges) with the ranges of forward.param_names(model)."""
+    sources = []
+    for info in model_inputs.values():
+        ranges = dict(zip(forward.POSITION_PARAMS, [inps.x_range, inps.y_range, inps.z_range]))
+        ranges.update(zip(MODEL_DEFS[info['name']]['params'], info['params']))
+
+        # Finite sources of the native engine are point-source approximations, sampled only deep enough
+        clipped = forward.far_field_ranges(info['name'], ranges)
+        if clipped is not ranges:
+            print("#" * 50)
+            print(f"Depth range of {info['name']} raised to {clipped['depth']}, where its point-source approximation holds.\n")
+        sources.append((info['name'], clipped))
+
+    return sources
+
+
+def dataset_name(file):
+    """Name of the point dataset of a file, the suffix of its VSM_synth_*.csv."""
+    return os.path.basename(file).replace(POINTS_EXT, '').replace('.csv', '')
+
+
+def write_results(problem, params, output_folder, names):
+    """Best model and synthetics in the layout of VSM, VSM_best.csv and one VSM_synth_<name>.csv per dataset."""
+    pd.DataFrame([params], columns=problem.names).to_csv(os.path.join(output_folder, 'VSM_best.csv'), index=False)
+
+    synth = problem.synthetic(params)
+    outputs = [os.path.join(output_folder, 'VSM_best.csv')]
+    for i, name in enumerate(names):
+        out_file = os.path.join(output_folder, f'VSM_synth_{name}.csv')
+        keep = problem.dataset == i
+
+        pd.DataFrame({'east': problem.x[keep], 'north': problem.y[keep], 'synth': synth[keep], 'data': problem.d[keep]}).to_csv(out_file, index=False)
+        outputs.append(out_file)
+
+    return outputs
+
+
+def sampler_budget(inps):
+    """Budget and early-stopping settings of the native samplers, the defaults of create_parser when missing."""
+    early = not getattr(inps, 'no_early_stop', False)
+    return {
+        'samples': getattr(inps, 'samples', 1000),
+        'resample': getattr(inps, 'resample', 300),
+        'iterations': getattr(inps, 'iterations', 12),
+        'steps': getattr(inps, 'steps', None) or 1000,
+        'burn_in': getattr(inps, 'burn_in', 5000),
+        'walkers': getattr(inps, 'walkers', 32),
+        'starts': getattr(inps, 'starts', 32),
+        'rhat': getattr(inps, 'rhat', 1.05) if early else None,
+        'min_ess': getattr(inps, 'min_ess', 400),
+        'plateau': getattr(inps, 'plateau', 1e-3) if early else None,
+        'patience': getattr(inps, 'patience', 2),
+    }
+
+
+def create_sampler(problem, sampling_id, budget, seed=None, init=None):
+    """Native sampler of 'sampling_id', 0 neighbourhood algorithm, 1 ensemble sampler, 2 multistart L-BFGS-B,
+    its initial population seeded with the models 'init' if any."""
+    if sampling_id == '0':
+        return NeighbourhoodAlgorithm(problem, n_samples=budget['samples'], n_resample=budget['resample'], n_iterations=budget['iterations'],
+                                      plateau_tol=budget['plateau'], patience=budget['patience'], init=init, seed=seed)
+    if sampling_id == '1':
+        return EnsembleSampler(problem, n_walkers=budget['walkers'], n_steps=budget['steps'], burn_in=budget['burn_in'],
+                               rhat=budget['rhat'], min_ess=budget['min_ess'], init=init, seed=seed)
+    return MultistartOptimizer(problem, n_starts=budget['starts'], init=init, seed=seed)
+
+
+def write_posterior(posterior, output_folder):
+    """Samples of every chain with their misfit, VSM_posterior.csv next to VSM_best.csv."""
+    out_file = os.path.join(output_folder, 'VSM_posterior.csv')
+    pd.DataFrame(posterior).to_csv(out_file, index=False)
+
+    return out_file
+
+
+def write_convergence(report, output_folder):
+    """Convergence report of the sampler, VSM_convergence.json next to VSM_best.csv."""
+    out_file = os.path.join(output_folder, 'VSM_convergence.json')
+    with open(out_file, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    return out_file
+
+
+def sample(inps, problem, budget, key, output_folder, greens=None, init=None):
+    """Run the native sampler of inps.sampling_id on 'problem', in inps.chains chains, see parallel.merge.
+    Returns:    best, misfit, posterior, report - merged result of the chains
+                checkpoints                     - list of str, snapshot files to remove once the result is saved
+    """
+    seed = getattr(inps, 'seed', None)
+    chains = getattr(inps, 'chains', 1)
+    factory = partial(create_sampler, sampling_id=inps.sampling_id, budget=budget, init=init)
+    interval = getattr(inps, 'checkpoint_interval', 600.)
+
+    # Snapshots of the same run, left by a killed job, are picked up where they stopped
+    if chains > 1:
+        jobs = getattr(inps, 'jobs', None) or min(chains, os.cpu_count())
+        checkpoints = [os.path.join(output_folder, f'VSM_checkpoint_{k}.npz') for k in range(chains)]
+        print("#" * 50)
+        print(f"Running {chains} chains on {jobs} processes.\n")
+
+        results = run_chains(problem, factory, np.random.SeedSequence(seed).spawn(chains), jobs,
+                             (os.path.join(output_folder, 'VSM_checkpoint_{k}.npz'), key, interval),
+                             os.path.join(output_folder, 'VSM_chain_{k}.log'), greens=greens)
+    else:
+        sampler = factory(problem, seed=seed)
+        checkpoint = Checkpoint(os.path.join(output_folder, 'VSM_checkpoint.npz'), key, interval=interval)
+        checkpoint.load(sampler)
+        with checkpoint.sigterm():
+            sampler.run(callback=checkpoint)
+        checkpoints = [checkpoint.file]
+        results = [chain_result(sampler)]
+
+    return (*merge(problem, results), checkpoints)
+
+
+def print_greens_error(model, depth, error):
+    """Report the interpolation error of a Green's function table and the depths it is accurate below."""
+    print("#" * 50)
+    print(f"Green's function table of {model}, interpolation error at cell centres over the peak response: "
+          f"median {np.median(error):.2%}, largest {np.max(error):.2%}.")
+
+    inaccurate = depth[error > GREENS_TOLERANCE]
+    if len(inaccurate):
+        where = "at every depth" if inaccurate.max() == depth.max() else f"for sources down to {inaccurate.max():.0f} m deep"
+        print(f"Above {GREENS_TOLERANCE:.0%} {where}, the fits there are biased: "
+              f"refine --greens-shape, narrow the ranges or drop --greens.")
+    print()
+
+
+def invert(inps, points, full_sources, key, output_folder, warm=None, greens=None):
+    """Native inversion of point datasets held in memory, the ranges narrowed around a WarmStart and
+    widened again while the best fit lies against a narrowed bound. Only checkpoints and chain logs go
+    to output_folder, the results are returned.
+    Parameters: points       - list of dict of np.ndarray, point datasets with the h5_functions.COLUMNS
+                full_sources - list of (model, ranges), see inversion_sources
+                key          - str, key of the run, restores the checkpoints of the same run only
+                greens       - list of int, shape of the Green's function tables, None without
+    Returns:    problem                        - Problem of the last attempt
+                best, misfit, posterior, report - merged result of the chains, see parallel.merge
+                checkpoints                    - list of str, snapshot files to remove once the result is saved
+    """
+    sources = full_sources if warm is None else warm.narrow(full_sources)
+    linear = getattr(inps, 'linear', False)
+    budget = sampler_budget(inps)
+    # Tables span the full ranges and are keyed by the point set, every period of the same tracks shares them
+    greens = (os.path.join(inps.folder_path, 'greens'), greens, full_sources, getattr(inps, 'greens_max_size', None)) if greens else None
+
+    for attempt in itertools.count():
+        if warm is not None:
+            print("#" * 50)
+            print(f"Ranges narrowed around the previous period: {sources}\n")
+
+        problem = Problem(points, sources, weights=[inps.weight_sar] * len(points), nu=inps.nu, linear=linear)
+        if greens:
+            tabulated = problem.use_greens(*greens)
+            print("#" * 50)
+            print(f"Green's function tables used for: {tabulated or 'none, every source has free shape parameters or too large a table'}\n")
+
+            for model, (depth, error) in problem.greens_error().items():
+                print_greens_error(model, depth, error)
+
+        print("#" * 50)
+        print(f"Sampling {problem.dim} of {len(problem.names)} parameters: {[problem.names[i] for i in problem.free]}\n")
+
+        init = warm.init(problem) if warm is not None else None
+        best, misfit, posterior, report, checkpoints = sample(inps, problem, budget, key if not attempt else f'{key}:{attempt}',
+                                                              output_folder, greens=greens, init=init)
+
+        # A best fit against a narrowed bound means the source moved further, the period is run again wider
+        hit = warm.at_bound(full_sources, sources, dict(zip(problem.names, best))) if warm is not None else []
+        if not hit:
+            return problem, best, misfit, posterior, report, checkpoints
+
+        for file in checkpoints:
+            if os.path.exists(file):
+                os.remove(file)
+
+        warm = warm.widen()
+        sources = warm.narrow(full_sources)
+        print("#" * 50)
+        print(f"Best fit at the narrowed bound of {hit}, inflation raised to {warm.inflation:g}.\n")
+
+
+def run_native(inps, output_folder, input_sar, model_inputs, warm=None):
+    """Inversion with the native forward models and samplers, same outputs as run_vsm,
+    warm started from the previous period with a WarmStart."""
+    files = input_sar.split()
+    full_sources = inversion_sources(inps, model_inputs)
+    sources = full_sources if warm is None else warm.narrow(full_sources)
+    linear = getattr(inps, 'linear', False)
+    budget = sampler_budget(inps)
+
+    params = {
+        'engine': 'native',
+        'sources': full_sources,
+        'sampling_id': inps.sampling_id,
+        'linear': linear,
+        'seed': getattr(inps, 'seed', None),
+        'budget': budget,
+        'chains': getattr(inps, 'chains', 1),
+        # The warm start depends on the previous period through the narrowed ranges
+        'warm': {'sources': sources, 'inflation': warm.inflation} if warm is not None else None,
+        'greens': list(inps.greens_shape) if getattr(inps, 'greens', False) else None,
+        'greens_max_size': getattr(inps, 'greens_max_size', None) if getattr(inps, 'greens', False) else None,
+        'nu': inps.nu,
+        'weight_sar': inps.weight_sar,
+    }
+    key = cache.unit_key(files, params)
+    base = os.path.join(output_folder, 'VSM')
+
+    if getattr(inps, 'no_cache', False) or not cache.is_fresh(base, key):
+        points = [read_points(f) for f in files]
+        problem, best, misfit, posterior, report, checkpoints = invert(inps, points, full_sources, key, output_folder,
+                                                                       warm=warm, greens=params['greens'])
+
+        outputs = write_results(problem, best, output_folder, [dataset_name(f) for f in files])
+        outputs.append(write_posterior(posterior, output_folder))
+        outputs.append(write_convergence(report, output_folder))
+        cache.record(base, key, outputs=outputs, params=params)
+
+        for file in checkpoints:
+            if os.path.exists(file):
+                os.remove(file)
+
+        print("#" * 50)
+        print(f"Best misfit {misfit:.6g}: {dict(zip(problem.names, best.tolist()))}\n")
+        print("#" * 50)
+        print(f"{report['evaluations']} forward evaluations in {report['iterations']} of at most {report['max_iterations']} iterations, converged: {report['converged']}\n")
+    else:
+        print("#" * 50)
+        print("Inversion inputs unchanged, skipping inversion.\n")
+
+    print("#" * 50)
+    print("Inversion completed with the native engine.\n")
+
+
 def plot_results(inps, output_folder):
     for file in os.listdir(output_folder):
         if 'VSM_synth' in file and file.endswith('.csv'):
@@ -166,6 +490,14 @@ def main(iargs=None):
     print()
 
     inps = create_parser() if not isinstance(iargs, argparse.Namespace) else iargs
+    # The multistart optimizer only exists in the native engine
+    engine = 'native' if inps.sampling_id == '2' else getattr(inps, 'engine', 'vsm')
+    run = run_native if engine == 'native' else run_vsm
+
+    sequential = getattr(inps, 'sequential', False)
+    if sequential and engine != 'native':
+        print("Sequential periods need the native engine, every period is inverted over the full ranges.\n")
+        sequential = False
 
     if inps.satellite:
         pattern = f"({'|'.join([f'{inps.satellite}[AD]T?'])})\\d+"
@@ -174,15 +506,24 @@ def main(iargs=None):
 
         def gather_input_sar(base_folder, match_str):
             input_sar = ''
-            for f in os.listdir(base_folder):
-                if f.endswith('.csv') and match_str in f:
-                    input_sar += os.path.join(base_folder, f) + ' '
-                    df = pd.read_csv(os.path.join(base_folder, f))
-                    inps.x_range = define_range(inps.x_range, df['xx'])
-                    inps.y_range = define_range(inps.y_range, df['yy'])
+            for f in point_files(base_folder, match_str):
+                if f.endswith(POINTS_EXT):
+                    # Bounds are stored with the points, VSM reads a CSV export
+                    meta = points_metadata(f)
+                    xx, yy = np.array([meta['X_MIN'], meta['X_MAX']]), np.array([meta['Y_MIN'], meta['Y_MAX']])
+                    if engine == 'vsm':
+                        f = export_csv(f)
+                else:
+                    df = pd.read_csv(f, usecols=['xx', 'yy'])
+                    xx, yy = df['xx'], df['yy']
+
+                input_sar += f + ' '
+                inps.x_range = define_range(inps.x_range, xx)
+                inps.y_range = define_range(inps.y_range, yy)
             return input_sar
 
         if inps.period_folder:
+            warm = WarmStart.load(inps.warm_from, inflation=getattr(inps, 'inflation', 2.0)) if sequential and getattr(inps, 'warm_from', None) else None
             for period in inps.period_folder:
                 input_sar = ''
                 for folder in folder_list:
@@ -200,7 +541,15 @@ def main(iargs=None):
                         input_sar += gather_input_sar(period_folder, match.group(0))
 
                 model_inputs = extract_model_parameters(inps)
-                run_vsm(inps, output_folder, input_sar, model_inputs)
+                if warm is not None:
+                    run_native(inps, output_folder, input_sar, model_inputs, warm=warm)
+                else:
+                    run(inps, output_folder, input_sar, model_inputs)
+
+                # The result of this period narrows the next one
+                if sequential:
+                    warm = WarmStart.load(output_folder, inflation=getattr(inps, 'inflation', 2.0))
+
                 if inps.show:
                     plot_results(inps, output_folder)
 
@@ -213,7 +562,7 @@ def main(iargs=None):
                     input_sar += gather_input_sar(input_folder, match.group(0))
 
             model_inputs = extract_model_parameters(inps)
-            run_vsm(inps, inps.folder_path, input_sar, model_inputs)
+            run(inps, inps.folder_path, input_sar, model_inputs)
             if inps.show:
                 plot_results(inps, inps.folder_path)
 
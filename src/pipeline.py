@@ -0,0 +1,203 @@
+import os
+import re
+import copy
+import shlex
+import pandas as pd
+from src.shared import cache
+from src.shared.h5_functions import POINTS_EXT, displacement_h5
+from src.downsample import run_downsample
+from src.inversion import run_inversion
+from src.inversion.objects.warm_start import WarmStart
+from src.simulation import run_simulation
+
+# Options of the inversion that do not change its result, left out of the cache key
+INVERSION_IGNORED = ['show', 'jobs', 'no_cache', 'warm_from', 'txt_file', 'checkpoint_interval']
+
+
+def downsample_points(inps, units, save=False):
+    """Downsample (track, period) units in memory.
+    Parameters: inps  - Namespace, see run_downsample.create_parser
+                units - list of (input_folder, period_folder, node, out_file), see run_downsample.find_units
+                save  - bool, also write the points of every unit as run_downsample does
+    Returns:    dict, name of the dataset (basename of out_file) -> point dataset, dict of the h5_functions.COLUMNS
+    """
+    points = {}
+    for input_folder, period_folder, node, out_file in units:
+        velocity_file, geom_file = run_downsample.input_files(input_folder, period_folder)
+        mask_file = run_downsample.covariance_mask_file(input_folder, period_folder, inps.covariance_mask) if inps.covariance else []
+
+        down, metadata = run_downsample.open_unit(velocity_file[0], geom_file[0], inps, mask_file=(mask_file or [None])[0])
+        run_downsample.downsample(down, inps)
+        points[os.path.basename(out_file)] = down.points()
+
+        if save:
+            run_downsample.save_points(down, out_file, inps, metadata)
+
+    return points
+
+
+def invert_points(inps, points, output_folder, key, warm=None):
+    """Native inversion of point datasets held in memory, writing its results as run_inversion does.
+    Parameters: inps          - Namespace, see run_inversion.create_parser
+                points        - dict, name of the dataset -> point dataset
+                output_folder - str, folder of VSM_best.csv and the other results
+                key           - str, key of the run (see cache.unit_key), the results are kept while it holds
+                warm          - WarmStart, previous period of a sequential inversion
+    Returns:    WarmStart, best fit and posterior of the inversion, read back if it was up to date
+    """
+    base = os.path.join(output_folder, 'VSM')
+    inflation = getattr(inps, 'inflation', 2.0)
+
+    if not getattr(inps, 'no_cache', False) and cache.is_fresh(base, key):
+        print("#" * 50)
+        print("Inversion inputs unchanged, skipping inversion.\n")
+        return WarmStart.load(output_folder, inflation=inflation)
+
+    # Ranges spanning every point, as run_inversion gets from the point files
+    inps = copy.deepcopy(inps)
+    for p in points.values():
+        if len(p['xx']):
+            inps.x_range = run_inversion.define_range(inps.x_range, p['xx'])
+            inps.y_range = run_inversion.define_range(inps.y_range, p['yy'])
+
+    os.makedirs(output_folder, exist_ok=True)
+    full_sources = run_inversion.inversion_sources(inps, run_inversion.extract_model_parameters(inps))
+    greens = list(inps.greens_shape) if getattr(inps, 'greens', False) else None
+    problem, best, misfit, posterior, report, checkpoints = run_inversion.invert(inps, list(points.values()), full_sources, key,
+                                                                                 output_folder, warm=warm, greens=greens)
+
+    outputs = run_inversion.write_results(problem, best, output_folder, list(points))
+    outputs.append(run_inversion.write_posterior(posterior, output_folder))
+    outputs.append(run_inversion.write_convergence(report, output_folder))
+    cache.record(base, key, outputs=outputs, params={'sources': full_sources})
+
+    for file in checkpoints:
+        if os.path.exists(file):
+            os.remove(file)
+
+    print("#" * 50)
+    print(f"Best misfit {misfit:.6g}: {dict(zip(problem.names, best.tolist()))}\n")
+
+    return WarmStart(pd.Series(best, index=problem.names), pd.DataFrame(posterior), inflation=inflation)
+
+
+def simulate_points(inps, points, best, save_folder=None):
+    """Points simulated from a best fit, see run_simulation.simulate_points.
+    Parameters: points      - dict, name of the dataset -> point dataset
+                best        - pd.Series, best fit of the inversion
+                save_folder - dict, name of the dataset -> folder the simulated points are written to, None to keep them in memory
+    Returns:    dict, name of the dataset -> simulated point dataset
+    """
+    simulated = {}
+    for name, p in points.items():
+        simulated[name] = run_simulation.simulate_points(inps, p, best.to_dict())
+
+        if save_folder:
+            os.makedirs(save_folder[name], exist_ok=True)
+            sim = simulated[name]
+            displacement_h5(file=os.path.join(save_folder[name], name + POINTS_EXT), x=sim['xx'], y=sim['yy'], z=sim['dd'],
+                            err=sim['ee'], lose=sim['lx'], losn=sim['ly'], losz=sim['lz'])
+
+    return simulated
+
+
+def result_files(output_folder):
+    """Best fit and, if any, posterior of the inversion in output_folder, the files a warm start reads."""
+    files = [os.path.join(output_folder, f) for f in ['VSM_best.csv', 'VSM_posterior.csv']]
+    return [f for f in files if os.path.exists(f)]
+
+
+def period_units(units, period, satellite):
+    """Units of 'period' (None for the track folders) whose track is of 'satellite'."""
+    regex = re.compile(f"({satellite}[AD]T?)\\d+")
+    return [u for u in units if regex.match(u[2]) and
+            (os.path.basename(u[1]) == period if period else u[0] == u[1])]
+
+
+def run(template, save_points=False):
+    """Downsample, invert and optionally check by simulation every period in this process, the points
+    passed between the stages as arrays.
+
+    Only the results of the inversions (VSM_best.csv, VSM_synth_*.csv, VSM_posterior.csv and
+    VSM_convergence.json) are written, the points of the downsample and of the simulation only with
+    'save_points'. The units are downsampled period by period, so that the points of one period only
+    are held at once. A period whose velocity and geometry files and arguments did not change since its
+    last run is skipped, its downsample included. The inversions use the native engine, VSM reads its
+    inputs from files.
+    Parameters: template    - dict, arguments of the stages, see run_all.load_template
+                save_points - bool, also write the downsampled and simulated points
+    Returns:    dict, period (None without periods) -> pd.Series, best fit of its inversion
+    """
+    # Older templates name the downsample stage 'decomposition'
+    downsample_args = template.get("downsample", template.get("decomposition", ""))
+    inversion_args = template.get("inversion", "")
+    simulation_args = template.get("simulation")
+
+    down = run_downsample.create_parser(shlex.split(downsample_args))
+    units = run_downsample.find_units(down)
+    if not down.utm_zone:
+        down.utm_zone = run_downsample.shared_utm_zone(units)
+
+    inv = run_inversion.create_parser(shlex.split(inversion_args))
+    sim = run_simulation.create_parser(shlex.split(simulation_args)) if simulation_args is not None else None
+    for inps in [inv, sim]:
+        if inps is not None and inps.sampling_id != '2' and inps.engine != 'native':
+            raise ValueError("The in-memory pipeline inverts with the native engine, add --engine native to the inversion and simulation arguments")
+
+    inv_params = {k: v for k, v in sorted(vars(inv).items()) if k not in INVERSION_IGNORED}
+    sequential = getattr(inv, 'sequential', False)
+    warm_folder = inv.warm_from if sequential else None
+    warm = WarmStart.load(warm_folder, inflation=inv.inflation) if warm_folder else None
+
+    results = {}
+    for period in inv.period_folder or [None]:
+        units_of_period = period_units(units, period, inv.satellite)
+        if not units_of_period:
+            print(f"No track of {inv.satellite} for period {period}.")
+            continue
+
+        # Keyed by the files the downsample reads, a fresh inversion skips the downsample as well,
+        # and by the results the warm start reads, which are only rewritten when the previous period runs again
+        files = [f for u in units_of_period for f in sum(run_downsample.input_files(*u[:2]), [])]
+        if down.covariance:
+            files += [f for u in units_of_period for f in run_downsample.covariance_mask_file(*u[:2], down.covariance_mask)]
+        params = {'downsample': run_downsample.cache_params(down), 'inversion': inv_params}
+        key = cache.unit_key(files + (result_files(warm_folder) if warm is not None else []), params)
+        output_folder = os.path.join(inv.folder_path, period) if period else inv.folder_path
+
+        print("#" * 50)
+        print(f"Period {period or 'all'}: {len(units_of_period)} tracks.\n")
+
+        points = None
+        if getattr(inv, 'no_cache', False) or not cache.is_fresh(os.path.join(output_folder, 'VSM'), key):
+            points = downsample_points(down, units_of_period, save=save_points)
+
+        result = invert_points(inv, points, output_folder, key, warm=warm if sequential else None)
+        results[period] = result.best
+        if sequential:
+            warm, warm_folder = result, output_folder
+
+        if sim is not None:
+            sim_folder = os.path.join(sim.folder_path, 'simulation')
+            sim_out_folder = os.path.join(sim_folder, period) if period else sim_folder
+            sim_inps = copy.deepcopy(sim)
+            sim_inps.folder_path = sim_folder
+            sim_key = cache.unit_key(files + result_files(output_folder)[:1],
+                                     {'downsample': params['downsample'],
+                                      'simulation': {k: v for k, v in sorted(vars(sim).items()) if k not in INVERSION_IGNORED}})
+
+            if getattr(sim, 'no_cache', False) or not cache.is_fresh(os.path.join(sim_out_folder, 'VSM'), sim_key):
+                if points is None:
+                    points = downsample_points(down, units_of_period, save=save_points)
+                save_folder = {os.path.basename(u[3]): os.path.join(sim_folder, u[2], period) if period else os.path.join(sim_folder, u[2])
+                               for u in units_of_period} if save_points else None
+
+                simulated = simulate_points(sim_inps, points, result.best, save_folder=save_folder)
+                invert_points(sim_inps, simulated, sim_out_folder, sim_key)
+            else:
+                print("#" * 50)
+                print("Simulation inputs unchanged, skipping simulation.\n")
+
+            run_simulation.compare(sim_out_folder)
+
+    return results
@@ -0,0 +1,63 @@
+import os
+import json
+import hashlib
+
+# Bump when the content of the outputs changes for the same inputs and parameters
+CACHE_VERSION = 2
+
+
+def file_signature(path, content=False):
+    """Identify an input file by size and modification time, or by the sha256 of its content."""
+    stat = os.stat(path)
+    signature = {'path': os.path.abspath(path), 'size': stat.st_size}
+
+    if content:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        signature['sha256'] = sha.hexdigest()
+    else:
+        signature['mtime_ns'] = stat.st_mtime_ns
+
+    return signature
+
+
+def unit_key(files, params, content=False):
+    """Key of a unit of work from its input files and the full set of parameters."""
+    description = {
+        'version': CACHE_VERSION,
+        'files': [file_signature(f, content=content) for f in files],
+        'params': params,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def manifest_file(base):
+    return base + '.manifest.json'
+
+
+def is_fresh(base, key):
+    """True if the manifest of 'base' was written for 'key' and all its outputs still exist."""
+    try:
+        with open(manifest_file(base), 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+    return manifest.get('key') == key and all(os.path.exists(o) for o in manifest.get('outputs', []))
+
+
+def record(base, key, outputs, params=None):
+    """Write the manifest of 'base' once its outputs are complete."""
+    manifest = {
+        'key': key,
+        'outputs': [os.path.abspath(o) for o in outputs],
+        'params': params,
+    }
+
+    # Write then rename, so an interrupted run never leaves a valid-looking manifest
+    tmp_file = manifest_file(base) + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True, default=str)
+    os.replace(tmp_file, manifest_file(base))
@@ -0,0 +1,411 @@
+import numpy as np
+from src.shared.helper_functions import MODEL_DEFS
+
+# Source position parameters shared by every model, followed by MODEL_DEFS[model]['params']
+POSITION_PARAMS = ['xcen', 'ycen', 'depth']
+
+# Number of (sample, point) pairs evaluated at once by batch()
+BATCH_SIZE = 2 ** 22
+
+# Point-source approximations of finite sources, (size parameter, smallest depth over size they hold for)
+FAR_FIELD = {
+    'penny': ('radius', 2.),
+    'spheroid': ('a', 2.),
+}
+
+
+def mogi(x, y, xcen, ycen, depth, volume, nu=0.25):
+    """Surface displacement of a point pressure source, Mogi (1958).
+    Parameters: x, y       - np.ndarray, observation coordinates [m]
+                xcen, ycen - float, source position [m]
+                depth      - float, source depth, positive down [m]
+                volume     - float, volume change [m^3]
+                nu         - float, Poisson ratio
+    Returns:    ux, uy, uz - np.ndarray, east/north/up displacement [m]
+    """
+    dx, dy = x - xcen, y - ycen
+    C = (1 - nu) * volume / np.pi / (dx ** 2 + dy ** 2 + depth ** 2) ** 1.5
+
+    return C * dx, C * dy, C * depth
+
+
+def point(x, y, xcen, ycen, depth, radius, dP_mu, nu=0.25):
+    """Pressurized sphere of finite radius, McTigue (1987).
+    Mogi's solution corrected to order (radius/depth)^3 for the size of the sphere,
+    accurate for radius/depth up to ~0.5.
+    Parameters: radius - float, sphere radius [m]
+                dP_mu  - float, excess pressure over shear modulus
+    """
+    dx, dy = x - xcen, y - ycen
+    R2 = dx ** 2 + dy ** 2 + depth ** 2
+    eps3 = (radius / depth) ** 3
+    correction = 1 + eps3 * (-(1 + nu) / (2 * (7 - 5 * nu)) + 15 * (2 - nu) * depth ** 2 / (4 * (7 - 5 * nu) * R2))
+    C = (1 - nu) * dP_mu * radius ** 3 / R2 ** 1.5 * correction
+
+    return C * dx, C * dy, C * depth
+
+
+def penny(x, y, xcen, ycen, depth, radius, dP_mu, nu=0.25):
+    """Horizontal pressurized penny-shaped crack, Fialko et al. (2001), as a point sill.
+    The crack is replaced by a horizontal tensile point source with the opening volume
+    of a penny crack in a full space, 8 (1 - nu) / 3 * radius^3 * dP_mu (Sneddon, 1946).
+    This is the far-field limit of Fialko et al., accurate for depth/radius above ~2 (see FAR_FIELD).
+    Parameters: radius - float, crack radius [m]
+                dP_mu  - float, excess pressure over shear modulus
+    """
+    potency = 8 * (1 - nu) / 3 * radius ** 3 * dP_mu
+    ux, uy, uz = _tensile_point(x - xcen, y - ycen, depth, 0., potency, nu)
+
+    return ux, uy, uz
+
+
+def spheroid(x, y, xcen, ycen, depth, strike, dip, ratio, a, dP_mu, nu=0.25):
+    """Pressurized prolate spheroid, Yang et al. (1988), as a point moment tensor.
+    The moment tensor is that of the equivalent Eshelby inclusion of the pressurized
+    cavity (Davis, 1986), the far-field limit of Yang et al., accurate for depth/a above ~2 (see FAR_FIELD).
+    Parameters: strike - float, azimuth of the major axis, clockwise from north [deg]
+                dip    - float, plunge of the major axis below the horizontal [deg]
+                ratio  - float, minor over major semi-axis, in (0, 1]
+                a      - float, major semi-axis [m]
+                dP_mu  - float, excess pressure over shear modulus
+    """
+    M = _spheroid_moment(strike, dip, ratio, a, dP_mu, nu)
+    return _moment_tensor(x - xcen, y - ycen, depth, M, nu)
+
+
+def moment(x, y, xcen, ycen, depth, Mxx, Myy, Mzz, Mxy, Mxz, Myz, nu=0.25):
+    """Point moment tensor source, Davis (1986).
+    Parameters: Mxx ... Myz - float, moment tensor over shear modulus [m^3], x east, y north, z up
+    """
+    Mxx, Myy, Mzz, Mxy, Mxz, Myz = np.broadcast_arrays(*[np.asarray(m, dtype=float) for m in [Mxx, Myy, Mzz, Mxy, Mxz, Myz]])
+    M = np.stack([np.stack([Mxx, Mxy, Mxz], -1),
+                  np.stack([Mxy, Myy, Myz], -1),
+                  np.stack([Mxz, Myz, Mzz], -1)], -2)
+
+    return _moment_tensor(x - xcen, y - ycen, depth, M, nu)
+
+
+def okada(x, y, xcen, ycen, depth, length, width, strike, dip, slip, rake, opening, nu=0.25):
+    """Rectangular dislocation, Okada (1985).
+    The position is the top left corner of the fault, as in VSM: the upper edge starts there
+    and runs 'length' along strike, the fault dips to the right of the strike direction.
+    Parameters: length, width - float, fault length along strike and width along dip [m]
+                strike        - float, clockwise from north [deg]
+                dip           - float, [deg]
+                slip, rake    - float, slip [m] and rake [deg] (Aki & Richards convention)
+                opening       - float, tensile opening [m]
+    """
+    dip_r = np.deg2rad(dip)
+    xl, yl = _local(x, y, xcen, ycen, strike)
+
+    # Okada's reference is the lower left corner, the top edge is 'width' up-dip of it
+    yl = yl + width * np.cos(dip_r)
+    d = depth + width * np.sin(dip_r)
+
+    U1, U2 = slip * np.cos(np.deg2rad(rake)), slip * np.sin(np.deg2rad(rake))
+    p = yl * np.cos(dip_r) + d * np.sin(dip_r)
+    q = yl * np.sin(dip_r) - d * np.cos(dip_r)
+
+    # Chinnery's notation f(x, p) - f(x, p - W) - f(x - L, p) + f(x - L, p - W)
+    u = [np.zeros(np.broadcast(xl, p, U1).shape) for _ in range(3)]
+    for xi, eta, sign in [(xl, p, 1), (xl, p - width, -1), (xl - length, p, -1), (xl - length, p - width, 1)]:
+        for i, c in enumerate(_okada_rectangle(xi, eta, q, dip_r, U1, U2, opening, nu)):
+            u[i] += sign * c
+
+    ux, uy = _global(u[0], u[1], strike)
+    return ux, uy, u[2]
+
+
+def _local(x, y, xcen, ycen, strike):
+    """Coordinates along strike and to the left of it, strike clockwise from north [deg]."""
+    s, c = np.sin(np.deg2rad(strike)), np.cos(np.deg2rad(strike))
+    dx, dy = x - xcen, y - ycen
+    return dx * s + dy * c, -dx * c + dy * s
+
+
+def _global(ux, uy, strike):
+    """East and north components of displacements along strike and to the left of it."""
+    s, c = np.sin(np.deg2rad(strike)), np.cos(np.deg2rad(strike))
+    return ux * s - uy * c, ux * c + uy * s
+
+
+def _okada_rectangle(xi, eta, q, dip, U1, U2, U3, nu):
+    """Surface displacement term f(xi, eta) of Okada (1985) eqs. (25)-(30), in the fault frame."""
+    cs, sn = np.cos(dip), np.sin(dip)
+    vertical = np.abs(cs) < 1e-6
+    cs_safe = np.where(vertical, 1., cs)
+    m = 1 - 2 * nu      # mu / (lambda + mu)
+
+    R = np.sqrt(xi ** 2 + eta ** 2 + q ** 2)
+    X = np.sqrt(xi ** 2 + q ** 2)
+    yb = eta * cs + q * sn
+    db = eta * sn - q * cs
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # R + eta and R + xi without cancellation, singular terms set to zero (Okada, 1985, sec. 6)
+        R_eta = np.where(eta >= 0, R + eta, (xi ** 2 + q ** 2) / (R - eta))
+        R_xi = np.where(xi >= 0, R + xi, (eta ** 2 + q ** 2) / (R - xi))
+        inv_R_eta = np.where(R_eta > 0, 1 / R_eta, 0.)
+        inv_R_xi = np.where(R_xi > 0, 1 / R_xi, 0.)
+        ln_R_eta = np.where(R_eta > 0, np.log(R_eta), -np.log(R - eta))
+
+        theta = np.where(q != 0, np.arctan(xi * eta / (q * R)), 0.)
+
+        I5 = np.where(xi != 0, m * 2 / cs_safe * np.arctan((eta * (X + q * cs) + X * (R + X) * sn) / (xi * (R + X) * cs_safe)), 0.)
+        I4 = m / cs_safe * (np.log(R + db) - sn * ln_R_eta)
+        I3 = m * (yb / (cs_safe * (R + db)) - ln_R_eta) + sn / cs_safe * I4
+        I1 = m * (-xi / (cs_safe * (R + db))) - sn / cs_safe * I5
+
+        # Vertical fault limits
+        I1 = np.where(vertical, -m / 2 * xi * q / (R + db) ** 2, I1)
+        I3 = np.where(vertical, m / 2 * (eta / (R + db) + yb * q / (R + db) ** 2 - ln_R_eta), I3)
+        I4 = np.where(vertical, -m * q / (R + db), I4)
+        I5 = np.where(vertical, -m * xi * sn / (R + db), I5)
+        I2 = m * (-ln_R_eta) - I3
+
+        qR_eta = q / R * inv_R_eta
+        qR_xi = q / R * inv_R_xi
+
+    ux = (-U1 * (xi * qR_eta + theta + I1 * sn)
+          - U2 * (q / R - I3 * sn * cs)
+          + U3 * (q * qR_eta - I3 * sn ** 2))
+    uy = (-U1 * (yb * qR_eta + q * cs * inv_R_eta + I2 * sn)
+          - U2 * (yb * qR_xi + cs * theta - I1 * sn * cs)
+          + U3 * (-db * qR_xi - sn * (xi * qR_eta - theta) - I1 * sn ** 2))
+    uz = (-U1 * (db * qR_eta + q * sn * inv_R_eta + I4 * sn)
+          - U2 * (db * qR_xi + sn * theta - I5 * sn * cs)
+          + U3 * (yb * qR_xi + cs * (xi * qR_eta - theta) - I5 * sn ** 2))
+
+    return ux / (2 * np.pi), uy / (2 * np.pi), uz / (2 * np.pi)
+
+
+def _tensile_point(x, y, d, dip, potency, nu, strike=0.):
+    """Tensile point source of Okada (1985) eqs. (8), (9) and (10) in global east/north/up components.
+    Parameters: x, y    - np.ndarray, coordinates relative to the epicenter [m]
+                d       - float, depth [m]
+                dip     - float, dip of the crack plane [rad]
+                potency - float, opening times area [m^3]
+                strike  - float, strike of the crack plane [rad]
+    """
+    s, c = np.sin(strike), np.cos(strike)
+    xl, yl = x * s + y * c, -x * c + y * s
+
+    cs, sn = np.cos(dip), np.sin(dip)
+    m = 1 - 2 * nu
+    R = np.sqrt(xl ** 2 + yl ** 2 + d ** 2)
+    q = yl * sn - d * cs
+
+    I1 = m * yl * (1 / (R * (R + d) ** 2) - xl ** 2 * (3 * R + d) / (R ** 3 * (R + d) ** 3))
+    I2 = m * xl * (1 / (R * (R + d) ** 2) - yl ** 2 * (3 * R + d) / (R ** 3 * (R + d) ** 3))
+    I3 = m * xl / R ** 3 - I2
+    I5 = m * (1 / (R * (R + d)) - xl ** 2 * (2 * R + d) / (R ** 3 * (R + d) ** 2))
+
+    C = potency / (2 * np.pi)
+    ux = C * (3 * xl * q ** 2 / R ** 5 - I3 * sn ** 2)
+    uy = C * (3 * yl * q ** 2 / R ** 5 - I1 * sn ** 2)
+    uz = C * (3 * d * q ** 2 / R ** 5 - I5 * sn ** 2)
+
+    return ux * s - uy * c, ux * c + uy * s, uz
+
+
+def _moment_tensor(x, y, d, M, nu):
+    """Surface displacement of point moment tensors M (..., 3, 3), over shear modulus, x east, y north, z up.
+    M is split along its eigenvectors into three orthogonal tensile point sources, a tensile
+    crack of potency P and normal n having the moment P (lambda I + 2 mu n n^T).
+    """
+    values, vectors = np.linalg.eigh(M)
+
+    # Potencies of the three cracks: m_i = lambda/mu * sum(P) + 2 P_i
+    lm = 2 * nu / (1 - 2 * nu)
+    total = values.sum(-1, keepdims=True) / (3 * lm + 2)
+    potency = (values - lm * total) / 2
+
+    u = [0., 0., 0.]
+    for i in range(3):
+        # Crack plane orientation from its upward normal: n = (sin(dip) cos(strike), -sin(dip) sin(strike), cos(dip))
+        n = vectors[..., :, i] * np.where(vectors[..., 2:3, i] < 0, -1, 1)
+        dip = np.arccos(np.clip(n[..., 2], -1, 1))
+        strike = np.arctan2(-n[..., 1], n[..., 0])
+
+        for j, c in enumerate(_tensile_point(x, y, d, dip, potency[..., i], nu, strike=strike)):
+            u[j] = u[j] + c
+
+    return tuple(u)
+
+
+def _spheroid_moment(strike, dip, ratio, a, dP_mu, nu):
+    """Moment tensor over shear modulus (..., 3, 3) of a pressurized prolate spheroidal cavity.
+    The cavity is the Eshelby inclusion whose eigenstrain e* solves (S - I) : e* = -P C^-1 : I,
+    with S the Eshelby tensor of the spheroid (Mura, 1987, sec. 11), and M = V C : e*.
+    """
+    strike, dip, ratio, a, dP_mu = np.broadcast_arrays(*[np.atleast_1d(np.asarray(v, dtype=float))
+                                                         for v in [strike, dip, ratio, a, dP_mu]])
+    ratio = np.clip(ratio, 1e-3, 1.)
+    a1, a3 = a, a * ratio
+
+    # Eshelby integrals of a prolate spheroid a1 > a2 = a3, sphere where the axes are (nearly) equal
+    sphere = ratio > 1 - 1e-3
+    r = np.where(sphere, 0.5, ratio)
+    e = np.sqrt(1 / r ** 2 - 1)
+    I2 = 2 * np.pi / (r * e ** 3) * (e / r - np.arccosh(1 / r))
+    I1 = 4 * np.pi - 2 * I2
+    I12 = (I2 - I1) / (a1 ** 2 * (1 - r ** 2))
+    I11 = (4 * np.pi / a1 ** 2 - 2 * I12) / 3
+    I23 = (4 * np.pi / a3 ** 2 - I12) / 10
+    I22 = 3 * I23
+
+    I1 = np.where(sphere, 4 * np.pi / 3, I1)
+    I2 = np.where(sphere, 4 * np.pi / 3, I2)
+    I11 = np.where(sphere, 4 * np.pi / (5 * a1 ** 2), I11)
+    I12 = np.where(sphere, 4 * np.pi / (5 * a1 ** 2), I12)
+    I22 = np.where(sphere, 4 * np.pi / (5 * a3 ** 2), I22)
+    I23 = np.where(sphere, 4 * np.pi / (5 * a3 ** 2), I23)
+
+    Q, R = 1 / (8 * np.pi * (1 - nu)), (1 - 2 * nu) / (8 * np.pi * (1 - nu))
+    S = np.zeros(a.shape + (3, 3))
+    S[..., 0, 0] = 3 * Q * a1 ** 2 * I11 + R * I1
+    S[..., 0, 1] = S[..., 0, 2] = Q * a3 ** 2 * I12 - R * I1
+    S[..., 1, 0] = S[..., 2, 0] = Q * a1 ** 2 * I12 - R * I2
+    S[..., 1, 1] = S[..., 2, 2] = 3 * Q * a3 ** 2 * I22 + R * I2
+    S[..., 1, 2] = S[..., 2, 1] = Q * a3 ** 2 * I23 - R * I2
+
+    # Normal eigenstrains in the spheroid frame, over shear modulus units: C^-1 : P I = P / (3K) I
+    lm = 2 * nu / (1 - 2 * nu)
+    bulk = lm + 2 / 3
+    strain = np.linalg.solve(S - np.eye(3), (-dP_mu / (3 * bulk))[..., None, None] * np.ones((3, 1)))[..., 0]
+
+    volume = 4 / 3 * np.pi * a1 * a3 ** 2
+    local = volume[..., None] * (lm * strain.sum(-1, keepdims=True) + 2 * strain)
+
+    # Frame of the spheroid: major axis along strike plunging by dip, z up
+    st, dp = np.deg2rad(strike), np.deg2rad(dip)
+    e1 = np.stack([np.cos(dp) * np.sin(st), np.cos(dp) * np.cos(st), -np.sin(dp)], -1)
+    e2 = np.stack([np.cos(st), -np.sin(st), np.zeros(st.shape)], -1)
+    e3 = np.cross(e1, e2)
+    frame = np.stack([e1, e2, e3], -1)
+
+    return np.einsum('...ij,...j,...kj->...ik', frame, local, frame)
+
+
+MODELS = {
+    'mogi': mogi,
+    'point': point,
+    'penny': penny,
+    'spheroid': spheroid,
+    'moment': moment,
+    'okada': okada,
+}
+
+# Reference strength of each model, used where only the shape of the signal matters
+REFERENCE_PARAMS = {
+    'mogi': {'volume': 1e6},
+    'point': {'radius': 500., 'dP_mu': 2.5e-3},
+    'penny': {'radius': 1000., 'dP_mu': 1e-3},
+    'spheroid': {'strike': 0., 'dip': 45., 'ratio': 0.5, 'a': 1000., 'dP_mu': 1e-3},
+    'moment': {'Mxx': 1e6, 'Myy': 1e6, 'Mzz': 1e6, 'Mxy': 0., 'Mxz': 0., 'Myz': 0.},
+    'okada': {'length': 2000., 'width': 1000., 'strike': 0., 'dip': 45., 'slip': 1., 'rake': 0., 'opening': 0.},
+}
+
+
+def far_field_ranges(model, ranges):
+    """Ranges of a source narrowed to the regime its point-source approximation holds for (see FAR_FIELD),
+    the depth raised to the ratio of FAR_FIELD times the largest size.
+    Parameters: model  - str, key of MODELS
+                ranges - dict, (min, max) or value of the parameters of the source
+    Returns:    dict, ranges with the depth narrowed, the ranges unchanged for other models
+    Raises:     ValueError if no depth of the ranges is deep enough for the largest size
+    """
+    if model not in FAR_FIELD or ranges.get('depth') is None or ranges.get(FAR_FIELD[model][0]) is None:
+        return ranges
+
+    size, ratio = FAR_FIELD[model]
+    depth = np.atleast_1d(np.asarray(ranges['depth'], dtype=float))
+    shallowest = ratio * float(np.max(ranges[size]))
+
+    if depth.max() < shallowest:
+        raise ValueError(f"The {model} kernel is a point-source approximation valid for depth/{size} above {ratio:g}, "
+                         f"depth {depth.max():g} m is shallower than {shallowest:g} m for {size} up to {np.max(ranges[size]):g} m, "
+                         f"narrow the {size} range or deepen the depth range")
+
+    if depth.min() >= shallowest:
+        return ranges
+
+    return dict(ranges, depth=(shallowest, float(depth.max())))
+
+
+def param_names(model):
+    """Ordered parameter names of a model, position first."""
+    return POSITION_PARAMS + MODEL_DEFS[model]['params']
+
+
+def displacement(model, x, y, params, nu=0.25):
+    """Evaluate a source model.
+    Parameters: model  - str, key of MODEL_DEFS
+                x, y   - np.ndarray, observation coordinates [m]
+                params - dict, values for param_names(model)
+    Returns:    ux, uy, uz - np.ndarray
+    """
+    if model not in MODELS:
+        raise ValueError(f"Forward model '{model}' is not available, choose from {list(MODELS)}")
+
+    return MODELS[model](x, y, nu=nu, **{p: params[p] for p in param_names(model)})
+
+
+def los_displacement(model, x, y, params, los, nu=0.25):
+    """Displacement projected on the LOS unit vectors los = (lx, ly, lz)."""
+    ux, uy, uz = displacement(model, x, y, params, nu=nu)
+    return ux * los[0] + uy * los[1] + uz * los[2]
+
+
+def batch(model, x, y, params, los=None, nu=0.25):
+    """Evaluate a source model for many parameter sets at once.
+    Parameters: model  - str, key of MODELS
+                x, y   - np.ndarray of shape (n_points,), observation coordinates [m]
+                params - dict, arrays of shape (n_samples,) for param_names(model)
+                los    - tuple of np.ndarray (lx, ly, lz), project on the LOS if given
+    Returns:    u      - np.ndarray of shape (n_samples, n_points) of LOS displacement if los is given,
+                         else tuple of east/north/up arrays of that shape
+    """
+    x, y = np.asarray(x, dtype=float).ravel(), np.asarray(y, dtype=float).ravel()
+    values = {p: np.atleast_1d(np.asarray(params[p], dtype=float)) for p in param_names(model)}
+    n_samples = max(len(v) for v in values.values())
+    values = {p: np.broadcast_to(v, (n_samples,)) for p, v in values.items()}
+
+    shape = (n_samples, len(x))
+    out = np.empty(shape) if los is not None else tuple(np.empty(shape) for _ in range(3))
+    step = max(1, BATCH_SIZE // max(len(x), 1))
+
+    # Samples in chunks, so that the temporaries of the kernels stay bounded
+    for s0 in range(0, n_samples, step):
+        chunk = {p: v[s0:s0 + step, None] for p, v in values.items()}
+        u = displacement(model, x[None, :], y[None, :], chunk, nu=nu)
+        u = [np.broadcast_to(c, (len(chunk['xcen']), len(x))) for c in u]
+
+        if los is not None:
+            out[s0:s0 + step] = u[0] * los[0] + u[1] * los[1] + u[2] * los[2]
+        else:
+            for o, c in zip(out, u):
+                o[s0:s0 + step] = c
+
+    return out
+
+
+def jacobian(model, x, y, params, los, nu=0.25, rel_step=1e-4):
+    """Sensitivity of the LOS displacement to every model parameter, by central differences.
+    Returns:    G - np.ndarray of shape (n_points, n_params), columns ordered as param_names(model)
+    """
+    names = param_names(model)
+    G = np.empty((len(x), len(names)))
+
+    for i, name in enumerate(names):
+        # Positions move by a fraction of the depth, other parameters by a fraction of their value
+        scale = params['depth'] if name in POSITION_PARAMS else params[name]
+        h = rel_step * (abs(scale) or 1.)
+
+        up, down = dict(params), dict(params)
+        up[name] += h
+        down[name] -= h
+
+        G[:, i] = (los_displacement(model, x, y, up, los, nu) - los_displacement(model, x, y, down, los, nu)) / (2 * h)
+
+    return G
@@ -0,0 +1,179 @@
+import os
+import h5py
+import numpy as np
+import pandas as pd
+
+# Point datasets exchanged between the pipeline stages
+POINTS_EXT = '.points.h5'
+COLUMNS = ['xx', 'yy', 'dd', 'ee', 'lx', 'ly', 'lz']
+
+
+def points_name(file):
+    """Name of the point dataset for an output path given with or without extension."""
+    for ext in [POINTS_EXT, '.csv']:
+        if file.endswith(ext):
+            file = file[:-len(ext)]
+    return file + POINTS_EXT
+
+
+def displacement_h5(file, x, y, z, err, lose, losn, losz, dtype='float64', metadata=None):
+    """Write a point dataset as one contiguous HDF5 dataset per column.
+    Parameters: file     - str, output path, POINTS_EXT is appended if missing
+                x ... losz - array-like, columns of the dataset (see COLUMNS)
+                dtype    - str, 'float32' or 'float64'
+                metadata - dict, extra attributes stored with the dataset (e.g. UTM_ZONE)
+    Returns:    file_name - str
+    """
+    file_name = points_name(file)
+    columns = dict(zip(COLUMNS, [x, y, z, err, lose, losn, losz]))
+    columns = {k: np.asarray(v, dtype=dtype).ravel() for k, v in columns.items()}
+
+    print("#" * 50)
+    print(f"Saving {file_name}.\n")
+
+    with h5py.File(file_name, 'w') as f:
+        # Contiguous and uncompressed, so that readers can memory-map the columns
+        for name, data in columns.items():
+            f.create_dataset(name, data=data)
+
+        for key, value in (metadata or {}).items():
+            if value is not None:
+                f.attrs[key] = value
+
+        count = len(columns['xx'])
+        f.attrs['COUNT'] = count
+        f.attrs['DTYPE'] = dtype
+        if count:
+            f.attrs['X_MIN'], f.attrs['X_MAX'] = columns['xx'].min(), columns['xx'].max()
+            f.attrs['Y_MIN'], f.attrs['Y_MAX'] = columns['yy'].min(), columns['yy'].max()
+
+    return file_name
+
+
+class PointWriter:
+    """Append a point dataset tile by tile, so that the whole set is never held in memory.
+
+    Tiles go to a temporary chunked file. On close the columns are copied one
+    at a time to the contiguous layout of displacement_h5, which read_points
+    can memory-map.
+    """
+    CHUNK = 65536
+
+    def __init__(self, file, dtype='float64', metadata=None):
+        self.file_name = points_name(file)
+        self.tmp_file = f"{self.file_name}.{os.getpid()}.tmp"
+        self.dtype = dtype
+        self.metadata = metadata or {}
+        self.count = 0
+        self.bounds = [np.inf, -np.inf, np.inf, -np.inf]
+
+        self.f = h5py.File(self.tmp_file, 'w')
+        for name in COLUMNS:
+            self.f.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(self.CHUNK,))
+
+    def append(self, x, y, z, err, lose, losn, losz):
+        columns = dict(zip(COLUMNS, [x, y, z, err, lose, losn, losz]))
+        n = len(np.ravel(x))
+        if not n:
+            return
+
+        for name, data in columns.items():
+            ds = self.f[name]
+            ds.resize((self.count + n,))
+            ds[self.count:] = np.asarray(data, dtype=self.dtype).ravel()
+
+        self.bounds = [min(self.bounds[0], np.min(x)), max(self.bounds[1], np.max(x)),
+                       min(self.bounds[2], np.min(y)), max(self.bounds[3], np.max(y))]
+        self.count += n
+
+    def close(self):
+        """Write the final dataset and remove the temporary one.
+        Returns:    file_name - str
+        """
+        print("#" * 50)
+        print(f"Saving {self.file_name}.\n")
+
+        with h5py.File(self.file_name, 'w') as f:
+            for name in COLUMNS:
+                f.create_dataset(name, data=self.f[name][()])
+
+            for key, value in self.metadata.items():
+                if value is not None:
+                    f.attrs[key] = value
+
+            f.attrs['COUNT'] = self.count
+            f.attrs['DTYPE'] = self.dtype
+            if self.count:
+                f.attrs['X_MIN'], f.attrs['X_MAX'], f.attrs['Y_MIN'], f.attrs['Y_MAX'] = self.bounds
+
+        self.f.close()
+        os.remove(self.tmp_file)
+
+        return self.file_name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            os.remove(self.tmp_file)
+
+
+def points_metadata(file):
+    """Attributes of a point dataset, without reading any column."""
+    with h5py.File(file, 'r') as f:
+        return dict(f.attrs)
+
+
+def read_points(file, columns=None, mmap=True):
+    """Read the columns of a point dataset, HDF5 or CSV.
+    Parameters: file    - str, POINTS_EXT or .csv file
+                columns - list of str, columns to read (default: all)
+                mmap    - bool, memory-map the HDF5 columns instead of reading them
+    Returns:    dict of column name -> 1D np.ndarray
+    """
+    columns = columns or COLUMNS
+
+    if not file.endswith(POINTS_EXT):
+        df = pd.read_csv(file, usecols=columns)
+        return {c: df[c].values for c in columns}
+
+    points = {}
+    with h5py.File(file, 'r') as f:
+        for c in columns:
+            ds = f[c]
+            offset = ds.id.get_offset()
+
+            if mmap and offset is not None and ds.chunks is None and ds.compression is None:
+                points[c] = np.memmap(file, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
+            else:
+                points[c] = ds[()]
+
+    return points
+
+
+def export_csv(file):
+    """Export a point dataset to the CSV layout read by VSM, only if missing or outdated.
+    Returns:    csv_file - str
+    """
+    csv_file = file[:-len(POINTS_EXT)] + '.csv'
+
+    if not os.path.exists(csv_file) or os.path.getmtime(csv_file) < os.path.getmtime(file):
+        pd.DataFrame(read_points(file)).to_csv(csv_file, index=False)
+
+    return csv_file
+
+
+def point_files(folder, match_str):
+    """Point datasets of a folder whose name contains 'match_str'.
+    A CSV exported from a POINTS_EXT dataset is not listed twice.
+    """
+    files = [f for f in sorted(os.listdir(folder)) if match_str in f]
+    points = [f for f in files if f.endswith(POINTS_EXT)]
+    exported = [f[:-len(POINTS_EXT)] + '.csv' for f in points]
+    points += [f for f in files if f.endswith('.csv') and f not in exported]
+
+    return [os.path.join(folder, f) for f in points]
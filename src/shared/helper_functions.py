@@ -1,7 +1,6 @@
 import os
 import glob
 import numpy as np
-from pyproj import Transformer
 
 SCRATCHDIR = os.getenv('SCRATCHDIR')
 
@@ -12,7 +11,7 @@ MODEL_DEFS = {
     },
     'point': {
         'id': '1',
-        'params': ['volume'],
+        'params': ['radius', 'dP_mu'],
     },
     'penny': {
         'id': '2',
@@ -46,6 +45,31 @@ def extent2meshgrid(extent: tuple, ds_shape: list):
     return xx.flatten(), yy.flatten()
 
 
+def block_view(data: np.ndarray, size: int):
+    """Split a 2D array into non-overlapping size x size blocks.
+    Parameters: data   - 2D np.ndarray, padded with NaN if its shape is not a multiple of size
+                size   - int, edge length of the blocks in pixels
+    Returns:    blocks - 4D np.ndarray of shape (n_rows, n_cols, size, size), a view when no padding is needed
+    """
+    length, width = data.shape
+    pad_rows, pad_cols = -length % size, -width % size
+
+    if pad_rows or pad_cols:
+        data = np.pad(data.astype(float), ((0, pad_rows), (0, pad_cols)), constant_values=np.nan)
+
+    n_rows, n_cols = data.shape[0] // size, data.shape[1] // size
+    return data.reshape(n_rows, size, n_cols, size).swapaxes(1, 2)
+
+
+def summed_area_table(data: np.ndarray):
+    """Summed-area table padded with a leading row and column of zeros, so that
+    the sum over data[r0:r1, c0:c1] is S[r1, c1] - S[r0, c1] - S[r1, c0] + S[r0, c0].
+    """
+    sat = np.zeros((data.shape[0] + 1, data.shape[1] + 1), dtype=float)
+    np.cumsum(np.cumsum(data, axis=0, dtype=float), axis=1, out=sat[1:, 1:])
+    return sat
+
+
 def get_file_names(path):
     """gets the youngest eos5 file. Path can be:
     MaunaLoaSenAT124
@@ -105,37 +129,26 @@ def get_file_names(path):
     return eos_file, vel_file, geometry_file, project_base_dir, out_vel_file, inputs_folder
 
 
-def convert_to_utm(longitude, latitude):
+def convert_to_utm(longitude, latitude, zone=None):
     """
     Converts latitude and longitude to UTM coordinates.
 
     Parameters:
         longitude (array-like): Array of longitude values.
         latitude (array-like): Array of latitude values.
+        zone (str): Forced UTM zone, e.g. '33N'. Default is the zone of the mean longitude.
 
     Returns:
         tuple: Arrays of UTM Eastings (x) and Northings (y).
     """
-    # Calculate the UTM zone based on the longitude
-    utm_zone = int((longitude.mean() + 180) // 6) + 1
-
-    # Determine the hemisphere based on latitude
-    hemisphere = 'north' if latitude.mean() >= 0 else 'south'
-
-    # Determine the EPSG code based on the UTM zone and hemisphere
-    epsg_code = f"326{utm_zone:02d}" if hemisphere == 'north' else f"327{utm_zone:02d}"
-
-    # Create a Transformer object for WGS84 to UTM
-    transformer = Transformer.from_crs("epsg:4326", f"epsg:{epsg_code}", always_xy=True)
-
-    # Convert to UTM coordinates (Eastings, Northings)
-    x, y = transformer.transform(longitude, latitude)
+    # Transformers are cached per EPSG code in the projection module
+    from src.shared.projection import to_utm
 
-    return x, y
+    return to_utm(longitude, latitude, zone=zone)
 
 
-def inversion_template(txt_file,output_folder,input_sar=None,input_gps=None,shear=None,poisson=None,x_range=None,y_range=None,z_range=None,models=None,sampling_id='0',weight_sar=0.0,weight_gps=0.0
-):
+def inversion_template(txt_file,output_folder,input_sar=None,input_gps=None,shear=None,poisson=None,x_range=None,y_range=None,z_range=None,models=None,sampling_id='0',weight_sar=0.0,weight_gps=0.0,
+                       samples=1000,resample=300,iterations=12,burn_in=5000):
     """
     Write VSM inversion template with multiple source models and shared x/y/z ranges.
 
@@ -145,6 +158,9 @@ def inversion_template(txt_file,output_folder,input_sar=None,input_gps=None,shea
         Dictionary with source_id as keys, and values as dicts with:
         - 'name': model name (str)
         - 'params': list of model-specific parameter ranges
+    samples, resample, iterations, burn_in : int
+        Sampler budget, NA samples per iteration and resampled cells, NA iterations
+        or Bayesian steps, Bayesian burn-in steps
     """
     lines = [
         f'{output_folder}',
@@ -180,9 +196,9 @@ def inversion_template(txt_file,output_folder,input_sar=None,input_gps=None,shea
 
     # Sampling algorithm & params
     lines.append(str(sampling_id))       # 0 for NA, 1 for BI
-    lines.append('1000 300')             # p1, p2
-    lines.append('12')                   # p3 or BI steps
-    lines.append('5000')                 # burn-in
+    lines.append(f'{samples} {resample}') # p1, p2
+    lines.append(f'{iterations}')         # p3 or BI steps
+    lines.append(f'{burn_in}')            # burn-in
 
     # Write to file
     with open(txt_file, 'w') as f:
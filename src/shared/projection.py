@@ -0,0 +1,73 @@
+from functools import lru_cache
+from collections import OrderedDict
+import numpy as np
+from pyproj import Transformer
+
+# Projected grids kept in memory, keyed by scene geometry and UTM zone
+GRID_CACHE_SIZE = 8
+_grid_cache = OrderedDict()
+
+
+def utm_zone(longitude, latitude):
+    """UTM zone, e.g. '33N', of the mean position of the input coordinates."""
+    zone = int((np.mean(longitude) + 180) // 6) + 1
+    hemisphere = 'N' if np.mean(latitude) >= 0 else 'S'
+
+    return f"{zone:02d}{hemisphere}"
+
+
+def zone2epsg(zone):
+    """EPSG code of a WGS84 UTM zone given as '33N' / '33S'."""
+    zone = zone.upper()
+    number, hemisphere = int(zone[:-1]), zone[-1]
+
+    if hemisphere not in 'NS' or not 1 <= number <= 60:
+        raise ValueError(f"UTM zone not valid: {zone}, it must be in the format 33N or 33S")
+
+    return int(f"{326 if hemisphere == 'N' else 327}{number:02d}")
+
+
+@lru_cache(maxsize=16)
+def get_transformer(epsg):
+    """WGS84 to 'epsg' transformer, built once per EPSG code."""
+    return Transformer.from_crs("epsg:4326", f"epsg:{epsg}", always_xy=True)
+
+
+def to_utm(longitude, latitude, zone=None):
+    """Project longitude/latitude into UTM Eastings/Northings.
+    Parameters: longitude, latitude - array-like, geographic coordinates
+                zone                - str, forced UTM zone ('33N'), default the zone of the mean position
+    Returns:    x, y                - np.ndarray, UTM Eastings and Northings
+    """
+    zone = zone or utm_zone(longitude, latitude)
+    return get_transformer(zone2epsg(zone)).transform(longitude, latitude)
+
+
+def project_grid(geotransform, shape, step, zone):
+    """UTM coordinates of the centers of every 'step'-th pixel of a geocoded scene, flattened row by row,
+    cached per geometry. Same values as projecting the pixel centers of Downsample._pixel2geo.
+    Parameters: geotransform - tuple of float (X_FIRST, X_STEP, Y_FIRST, Y_STEP) of the scene
+                shape        - tuple of int, shape of the subsampled grid
+                step         - int, pixels between two grid nodes
+                zone         - str, UTM zone ('33N')
+    Returns:    x, y         - read-only 1D np.ndarray
+    """
+    key = (tuple(float(g) for g in geotransform), tuple(shape), int(step), zone)
+
+    if key in _grid_cache:
+        _grid_cache.move_to_end(key)
+        return _grid_cache[key]
+
+    x_first, x_step, y_first, y_step = key[0]
+    rows, cols = np.meshgrid(np.arange(shape[0]) * step, np.arange(shape[1]) * step, indexing='ij')
+    lons = x_first + (cols.ravel() + 0.5) * x_step
+    lats = y_first + (rows.ravel() + 0.5) * y_step
+    x, y = to_utm(lons, lats, zone=zone)
+    x.flags.writeable = False
+    y.flags.writeable = False
+
+    _grid_cache[key] = (x, y)
+    if len(_grid_cache) > GRID_CACHE_SIZE:
+        _grid_cache.popitem(last=False)
+
+    return x, y
@@ -0,0 +1,145 @@
+import os
+import re
+import traceback
+import subprocess
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from src.shared import cache
+
+
+class Task:
+    """Node of a task graph: a picklable function, or a command run in a subprocess, with the files it reads and writes.
+
+    A task is up to date when the manifest written after its last success
+    (see cache.record) has the key of its current input files and params and
+    all its outputs exist. Inputs produced by other tasks are only identified
+    once those have run, so freshness is checked when the task becomes ready.
+    """
+    def __init__(self, name, func=None, args=(), inputs=(), outputs=(), deps=(), params=None, command=None):
+        """Parameters: name    - str, unique name of the task
+                       func    - callable, module level so that it runs in a worker process
+                       args    - tuple, arguments of func
+                       command - list of str, command run instead of func, e.g. in another environment
+                       inputs  - list of str, files read by the task
+                       outputs - list of str, files written by the task, the first one names its manifest and log
+                       deps    - list of str, names of the tasks to complete first
+                       params  - dict, settings of the task, part of its cache key
+        """
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.params = params
+        self.command = command
+
+    @property
+    def base(self):
+        """Manifest and log of the task, next to its first output."""
+        return os.path.join(os.path.dirname(self.outputs[0]), '.' + re.sub(r'[^\w.-]', '_', self.name))
+
+    def key(self):
+        return cache.unit_key([f for f in self.inputs if os.path.exists(f)], {'name': self.name, 'params': self.params})
+
+    def is_fresh(self):
+        return all(os.path.exists(f) for f in self.inputs) and cache.is_fresh(self.base, self.key())
+
+    def record(self):
+        cache.record(self.base, self.key(), outputs=self.outputs, params=self.params)
+
+
+def _execute(func, args, log_file, command=None):
+    """Run func(*args), or 'command' in a subprocess, logging to log_file as it runs.
+    Returns:    str, traceback or exit status of the failure, or None
+    """
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+
+    if command is not None:
+        with open(log_file, 'w') as f:
+            # Unbuffered, so that the log follows the run
+            status = subprocess.run(command, stdout=f, stderr=subprocess.STDOUT, env=dict(os.environ, PYTHONUNBUFFERED='1')).returncode
+        return f"Exited with status {status}" if status else None
+
+    with open(log_file, 'w') as f, redirect_stdout(f), redirect_stderr(f):
+        try:
+            func(*args)
+        except BaseException:
+            # SystemExit included, stages exit on bad inputs
+            error = traceback.format_exc()
+            print(error)
+            return error
+
+    return None
+
+
+def run_graph(tasks, jobs=1):
+    """Run a task graph on a pool of worker processes, every task as soon as its dependencies completed.
+
+    Up-to-date tasks are skipped, the dependents of a failed task are not run.
+    Every task logs to <base>.log (see Task.base).
+    Parameters: tasks - list of Task
+                jobs  - int, worker processes
+    Returns:    dict, status of every task: 'done', 'skipped', 'failed' or 'blocked'
+    """
+    by_name = {t.name: t for t in tasks}
+    missing = {d for t in tasks for d in t.deps if d not in by_name}
+    if missing:
+        raise ValueError(f"Unknown dependencies: {sorted(missing)}")
+
+    status = {}
+    waiting = {t.name: set(t.deps) for t in tasks}
+    dependents = {t.name: [u.name for u in tasks if t.name in u.deps] for t in tasks}
+    running = {}
+
+    def finish(name, state):
+        status[name] = state
+        print(f"[{len(status)}/{len(tasks)}] {state}: {name}")
+
+        for other in dependents[name]:
+            if other in status:
+                continue
+            if state in ['failed', 'blocked']:
+                finish(other, 'blocked')
+            else:
+                waiting[other].discard(name)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while len(status) < len(tasks):
+            # Ready tasks, in the order they were declared, again while skipped ones release others
+            released = True
+            while released:
+                released = False
+                for task in tasks:
+                    if task.name in status or task.name in running.values() or waiting[task.name]:
+                        continue
+
+                    if task.is_fresh():
+                        finish(task.name, 'skipped')
+                        released = True
+                        continue
+
+                    running[executor.submit(_execute, task.func, task.args, task.base + '.log', task.command)] = task.name
+
+            if len(status) == len(tasks):
+                break
+
+            if not running:
+                raise RuntimeError(f"Dependency cycle among {sorted(set(by_name) - set(status))}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = by_name[running.pop(future)]
+                error = future.result()
+
+                if error is None and not all(os.path.exists(f) for f in task.outputs):
+                    error = f"Missing outputs: {[f for f in task.outputs if not os.path.exists(f)]}"
+
+                if error is None:
+                    task.record()
+                    finish(task.name, 'done')
+                else:
+                    print(f"  {error.strip().splitlines()[-1]}, log in {task.base}.log")
+                    finish(task.name, 'failed')
+
+    return status
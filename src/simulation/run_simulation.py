@@ -7,9 +7,10 @@ import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from src.shared.csv_functions import read_csv, displacement_csv 
+from src.shared.csv_functions import read_csv, displacement_csv
+from src.shared.h5_functions import POINTS_EXT, displacement_h5, read_points, points_metadata, point_files
 from src.simulation.simulate import main as simulate
-from src.inversion.run_inversion import main as inversion
+from src.inversion.run_inversion import main as inversion, add_sampler_arguments
 
 
 EXAMPLE = """
@@ -18,7 +19,7 @@ EXAMPLE = """
 SCRATCHDIR = os.getenv('SCRATCHDIR')
 
 
-def create_parser():
+def create_parser(iargs=None):
     synopsis = 'Plotting of InSAR, GPS and Seismicity data'
     epilog = EXAMPLE
     parser = argparse.ArgumentParser(description=synopsis, epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
@@ -33,14 +34,17 @@ def create_parser():
     parser.add_argument('--y-range', type=float, nargs=2, default=[float('inf'), float('-inf')], help="Y range.")
     parser.add_argument('--z-range', type=float, nargs=2, default=(0, 5000), help="Z range (default: %(default)s).")
     parser.add_argument('--volume', type=str, default='1.e6 2.e7', help="Volume value (default: %(default)s).")
-    parser.add_argument('--sampling_id', type=str, choices=['0', '1'], default='0', help="Sampling ID (default: %(default)s).")
     parser.add_argument('--weight-sar', type=float, default=1.0, help="Weight for SAR data (default: %(default)s).")
     parser.add_argument('--weight-gps', type=float, default=0.0, help="Weight for GPS data (default: %(default)s).")
     parser.add_argument('--model', type=str, nargs='+', choices=['mogi', 'point', 'penny', 'spheroid', 'moment', 'okada'], default=['mogi'], help="One or more models: Mogi (1958), McTigue point source (1987), Fialko et al.(2001), Penny-shaped crack, Yang et al. (1988). Spheroid, Davis (1986) Moment tensor, Okada 1985.")
     parser.add_argument('--show', action='store_true', help="Show the plot.")
     parser.add_argument('--noise', type=float, default=0.0, help="Noise value (default: %(default)s).")
+    parser.add_argument('--forward-engine', type=str, choices=['native', 'vsm'], default='native', help="Forward model implementation, 'vsm' for VSM_forward (default: %(default)s).")
     parser.add_argument('--period', nargs='*', metavar='YYYYMMDD:YYYYMMDD, YYYYMMDD,YYYYMMDD', type=str, help='Period of the search')
 
+    # Inversion of the simulated points
+    add_sampler_arguments(parser)
+
     parser.add_argument('--mogi-volume', type=float, nargs=2, default=[1e6, 2e7], help="Mogi volume range (default: %(default)s).")
 
     # Penny parameters
@@ -65,7 +69,7 @@ def create_parser():
 
 
     # Parse arguments
-    inps = parser.parse_args()
+    inps = parser.parse_args(iargs)
 
     inps.folder_path = inps.folder if SCRATCHDIR in inps.folder else os.path.join(SCRATCHDIR, inps.folder)
 
@@ -87,31 +91,49 @@ def create_parser():
     return inps
 
 
-def generate_displacement(inps, fpath, out_folder, params):
-    df = pd.read_csv(fpath)
-    parameters = read_csv(params)
-
-    ux, uy, uz = simulate(x=df['xx'], y=df['yy'], paramters=parameters, **inps.__dict__)
+def simulate_points(inps, points, parameters):
+    """Point dataset with the LOS displacement of the source 'parameters' at the points of 'points',
+    with noise if inps.noise.
+    Parameters: points     - dict of np.ndarray, point dataset with the h5_functions.COLUMNS
+                parameters - dict, best fit of the inversion (see simulate.main)
+    Returns:    dict of np.ndarray, same points with the simulated displacement 'dd'
+    """
+    ux, uy, uz = simulate(x=points['xx'], y=points['yy'], paramters=parameters, **inps.__dict__)
     utot = np.array([ux, uy, uz])
-    los_sar = np.array([df['lx'], df['ly'], df['lz']]).T
+    los_sar = np.array([points['lx'], points['ly'], points['lz']]).T
     displacement = np.sum(utot.T * los_sar, axis=1)
 
     if inps.noise > 0:
         displacement += np.random.normal(0, inps.noise, size=displacement.shape)
 
-    displacement_csv(
-        file=os.path.join(out_folder, os.path.basename(fpath)),
-        x=df['xx'], y=df['yy'], z=displacement,
-        err=df['ee'], lose=df['lx'], losn=df['ly'], losz=df['lz']
-    )
+    return dict(points, dd=displacement)
+
+
+def show_simulation(observed, simulated):
+    fig, (ax, ax1) = plt.subplots(1, 2, figsize=(10, 5))
+    ax.scatter(observed['xx'], observed['yy'], c=simulated['dd'], s=3)
+    ax.set_title('Simulation')
+    ax1.scatter(observed['xx'], observed['yy'], c=observed['dd'], s=3)
+    ax1.set_title('Observed')
+    plt.show()
+
+
+def generate_displacement(inps, fpath, out_folder, params):
+    df = read_points(fpath)
+    sim = simulate_points(inps, df, read_csv(params))
+
+    out_file = os.path.join(out_folder, os.path.basename(fpath))
+    columns = dict(x=sim['xx'], y=sim['yy'], z=sim['dd'], err=sim['ee'], lose=sim['lx'], losn=sim['ly'], losz=sim['lz'])
+
+    # Same format as the observed points
+    if fpath.endswith(POINTS_EXT):
+        metadata = points_metadata(fpath)
+        displacement_h5(file=out_file, dtype=metadata['DTYPE'], metadata=metadata, **columns)
+    else:
+        displacement_csv(file=out_file, **columns)
 
     if inps.show:
-        fig, (ax, ax1) = plt.subplots(1, 2, figsize=(10, 5))
-        ax.scatter(df['xx'], df['yy'], c=displacement, s=3)
-        ax.set_title('Simulation')
-        ax1.scatter(df['xx'], df['yy'], c=df['dd'], s=3)
-        ax1.set_title('Observed')
-        plt.show()
+        show_simulation(df, sim)
 
 def compare(sim_out_folder):
     sim = pd.read_csv(os.path.join(sim_out_folder, 'VSM_best.csv'))
@@ -130,6 +152,53 @@ def compare(sim_out_folder):
     for s,i in zip(sim.keys(), inf.keys()):
         print(f"{s}: {sim[s].values - inf[i].values}")
 
+def simulate_period(inps, period=None):
+    """Simulate the points of every track of 'period' from the best fit of its inversion, invert them
+    and compare the two best fits. 'inps' is left unchanged.
+    Returns:    sim_out_folder - str, folder of the inversion of the simulated points
+    """
+    inps = argparse.Namespace(**vars(inps))
+
+    p = '|'.join([f"{inps.satellite}[AD]T?"])
+    pattern = f"({p})\d+"
+    regex = re.compile(pattern)
+    folder_list = [f for f in os.listdir(inps.folder_path) if os.path.isdir(os.path.join(inps.folder_path, f))]
+    simulation_folder = os.path.join(inps.folder_path, 'simulation')
+
+    for folder in folder_list:
+        match = regex.match(folder)
+        if not match:
+            continue
+
+        input_folder = os.path.join(inps.folder_path, folder)
+        period_folder = os.path.join(input_folder, period) if period else input_folder
+        output_folder = os.path.join(inps.folder_path, period) if period else inps.folder_path
+        params = os.path.join(output_folder, 'VSM_best.csv')
+
+        if not inps.txt_file:
+            if period:
+                inps.txt_file = os.path.join(inps.folder_path, 'simulation', period, 'VSM_input.txt')
+            else:
+                inps.txt_file = os.path.join(inps.folder_path, 'simulation', 'VSM_input.txt')
+
+        sim_out_folder = os.path.join(simulation_folder, period) if period else simulation_folder
+        simulation_input = os.path.join(simulation_folder, folder,  period) if period else os.path.join(simulation_folder, folder)
+        # os.makedirs(sim_out_folder, exist_ok=True)  ALREADY CREATED IN inversion
+        os.makedirs(simulation_input, exist_ok=True)
+
+        for fpath in point_files(period_folder, match.group(0)):
+            generate_displacement(inps, fpath, simulation_input, params)
+
+    # Only this period of the simulated tracks
+    inps.folder_path = simulation_folder
+    inps.period_folder = [period] if period else []
+    inversion(iargs=inps)
+    # compare(simulation_folder)
+    compare(sim_out_folder)
+
+    return sim_out_folder
+
+
 def main(iargs=None):
 
     print("#" * 50)
@@ -137,50 +206,13 @@ def main(iargs=None):
     print("#" * 50)
     print()
 
-    inps = create_parser()
+    inps = create_parser() if not isinstance(iargs, argparse.Namespace) else iargs
 
     if inps.satellite:
-        p = '|'.join([f"{inps.satellite}[AD]T?"])
-        input_sar = ''
-
-        pattern = f"({p})\d+"
-        regex = re.compile(pattern)
-        folder_list = [f for f in os.listdir(inps.folder_path) if os.path.isdir(os.path.join(inps.folder_path, f))]
-        simulation_folder = os.path.join(inps.folder_path, 'simulation')
-
         periods = inps.period_folder if inps.period_folder else [None]
 
         for period in periods:
-            for folder in folder_list:
-                match = regex.match(folder)
-                if not match:
-                    continue
-
-                input_folder = os.path.join(inps.folder_path, folder)
-                period_folder = os.path.join(input_folder, period) if period else input_folder
-                output_folder = os.path.join(inps.folder_path, period) if period else inps.folder_path
-                params = os.path.join(output_folder, 'VSM_best.csv')
-
-                if not inps.txt_file:
-                    if period:
-                        inps.txt_file = os.path.join(inps.folder_path, 'simulation', period, 'VSM_input.txt')
-                    else:
-                        inps.txt_file = os.path.join(inps.folder_path, 'simulation', 'VSM_input.txt')
-
-                sim_out_folder = os.path.join(simulation_folder, period) if period else simulation_folder
-                simulation_input = os.path.join(simulation_folder, folder,  period) if period else os.path.join(simulation_folder, folder)
-                # os.makedirs(sim_out_folder, exist_ok=True)  ALREADY CREATED IN inversion
-                os.makedirs(simulation_input, exist_ok=True)
-
-                for f in os.listdir(period_folder):
-                    if f.endswith('.csv') and match.group(0) in f:
-                        fpath = os.path.join(period_folder, f)
-                        generate_displacement(inps, fpath, simulation_input, params)
-
-            inps.folder_path = simulation_folder
-            inversion(iargs=inps)
-            # compare(simulation_folder)
-            compare(sim_out_folder)
+            simulate_period(inps, period)
 
 
 if __name__ == '__main__':
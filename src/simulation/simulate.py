@@ -1,5 +1,16 @@
 import sys
-import VSM_forward
+import numpy as np
+from src.shared import forward
+
+# VSM column names of the inverted parameters and their forward model counterparts
+VSM_NAMES = {
+    'dVol': 'volume',
+    'xtlc': 'xcen',
+    'ytlc': 'ycen',
+    'dtlc': 'depth',
+    'param1': 'slip',
+    'param2': 'rake',
+}
 
 
 def print_msg(model, x, y, parameters):
@@ -7,32 +18,76 @@ def print_msg(model, x, y, parameters):
     print(f"Using {model} parameters: {parameters}\n")
     print(f"Grid shape: {x.shape}, {y.shape}\n")
 
-def main(x, y, paramters, **kwargs):
-    # Merge paramters and kwargs into a single dictionary
-    all_params = {**paramters, **kwargs}
 
-    if 'okada' in all_params["model"]:
+def source_model(models):
+    """First model of 'models' the forward library implements."""
+    models = [models] if isinstance(models, str) else models
+    for model in models:
+        if model in forward.MODELS:
+            return model
+
+    raise ValueError(f"No forward model for {models}, choose from {list(forward.MODELS)}")
+
+
+def model_parameters(model, parameters):
+    """Parameters of 'model' from a VSM_best row or a dict with forward model names."""
+    values = {VSM_NAMES.get(key, key): value for key, value in parameters.items()}
+    return {name: float(values[name]) for name in forward.param_names(model)}
+
+
+def main(x, y, paramters, forward_engine='native', **kwargs):
+    # Merge paramters and kwargs into a single dictionary, the best fit over same-named options (e.g. --volume)
+    all_params = {**kwargs, **paramters}
+    model = source_model(all_params["model"])
+    nu = float(all_params.get('nu', 0.25))
+
+    if forward_engine == 'vsm':
+        return vsm(x, y, model, all_params)
+
+    params = model_parameters(model, all_params)
+    # Point-source approximations of finite sources refuse a source too shallow for them
+    forward.far_field_ranges(model, params)
+    print_msg(model.capitalize(), np.asarray(x), np.asarray(y), params)
+
+    return forward.displacement(model, np.asarray(x, dtype=float), np.asarray(y, dtype=float), params, nu=nu)
+
+
+def vsm(x, y, model, all_params):
+    """Reference evaluation with VSM_forward, only Okada and Mogi are wired."""
+    import VSM_forward
+
+    if model == 'okada':
         # Extract only the parameters required by the okada function
-        required_params = ['xtlc', 'ytlc', 'dtlc', 'length', 'width', 
-                           'strike', 'dip', 'param1', 'param2', 
-                           'opening', 'opt', 'nu', 'poisson']
+        required_params = ['xtlc', 'ytlc', 'dtlc', 'length', 'width',
+                           'strike', 'dip', 'param1', 'param2',
+                           'opening', 'nu']
         okada_params = {key: float(all_params[key]) for key in required_params if key in all_params}
+        okada_params.setdefault('opening', 0.)
 
         print_msg('Okada', x, y, okada_params)
 
-        ux, uy, uz = VSM_forward.okada(x, y, opening=0, opt='R', **okada_params)
+        return VSM_forward.okada(x, y, opt='R', **okada_params)
 
-    elif 'mogi' in all_params["model"]:
+    elif model == 'mogi':
         # Extract only the parameters required by the mogi function
         required_params = ['xcen', 'ycen', 'depth', 'dVol', 'nu']
         mogi_params = {key: float(all_params[key]) for key in required_params if key in all_params}
 
         print_msg('Mogi', x, y, mogi_params)
 
-        ux, uy, uz = VSM_forward.mogi(x, y, **mogi_params)
+        return VSM_forward.mogi(x, y, **mogi_params)
+
+    raise ValueError(f"VSM_forward engine not wired for model '{model}'")
+
+
+def compare_engines(x, y, paramters, **kwargs):
+    """Largest difference between the native and the VSM_forward displacements, per component."""
+    native = main(x, y, paramters, forward_engine='native', **kwargs)
+    reference = vsm(x, y, source_model(kwargs.get('model', paramters.get('model'))), {**paramters, **kwargs})
+
+    return [float(np.max(np.abs(np.asarray(a) - np.asarray(b)))) for a, b in zip(native, reference)]
 
-    return ux, uy, uz
 
 if __name__ == '__main__':
     args = sys.argv[1:]
-    main(*args)
\ No newline at end of file
+    main(*args)
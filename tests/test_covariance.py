@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from src.shared import forward
+from src.downsample.objects.covariance import Covariance
+
+# Scene of 400 x 400 pixels of 90 m, white noise of std 2 mm
+N, DX, STD = 400, 90., 0.002
+
+
+def scene(volume, ramp=0., seed=0):
+    """Uplift of a Mogi source at 3 km below the center of the scene, with a ramp and white noise."""
+    y, x = np.mgrid[0:N, 0:N] * DX
+    uz = forward.mogi(x, y, N * DX / 2, N * DX / 2, 3000., volume)[2]
+    return uz + ramp * x + np.random.default_rng(seed).normal(0, STD, uz.shape)
+
+
+@pytest.mark.parametrize('ramp', [0., 1e-6])
+def test_white_noise_under_deformation(ramp):
+    """The signal and its tails are masked, the noise left is white with the variance of the scene's."""
+    covariance = Covariance(scene(1e6, ramp=ramp), DX, DX)
+
+    assert covariance.nugget == pytest.approx(STD ** 2, rel=0.1)
+    assert covariance.sill < 0.05 * STD ** 2
+    # Mean of 3 x 3 pixels of white noise
+    assert np.sqrt(covariance.footprint_variance([3]))[0] == pytest.approx(STD / 3, rel=0.15)
+
+
+def test_user_mask():
+    """Without a buffer the tails of the signal raise the errors, a mask of the deformed area removes them."""
+    data = scene(1e6)
+    y, x = np.mgrid[0:N, 0:N]
+    mask = np.hypot(y - N / 2, x - N / 2) > 150
+
+    unmasked = Covariance(data, DX, DX, buffer=0.)
+    covariance = Covariance(data, DX, DX, buffer=0., mask=mask)
+
+    assert np.sqrt(unmasked.footprint_variance([3]))[0] > 1.5 * STD / 3
+    assert covariance.nugget == pytest.approx(STD ** 2, rel=0.1)
+    assert np.sqrt(covariance.footprint_variance([3]))[0] == pytest.approx(STD / 3, rel=0.15)
@@ -0,0 +1,167 @@
+import os
+import json
+import numpy as np
+import pytest
+from src.shared import forward
+
+NU = 0.25
+
+# Published and closed-form displacements, see the 'reference' of each entry
+with open(os.path.join(os.path.dirname(__file__), 'data', 'forward_reference.json')) as f:
+    REFERENCE = json.load(f)
+
+# Observation grid around the sources [m]
+X, Y = [c.ravel() for c in np.meshgrid(np.linspace(-10000, 10000, 41), np.linspace(-10000, 10000, 41))]
+
+# VSM_forward function, its arguments and the native kernel they compare with, only the
+# signatures simulate.vsm calls; the other kernels compare with REFERENCE and with Okada below
+VSM_KERNELS = {
+    'mogi': ('mogi', dict(xcen=300., ycen=-200., depth=3000., dVol=1e6, nu=NU),
+             dict(xcen=300., ycen=-200., depth=3000., volume=1e6)),
+    'okada': ('okada', dict(xtlc=300., ytlc=-200., dtlc=1000., length=3000., width=1500., strike=30., dip=60.,
+                            param1=1., param2=90., opening=0.5, nu=NU, opt='R'),
+              dict(xcen=300., ycen=-200., depth=1000., length=3000., width=1500., strike=30., dip=60.,
+                   slip=1., rake=90., opening=0.5)),
+}
+
+
+def peak_error(reference, value):
+    """Largest difference of every component over the peak of the reference."""
+    return [float(np.max(np.abs(np.asarray(v) - np.asarray(r))) / np.max(np.abs(r))) for r, v in zip(reference, value)]
+
+
+def small_fault(xcen, ycen, depth, strike, dip, rake, slip=0., opening=0., size=20.):
+    """Okada displacement of a size x size fault centred on (xcen, ycen, depth), a point source seen from afar."""
+    s, d = np.deg2rad(strike), np.deg2rad(dip)
+    # Top left corner, half a size back along strike and up dip
+    x0 = xcen - size / 2 * (np.sin(s) + np.cos(d) * np.cos(s))
+    y0 = ycen - size / 2 * (np.cos(s) - np.cos(d) * np.sin(s))
+    return forward.okada(X, Y, x0, y0, depth - size / 2 * np.sin(d), size, size, strike, dip, slip, rake, opening, nu=NU)
+
+
+@pytest.mark.parametrize('model', list(VSM_KERNELS))
+def test_against_vsm_forward(model):
+    VSM_forward = pytest.importorskip('VSM_forward')
+    name, arguments, params = VSM_KERNELS[model]
+
+    reference = getattr(VSM_forward, name)(X, Y, **arguments)
+    native = forward.displacement(model, X, Y, params, nu=NU)
+
+    assert max(peak_error(reference, native)) < 1e-6
+
+
+@pytest.mark.parametrize('slip', ['strike_slip', 'dip_slip', 'tensile'])
+def test_okada_table(slip):
+    ref = REFERENCE['okada']
+    dip = np.deg2rad(ref['dip'])
+    # Okada's origin is the lower left corner, the kernel's the upper one, strike east so that x is east
+    x, y = np.array([ref['x']]), np.array([ref['y'] - ref['width'] * np.cos(dip)])
+    depth = ref['d'] - ref['width'] * np.sin(dip)
+    dislocation = {'strike_slip': (1., 0., 0.), 'dip_slip': (1., 90., 0.), 'tensile': (0., 0., 1.)}[slip]
+
+    u = forward.okada(x, y, 0., 0., depth, ref['length'], ref['width'], 90., ref['dip'], *dislocation, nu=ref['nu'])
+
+    np.testing.assert_allclose(np.ravel(u), ref[slip], rtol=2e-3, atol=1e-6)
+
+
+@pytest.mark.parametrize('model', ['mogi', 'point'])
+def test_radial_reference(model):
+    ref = REFERENCE[model]
+    params = {p: ref[p] for p in forward.param_names(model) if p in ref}
+    r = np.asarray(ref['r'])
+    # Along an azimuth of 30 degrees from east
+    x, y = 300. + r * np.cos(np.pi / 6), -200. + r * np.sin(np.pi / 6)
+
+    ux, uy, uz = forward.displacement(model, x, y, dict(params, xcen=300., ycen=-200.), nu=ref['nu'])
+
+    np.testing.assert_allclose(np.hypot(ux, uy), ref['ur'], rtol=1e-6)
+    np.testing.assert_allclose(uz, ref['uz'], rtol=1e-6)
+
+
+def test_small_mctigue_sphere_is_mogi():
+    """McTigue's correction vanishes with the radius, a sphere of pressure dP in a full space changes volume by pi a^3 dP / mu."""
+    radius, dP_mu = 100., 1e-2
+    mogi = forward.mogi(X, Y, 300., -200., 3000., np.pi * radius ** 3 * dP_mu, nu=NU)
+    point = forward.point(X, Y, 300., -200., 3000., radius, dP_mu, nu=NU)
+
+    assert max(peak_error(mogi, point)) < 1e-4
+
+
+@pytest.mark.parametrize('rake', [0., 90.])
+def test_moment_is_small_fault(rake):
+    """A double couple of moment slip * area (s n^T + n s^T) over shear modulus is a small fault."""
+    strike, dip, slip, area = 30., 60., 1., 20. ** 2
+    s, d, r = np.deg2rad(strike), np.deg2rad(dip), np.deg2rad(rake)
+    # Upward normal of the fault and slip of its hanging wall, x east, y north, z up
+    normal = np.array([np.sin(d) * np.cos(s), -np.sin(d) * np.sin(s), np.cos(d)])
+    along, up_dip = np.array([np.sin(s), np.cos(s), 0.]), np.cross(normal, np.array([np.sin(s), np.cos(s), 0.]))
+    vector = np.cos(r) * along + np.sin(r) * up_dip
+    M = slip * area * (np.outer(vector, normal) + np.outer(normal, vector))
+
+    fault = small_fault(300., -200., 3000., strike, dip, rake, slip=slip)
+    moment = forward.moment(X, Y, 300., -200., 3000., M[0, 0], M[1, 1], M[2, 2], M[0, 1], M[0, 2], M[1, 2], nu=NU)
+
+    assert max(peak_error(fault, moment)) < 1e-3
+
+
+def test_deep_penny_is_small_sill():
+    """Far from the crack, a penny crack is a horizontal sill of the opening volume of Sneddon (1946)."""
+    radius, dP_mu = 100., 1e-2
+    volume = 8 * (1 - NU) / 3 * radius ** 3 * dP_mu
+    sill = small_fault(300., -200., 3000., 0., 0., 0., opening=volume / 20. ** 2)
+    penny = forward.penny(X, Y, 300., -200., 3000., radius, dP_mu, nu=NU)
+
+    assert max(peak_error(sill, penny)) < 1e-3
+
+
+def test_spherical_spheroid_is_mogi():
+    """A spheroid of equal axes is a pressurized sphere, of volume change pi a^3 dP / mu."""
+    a, dP_mu = 500., 1e-3
+    mogi = forward.mogi(X, Y, 300., -200., 3000., np.pi * a ** 3 * dP_mu, nu=NU)
+    spheroid = forward.spheroid(X, Y, 300., -200., 3000., 30., 40., 1., a, dP_mu, nu=NU)
+
+    assert max(peak_error(mogi, spheroid)) < 1e-3
+
+
+def test_okada_opening_is_integrated_tensile_points():
+    """A rectangular opening dislocation is the sum of the tensile point sources of its patches."""
+    length, width, strike, dip, opening = 2000., 1000., 30., 60., 1.
+    xcen, ycen, depth = 500., 300., 1500.
+    okada = forward.okada(X, Y, xcen, ycen, depth, length, width, strike, dip, 0., 0., opening, nu=NU)
+
+    n_along, n_down = 80, 40
+    s, d = np.deg2rad(strike), np.deg2rad(dip)
+    total = [0., 0., 0.]
+    for i in range(n_along):
+        for j in range(n_down):
+            along, down = (i + 0.5) * length / n_along, (j + 0.5) * width / n_down
+            # Along strike, then down dip to the right of it
+            cx = xcen + along * np.sin(s) + down * np.cos(d) * np.cos(s)
+            cy = ycen + along * np.cos(s) - down * np.cos(d) * np.sin(s)
+            u = forward._tensile_point(X - cx, Y - cy, depth + down * np.sin(d), d,
+                                       opening * length * width / (n_along * n_down), NU, strike=s)
+            total = [t + c for t, c in zip(total, u)]
+
+    assert max(peak_error(okada, total)) < 1e-3
+
+
+@pytest.mark.parametrize('nu', [0.25, 0.3])
+def test_isotropic_moment_is_mogi(nu):
+    """An isotropic moment tensor (lambda/mu + 2) dV over shear modulus is a Mogi source of volume change dV."""
+    volume = 1e6
+    M = (2 * nu / (1 - 2 * nu) + 2) * volume
+    mogi = forward.mogi(X, Y, 300., -200., 3000., volume, nu=nu)
+    moment = forward.moment(X, Y, 300., -200., 3000., M, M, M, 0., 0., 0., nu=nu)
+
+    assert max(peak_error(mogi, moment)) < 1e-9
+
+
+def test_far_field_ranges():
+    ranges = {'xcen': (0, 1), 'ycen': (0, 1), 'radius': (600, 800), 'dP_mu': (1e-4, 1e-2)}
+
+    deep = dict(ranges, depth=(2000, 5000))
+    assert forward.far_field_ranges('penny', deep) is deep
+    assert forward.far_field_ranges('penny', dict(ranges, depth=(0, 5000)))['depth'] == (1600, 5000)
+    assert forward.far_field_ranges('mogi', dict(ranges, depth=(0, 5000)))['depth'] == (0, 5000)
+    with pytest.raises(ValueError):
+        forward.far_field_ranges('penny', dict(ranges, depth=(0, 1000)))
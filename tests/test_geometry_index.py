@@ -0,0 +1,57 @@
+import h5py
+import numpy as np
+import pytest
+from src.downsample.objects.geometry_index import GeometryIndex
+
+SHAPE = (60, 50)
+
+
+def pixel_id(rows, cols):
+    """Raster whose value is the flat index of the pixel."""
+    return (np.asarray(rows) * SHAPE[1] + np.asarray(cols)).astype(float)
+
+
+def radar_geometry(folder):
+    """Radar-coded geometry file of a slightly rotated grid of 0.001 deg pixels, with a hole of no-data."""
+    rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]].astype(float)
+    lat = 40.1 - 0.001 * rows + 0.0001 * cols
+    lon = 14.0 + 0.001 * cols + 0.0001 * rows
+    lat[20:35, 20:35] = lon[20:35, 20:35] = np.nan
+
+    file = str(folder / 'geometryRadar.h5')
+    with h5py.File(file, 'w') as f:
+        f['latitude'], f['longitude'] = lat, lon
+        f['incidenceAngle'] = np.full(SHAPE, 35.)
+    return file, lat, lon
+
+
+def test_radar_holes_and_outside_are_nan(tmp_path):
+    file, lat, lon = radar_geometry(tmp_path)
+    index = GeometryIndex(file)
+
+    # A pixel center, the middle of the hole and a point off the scene
+    lons = np.array([lon[10, 5], 14.0 + 0.001 * 27 + 0.0001 * 27, 13.5])
+    lats = np.array([lat[10, 5], 40.1 - 0.001 * 27 + 0.0001 * 27, 40.0])
+
+    for method in ['nearest', 'bilinear']:
+        values = index.sample(pixel_id, lons, lats, method=method)
+        assert values[0] == pytest.approx(pixel_id(10, 5), abs=1e-6)
+        assert np.all(np.isnan(values[1:]))
+
+
+def test_regular_outside_is_nan(tmp_path):
+    file = str(tmp_path / 'geometryGeo.h5')
+    with h5py.File(file, 'w') as f:
+        f['incidenceAngle'] = np.full(SHAPE, 35.)
+        f.attrs.update({'X_FIRST': 14.0, 'X_STEP': 0.001, 'Y_FIRST': 40.1, 'Y_STEP': -0.001})
+    index = GeometryIndex(file)
+
+    # Centre of the last pixel and a pixel beyond the last column
+    lons = np.array([14.0 + 0.001 * (SHAPE[1] - 0.5), 14.0 + 0.001 * (SHAPE[1] + 0.5)])
+    lats = np.array([40.1 - 0.001 * (SHAPE[0] - 0.5)] * 2)
+    rows, cols, found = index.nearest(lons, lats)
+
+    assert (rows[0], cols[0]) == (SHAPE[0] - 1, SHAPE[1] - 1)
+    assert found.tolist() == [True, False]
+    assert np.isnan(index.sample(pixel_id, lons, lats)[1])
+
@@ -0,0 +1,35 @@
+import numpy as np
+from src.inversion.objects.greens import GreensTable
+from src.inversion.objects.problem import Problem
+
+# Points of a 20 x 20 km grid, descending LOS
+X, Y = [c.ravel() for c in np.meshgrid(np.linspace(-10000, 10000, 21), np.linspace(-10000, 10000, 21))]
+LOS = (np.full(X.shape, 0.6), np.full(X.shape, -0.1), np.full(X.shape, 0.79))
+BOUNDS = [(-3000, 3000), (-3000, 3000), (500, 5000)]
+
+
+def points():
+    zero = np.zeros(X.shape)
+    return {'xx': X, 'yy': Y, 'dd': zero, 'ee': zero + 1e-3, 'lx': LOS[0], 'ly': LOS[1], 'lz': LOS[2]}
+
+
+def test_size_and_error_with_refinement(tmp_path):
+    coarse = GreensTable(str(tmp_path), X, Y, LOS, 'mogi', ['volume'], {}, BOUNDS, shape=(5, 5, 5))
+    fine = GreensTable(str(tmp_path), X, Y, LOS, 'mogi', ['volume'], {}, BOUNDS, shape=(21, 21, 21))
+
+    assert GreensTable.nbytes((5, 5, 5), len(X), 1) == coarse.table.nbytes
+
+    # One cell centre per depth layer at least, the error falls with the node spacing
+    depth, error = coarse.interpolation_error(X, Y, LOS, n=16)
+    assert sorted(set(depth)) == sorted((coarse.axes[2][1:] + coarse.axes[2][:-1]) / 2)
+    assert np.median(fine.interpolation_error(X, Y, LOS, n=16)[1]) < np.median(error) / 5
+
+
+def test_max_size_skips_the_table(tmp_path):
+    sources = [('mogi', {'xcen': BOUNDS[0], 'ycen': BOUNDS[1], 'depth': BOUNDS[2], 'volume': (0, 1e7)})]
+    problem = Problem([points()], sources)
+
+    assert problem.use_greens(str(tmp_path), shape=(5, 5, 5), max_size=1e-3) == []
+    assert problem.greens_error() == {}
+    assert problem.use_greens(str(tmp_path), shape=(5, 5, 5), max_size=1.) == ['mogi']
+    assert list(problem.greens_error()) == ['mogi']